@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# _bench_job.py
+"""
+Job synthétique des benchmarks (voir drapo.bench). Bibliothèque standard uniquement.
+
+    python _bench_job.py sleep <secondes>
+    python _bench_job.py burn <secondes>               # boucle CPU
+    python _bench_job.py lines <n> [<lignes/s>]        # n lignes sur stdout, au débit donné (0 = max)
+"""
+
+import sys
+import time
+
+
+def main(argv):
+    mode = argv[0]
+    if mode == "sleep":
+        time.sleep(float(argv[1]))
+    elif mode == "burn":
+        end = time.process_time() + float(argv[1])
+        x = 0
+        while time.process_time() < end:
+            x += 1
+    elif mode == "lines":
+        count = int(argv[1])
+        rate = float(argv[2]) if len(argv) > 2 else 0.0
+        start = time.perf_counter()
+        write = sys.stdout.write
+        for i in range(count):
+            write(f"ligne {i} : {'x' * 60}\n")
+            if rate and i % 100 == 99:
+                ahead = (i + 1) / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    sys.stdout.flush()
+                    time.sleep(ahead)
+        sys.stdout.flush()
+    else:
+        sys.exit(f"mode inconnu : {mode}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# _profile_script.py
+"""
+Lanceur de script Python avec profilage (option `profile` d'un job python, voir drapo.runners).
+
+    python _profile_script.py [--cprofile <fichier.prof>] [--tracemalloc <fichier.txt>] -- script.py [args...]
+
+    Ce fichier n'importe que la bibliothèque standard : l'interpréteur du job n'a pas besoin de Drapo.
+    Le script est exécuté via runpy comme `python script.py` ; les rapports sont écrits à sa sortie,
+    y compris sur exception ou sys.exit. Le .prof se lit avec pstats ou snakeviz.
+"""
+
+import os
+import sys
+import runpy
+
+TRACEMALLOC_FRAMES = 1
+TRACEMALLOC_TOP = 30
+
+
+def _write_tracemalloc(path, snapshot, peak):
+    stats = snapshot.statistics("lineno")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("Pic mémoire Python (tracemalloc) : %.1f MB\n" % (peak / 1024 / 1024))
+        f.write("Allocations encore vivantes en fin de script, par ligne (top %d) :\n\n" % TRACEMALLOC_TOP)
+        for stat in stats[:TRACEMALLOC_TOP]:
+            f.write("%s\n" % stat)
+
+
+def main(argv):
+    cprofile_path = tracemalloc_path = None
+    while argv and argv[0] != "--":
+        option, value, argv = argv[0], argv[1], argv[2:]
+        if option == "--cprofile":
+            cprofile_path = value
+        elif option == "--tracemalloc":
+            tracemalloc_path = value
+    script, args = argv[1], argv[2:]
+
+    sys.argv = [script] + args
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+    profiler = None
+    if tracemalloc_path:
+        import tracemalloc
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    if cprofile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+        if tracemalloc_path:
+            _, peak = tracemalloc.get_traced_memory()
+            _write_tracemalloc(tracemalloc_path, tracemalloc.take_snapshot(), peak)
+            tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
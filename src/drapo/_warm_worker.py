@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# _warm_worker.py
+"""
+Serveur d'interpréteur « chaud » pour les jobs python (voir drapo.pyworkers).
+
+    Lancé avec l'interpréteur du job : python _warm_worker.py <socket> <modules préchargés en JSON>.
+    Ce fichier n'importe que la bibliothèque standard : l'interpréteur du job n'a pas besoin de Drapo.
+    Pour chaque connexion, le serveur forke un superviseur qui forke à son tour le process du script :
+    le script s'exécute via runpy dans un état isolé, sa sortie (stdout+stderr) part sur la socket,
+    et le superviseur ajoute le code retour réel une fois le script terminé (même après os._exit ou un crash).
+"""
+
+import os
+import sys
+import json
+import atexit
+import runpy
+import signal
+import socket
+import importlib
+import traceback
+
+PID_MARKER = b"\x00DRAPO-PID:"
+EXIT_MARKER = b"\x00DRAPO-EXIT:"
+
+
+def _exit_code(status):
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return 1
+
+
+def _read_request(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise EOFError("connexion fermée avant la requête")
+        data += chunk
+    return json.loads(data.decode("utf-8"))
+
+
+def _run_script(conn, request):
+    """Process du script : ne retourne jamais."""
+    code = 1
+    try:
+        os.setsid()
+        fd = conn.fileno()
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.write(1, PID_MARKER + str(os.getpid()).encode() + b"\n")
+        sys.stdout = open(1, "w", encoding="utf-8", errors="replace", buffering=1, closefd=False)
+        sys.stderr = open(2, "w", encoding="utf-8", errors="replace", buffering=1, closefd=False)
+
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        script = request["script"]
+        sys.argv = [script] + request["args"]
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        try:
+            runpy.run_path(script, run_name="__main__")
+            code = 0
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            # Trace identique à `python script.py` : on retire les frames du serveur et de runpy
+            etype, value, tb = sys.exc_info()
+            while tb is not None and tb.tb_frame.f_code.co_filename != script:
+                tb = tb.tb_next
+            traceback.print_exception(etype, value, tb)
+            code = 1
+        # os._exit ne lance pas les handlers atexit du script (flush de logging, etc.)
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+
+def _supervise(conn):
+    """Superviseur : lance le script, attend sa fin et renvoie son code retour. Ne retourne jamais."""
+    code = 1
+    try:
+        request = _read_request(conn)
+        pid = os.fork()
+        if pid == 0:
+            _run_script(conn, request)
+        _, status = os.waitpid(pid, 0)
+        code = _exit_code(status)
+        conn.sendall(EXIT_MARKER + str(code).encode() + b"\n")
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        os._exit(0)
+
+
+def main(sock_path, preload):
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print("preload %s failed: %s" % (module, e), flush=True)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(64)
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+    print("ready", flush=True)
+
+    while True:
+        conn, _ = server.accept()
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            _supervise(conn)
+        conn.close()
+        # Récupère les superviseurs terminés
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], json.loads(sys.argv[2]))
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# bench.py
+"""
+Benchmarks du coût propre de Drapo, mesuré avec des jobs synthétiques (drapo/_bench_job.py).
+
+    python -m drapo.bench [--quick] [--only spawn,log_throughput] [--out bench.json]
+                          [--compare baseline.json] [--tolerance 0.25]
+
+    spawn            lancement d'un process par stream_subprocess (ms par commande)
+    flow_overhead    run_flow séquentiel de jobs python vides : coût par job hors script
+    log_throughput   lignes de sortie d'un process enfant traversant le pipeline de logs
+    fan_out          DAG d'une racine et de K jobs parallèles : durée au-delà du chemin critique
+    cpu_burn         CPU de l'orchestrateur pendant un job qui consomme du CPU (échantillonnage, streaming)
+    scheduler_lag    retard entre l'heure planifiée d'un trigger et le démarrage du flow
+
+    Le CPU mesuré est celui du process Drapo (tous ses threads), hors process enfants.
+    Le résultat JSON porte la version et le commit : --compare signale les métriques dégradées
+    de plus de --tolerance par rapport à une référence (code retour 1). Les métriques en *_per_s
+    sont meilleures quand elles montent, toutes les autres quand elles baissent.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from argparse import Namespace
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+from drapo.logs import setup_pipeline, stop_pipeline
+from drapo.common import stream_subprocess
+from drapo.history import percentile
+from drapo.sampler import read_process_usage
+from drapo.orchestrer import run_flow
+from drapo.scheduler import SchedulerEngine, Trigger
+
+
+BENCH_JOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_bench_job.py")
+DEFAULT_TOLERANCE = 0.25
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+@contextmanager
+def measure(metrics: dict):
+    """Ajoute à `metrics` la durée (wall_s) et le CPU du process Drapo (cpu_s) du bloc."""
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    yield
+    metrics["wall_s"] = time.perf_counter() - wall
+    metrics["cpu_s"] = time.process_time() - cpu
+
+
+def bench_config(root: str) -> dict:
+    """Config Drapo minimale dans un répertoire temporaire : historique, logs par job et échantillonnage actifs."""
+    return {
+        "project_root": root,
+        "paths": {
+            "python_scripts": os.path.dirname(BENCH_JOB),
+            "drapostate": os.path.join(root, "state"),
+            "drapolog": os.path.join(root, "log"),
+        },
+        "flows": {},
+        "python_pool": {},
+    }
+
+
+def python_jobs(count: int, fan_out: bool = False) -> dict[str, dict]:
+    jobs = {}
+    for i in range(count):
+        job = {"name": f"job{i}", "type": "python", "script_file": os.path.basename(BENCH_JOB), "warm": False}
+        if fan_out:
+            job["depends_on"] = [] if i == 0 else ["job0"]
+        jobs[job["name"]] = job
+    return jobs
+
+
+################################################# Benchmarks #################################################
+@benchmark
+def spawn(CONFIG: dict, scale: int) -> dict:
+    n = 20 * scale
+    metrics = {"commands": n}
+    with measure(metrics):
+        for i in range(n):
+            stream_subprocess([sys.executable, BENCH_JOB, "sleep", "0"], name="bench_spawn")
+    metrics["ms_per_command"] = 1000 * metrics["wall_s"] / n
+    metrics["cpu_ms_per_command"] = 1000 * metrics["cpu_s"] / n
+    return metrics
+
+
+@benchmark
+def flow_overhead(CONFIG: dict, scale: int) -> dict:
+    n = 10 * scale
+    jobs = python_jobs(n)
+    # Référence : les mêmes commandes lancées directement, sans Drapo
+    start = time.perf_counter()
+    for _ in range(n):
+        subprocess.run([sys.executable, BENCH_JOB, "sleep", "0"], check=True)
+    baseline = time.perf_counter() - start
+    metrics = {"jobs": n}
+    with measure(metrics):
+        run_flow(CONFIG, sys.executable, list(jobs), jobs, args=Namespace(python_args="sleep 0"), flow_name="bench_overhead")
+    metrics["overhead_ms_per_job"] = 1000 * max(0.0, metrics["wall_s"] - baseline) / n
+    metrics["cpu_ms_per_job"] = 1000 * metrics["cpu_s"] / n
+    return metrics
+
+
+@benchmark
+def log_throughput(CONFIG: dict, scale: int) -> dict:
+    n = 50000 * scale
+    metrics = {"lines": n}
+    with measure(metrics):
+        stream_subprocess([sys.executable, BENCH_JOB, "lines", str(n)], name="bench_log")
+    metrics["lines_per_s"] = n / metrics["wall_s"]
+    metrics["cpu_us_per_line"] = 1e6 * metrics["cpu_s"] / n
+    return metrics
+
+
+@benchmark
+def fan_out(CONFIG: dict, scale: int) -> dict:
+    width = 8 * scale
+    sleep_s = 0.5
+    jobs = python_jobs(width + 1, fan_out=True)
+    metrics = {"jobs": width + 1}
+    with measure(metrics):
+        run_flow(CONFIG, sys.executable, list(jobs), jobs, args=Namespace(python_args=f"sleep {sleep_s}"),
+                 max_parallel=width, flow_name="bench_fan_out")
+    metrics["overhead_s"] = max(0.0, metrics["wall_s"] - 2 * sleep_s)
+    return metrics
+
+
+@benchmark
+def cpu_burn(CONFIG: dict, scale: int) -> dict:
+    burn_s = 1.0 * scale
+    jobs = python_jobs(1)
+    metrics = {"child_cpu_s": burn_s}
+    with measure(metrics):
+        run_flow(CONFIG, sys.executable, list(jobs), jobs, args=Namespace(python_args=f"burn {burn_s}"), flow_name="bench_burn")
+    metrics["orchestrator_cpu_ratio"] = metrics["cpu_s"] / burn_s
+    return metrics
+
+
+class IntervalTrigger(Trigger):
+    """Trigger à intervalle fixe sous la seconde, pour mesurer le retard du scheduler."""
+
+    def __init__(self, interval_s: float):
+        self.interval = timedelta(seconds=interval_s)
+        self.planned: list[float] = []
+
+    def next_after(self, after: datetime) -> datetime:
+        when = after + self.interval
+        self.planned.append(when.timestamp())
+        return when
+
+
+@benchmark
+def scheduler_lag(CONFIG: dict, scale: int) -> dict:
+    triggers = 20 * scale
+    engine = SchedulerEngine()
+    trigger = IntervalTrigger(0.05)
+    started: list[float] = []
+    done = threading.Event()
+
+    def callback():
+        started.append(time.time())
+        if len(started) >= triggers:
+            done.set()
+
+    root_logger = logging.getLogger()
+    level = root_logger.level
+    # Les messages de planification ne doivent pas peser sur la mesure
+    root_logger.setLevel(logging.WARNING)
+    metrics = {"triggers": triggers}
+    try:
+        engine.add("bench_lag", trigger, callback)
+        loop = threading.Thread(target=engine.run_forever, name="bench-scheduler", daemon=True)
+        with measure(metrics):
+            loop.start()
+            done.wait(60)
+            engine.stop()
+            loop.join()
+    finally:
+        root_logger.setLevel(level)
+    lags = [1000 * (start - planned) for start, planned in zip(started, trigger.planned)]
+    metrics.update(lag_p50_ms=percentile(lags, 50), lag_p95_ms=percentile(lags, 95), lag_max_ms=max(lags))
+    return metrics
+
+
+################################################# Report #################################################
+def version_info() -> dict:
+    try:
+        from importlib.metadata import version
+        drapo_version = version("drapo")
+    except Exception:
+        drapo_version = "unknown"
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(BENCH_JOB),
+                                capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {"drapo": drapo_version, "commit": commit, "python": platform.python_version(), "platform": platform.platform()}
+
+
+def run_benchmarks(names: list[str], scale: int = 1) -> dict:
+    root = tempfile.mkdtemp(prefix="drapo-bench-")
+    CONFIG = bench_config(root)
+    handler = logging.FileHandler(os.path.join(root, "drapo.log"), encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    logging.getLogger().setLevel(logging.INFO)
+    setup_pipeline([handler], os.path.join(root, "log"), {"job_logs": True})
+    report = {"version": version_info(), "timestamp": time.time(), "scale": scale, "benchmarks": {}}
+    try:
+        for name in names:
+            print(f"→ {name}…", file=sys.stderr)
+            report["benchmarks"][name] = BENCHMARKS[name](CONFIG, scale)
+    finally:
+        stop_pipeline()
+        shutil.rmtree(root, ignore_errors=True)
+    usage = read_process_usage(os.getpid())
+    report["process"] = {"peak_rss_kb": usage.peak_rss_kb if usage else None}
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    """Métriques dégradées de plus de `tolerance` (fraction) par rapport à `baseline`."""
+    regressions = []
+    for name, metrics in report["benchmarks"].items():
+        reference = baseline.get("benchmarks", {}).get(name, {})
+        for metric, value in metrics.items():
+            old = reference.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old <= 0:
+                continue
+            change = (value - old) / old
+            worse = -change if metric.endswith("_per_s") else change
+            if worse > tolerance:
+                regressions.append(f"{name}.{metric} : {old:.4g} → {value:.4g} ({change:+.0%})")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m drapo.bench", description="Benchmarks of Drapo's own overhead")
+    parser.add_argument("--only", default=None, help=f"Comma-separated benchmarks ({', '.join(BENCHMARKS)})")
+    parser.add_argument("--quick", action="store_true", help="Smaller workloads (scale 1 instead of 3)")
+    parser.add_argument("--out", default=None, help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument("--compare", default=None, help="Baseline JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed degradation (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    report = run_benchmarks(names, scale=1 if args.quick else 3)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# cache.py
+"""
+Cache d'empreintes des entrées des jobs (<drapostate>/cache.sqlite).
+
+    Un job python ou dbt peut déclarer un bloc `cache` dans le TOML :
+
+        [jobs.cache]
+        inputs = ["models/**/*.sql", "${python_scripts}/lib/*.py"]   # fichiers / globs
+        git = true                                                     # HEAD du dépôt paths.git_repo
+        env = ["TARGET_ENV"]                                           # variables d'environnement
+
+    Drapo calcule l'empreinte de ces entrées (et de la définition du job) ; si elle est identique à celle
+    du dernier succès, le job est sauté. Le cache est borné (`cache.max_entries` dans config.yml)
+    et les entrées les moins récemment utilisées sont évincées.
+"""
+
+import os
+import glob
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+
+from drapo.utils import git_repo_dir, resolve_path
+from drapo.common import run_output
+
+
+CACHEABLE_TYPES = ("python", "dbt")
+DEFAULT_MAX_ENTRIES = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    key          TEXT PRIMARY KEY,
+    fingerprint  TEXT NOT NULL,
+    stored_at    REAL NOT NULL,
+    last_used    REAL NOT NULL
+);
+"""
+
+
+class FingerprintCache:
+    """
+    Dernière empreinte à succès par clé (nom de job), bornée à `max_entries` clés en LRU.
+    """
+
+    def __init__(self, db_path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def hit(self, key: str, fingerprint: str) -> bool:
+        """True si `fingerprint` est l'empreinte du dernier succès de `key` (rafraîchit son rang LRU)."""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT fingerprint FROM fingerprints WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] != fingerprint:
+                return False
+            self._conn.execute("UPDATE fingerprints SET last_used = ? WHERE key = ?", (time.time(), key))
+            return True
+
+    def put(self, key: str, fingerprint: str):
+        """Enregistre l'empreinte d'un succès et évince les clés les moins récemment utilisées."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fingerprints (key, fingerprint, stored_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, fingerprint, now, now))
+            self._conn.execute(
+                "DELETE FROM fingerprints WHERE key NOT IN "
+                "(SELECT key FROM fingerprints ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+
+    def invalidate(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM fingerprints WHERE key = ?", (key,))
+
+
+_CACHES: dict[str, FingerprintCache] = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_cache(CONFIG: dict) -> FingerprintCache | None:
+    """Retourne le cache d'empreintes du projet, ou None si `drapostate` n'est pas configuré."""
+    try:
+        db_path = os.path.join(resolve_path("${drapostate}", CONFIG), "cache.sqlite")
+    except ValueError:
+        return None
+    with _CACHES_LOCK:
+        if db_path not in _CACHES:
+            max_entries = CONFIG.get("cache", {}).get("max_entries", DEFAULT_MAX_ENTRIES)
+            _CACHES[db_path] = FingerprintCache(db_path, max_entries)
+        return _CACHES[db_path]
+
+
+################################################# Fingerprint #################################################
+# Empreinte de contenu par fichier, réutilisée tant que taille et mtime ne changent pas
+_FILE_DIGESTS: dict[str, tuple[int, int, str]] = {}
+
+
+def file_digest(path: str) -> str:
+    st = os.stat(path)
+    memo = _FILE_DIGESTS.get(path)
+    if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+        return memo[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _FILE_DIGESTS[path] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+
+def git_head(repo_dir: str) -> str | None:
+    """Commit HEAD du dépôt, ou None si ce n'est pas un dépôt git (borné par l'échéance du job, annulable)."""
+    try:
+        result, out = run_output(["git", "rev-parse", "HEAD"], cwd=repo_dir, name="git", timeout_s=30)
+    except OSError:
+        return None
+    return out.strip() if result.ok else None
+
+
+def job_base_dir(CONFIG: dict, job: dict) -> str:
+    """Répertoire de référence des globs relatifs : scripts python ou projet dbt."""
+    return resolve_path("${dbt}" if job["type"] == "dbt" else "${python_scripts}", CONFIG)
+
+
+def job_fingerprint(CONFIG: dict, job: dict, extra_args: list[str] | None = None) -> str:
+    """
+    Empreinte SHA-256 de la définition du job, des fichiers déclarés dans `cache.inputs`,
+    du HEAD du dépôt `git_repo` (si `cache.git`, voir utils.git_repo_dir) et des variables de `cache.env`.
+    """
+    spec = job.get("cache", {})
+    h = hashlib.sha256()
+    h.update(json.dumps(job, sort_keys=True, default=str).encode())
+    h.update(json.dumps(extra_args or []).encode())
+
+    base = job_base_dir(CONFIG, job)
+    files = set()
+    for pattern in spec.get("inputs", []):
+        pattern = resolve_path(pattern, CONFIG) if pattern.startswith("${") else os.path.join(base, pattern)
+        files.update(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+    for path in sorted(files):
+        h.update(f"file:{path}:{file_digest(path)}\n".encode())
+
+    if spec.get("git"):
+        h.update(f"git:{git_head(git_repo_dir(CONFIG))}\n".encode())
+
+    for var in spec.get("env", []):
+        h.update(f"env:{var}={os.environ.get(var)}\n".encode())
+
+    return h.hexdigest()
+
+
+def check_job_cache(CONFIG: dict, job: dict, extra_args: list[str] | None = None) -> tuple[FingerprintCache | None, str | None, bool]:
+    """
+    Pour un job cachable avec un bloc `cache` : retourne (cache, empreinte, hit).
+    Sinon (None, None, False).
+    """
+    if not job.get("cache") or job.get("type") not in CACHEABLE_TYPES:
+        return None, None, False
+    cache = get_cache(CONFIG)
+    if cache is None:
+        logging.warning("Job %s : bloc cache ignoré, pas de chemin 'drapostate' dans config.yml.", job["name"])
+        return None, None, False
+    try:
+        fingerprint = job_fingerprint(CONFIG, job, extra_args)
+    except (OSError, ValueError) as e:
+        # Erreur de configuration (chemin absent de config.yml) : signalée comme telle, pas comme un simple miss
+        logging.error("Job %s : bloc cache inutilisable (%s), exécution sans cache.", job["name"], e)
+        return None, None, False
+    return cache, fingerprint, cache.hit(job["name"], fingerprint)
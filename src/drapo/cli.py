@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# cli.py
+"""
+Sous-commandes légères de drapo-run : list, validate, plan, run-job <nom>, run-flow <nom>.
+
+    list et validate ne configurent ni logger fichier ni scheduler, et n'importent que ce dont
+    elles ont besoin : avec les caches disque de config.yml et du plan (voir utils.read_cache),
+    elles ne chargent ni yaml, ni toml, ni les runners.
+    run-job et run-flow exécutent un job ou un flow tout de suite, sans scheduler ; leur code
+    de sortie donne le statut : 0 succès, 1 échec, 124 timeout, 130 annulation.
+    plan, et --dry-run sur les autres commandes, affichent la prévisualisation (drapo.preview)
+    sans lancer aucun process.
+"""
+
+import os
+import sys
+
+
+EXIT_CODES = {"success": 0, "failed": 1, "skipped": 1, "timed_out": 124, "cancelled": 130}
+
+
+def _plan(CONFIG: dict, env: str):
+    from drapo.plan import PlanError, load_plan
+    try:
+        return load_plan(CONFIG, fn=CONFIG["flows"][env])
+    except KeyError:
+        print(f"No flows file for environment '{env}' in config.yml", file=sys.stderr)
+    except FileNotFoundError as e:
+        print(f"Flows file not found: {e.filename}", file=sys.stderr)
+    except PlanError as e:
+        print(f"Invalid flows file {e.path}:", file=sys.stderr)
+        for error in e.errors:
+            print(f"  - {error}", file=sys.stderr)
+    return None
+
+
+def _schedule(flow: dict) -> str:
+    if "schedule" not in flow:
+        return "-"
+    return f"{flow['schedule']} {flow.get('cron') or flow.get('time', '')}".strip()
+
+
+def cmd_list(CONFIG: dict, args) -> int:
+    plan = _plan(CONFIG, args.env)
+    if plan is None:
+        return 1
+    print(f"Flows ({plan.path}):")
+    for flow in plan.flows:
+        options = [f"overlap={flow['overlap']}"] if "overlap" in flow else []
+        if flow.get("timeout_min"):
+            options.append(f"timeout={flow['timeout_min']}min")
+        print(f"  {flow['name']:<30} {_schedule(flow):<22} {len(flow.get('steps', []))} steps  {' '.join(options)}".rstrip())
+    print("Jobs:")
+    for job in plan.jobs.values():
+        if job["type"] != "flow":
+            print(f"  {job['name']:<30} {job['type']}")
+    return 0
+
+
+def cmd_validate(CONFIG: dict, args) -> int:
+    plan = _plan(CONFIG, args.env)
+    if plan is None:
+        return 1
+    problems = [f"path '{name}' does not exist: {path}" for name, path in CONFIG["paths"].items()
+                if name in ("drapoconfig", "python_scripts", "dbt") and not os.path.exists(path)]
+    from drapo.utils import git_repo_dir
+    git_jobs = [job["name"] for job in plan.jobs.values() if job["type"] == "git" or (job.get("cache") or {}).get("git")]
+    if git_jobs:
+        try:
+            git_repo_dir(CONFIG)
+        except ValueError as e:
+            print(f"Jobs {', '.join(git_jobs)} need a git repository: {e}", file=sys.stderr)
+            return 1
+    for problem in problems:
+        print(f"warning: {problem}", file=sys.stderr)
+    print(f"{plan.path}: OK ({len(plan.jobs)} jobs, {len(plan.flows)} flows)")
+    return 0
+
+
+def cmd_plan(CONFIG: dict, args) -> int:
+    plan = _plan(CONFIG, args.env)
+    if plan is None:
+        return 1
+    from drapo.preview import DEFAULT_DAYS, DEFAULT_PERCENTILE, print_preview
+    flows = getattr(args, "flows", None) or []
+    unknown = [name for name in flows if name not in {flow["name"] for flow in plan.flows}]
+    if unknown:
+        print(f"Unknown flow(s): {', '.join(unknown)}", file=sys.stderr)
+        return 1
+    return print_preview(CONFIG, plan, flows, days=getattr(args, "days", DEFAULT_DAYS),
+                         pct=getattr(args, "percentile", DEFAULT_PERCENTILE))
+
+
+def _prepare_run(CONFIG: dict, args):
+    """Logger, échantillonnage, file distribuée et pools : ce qu'une exécution ponctuelle utilise du scheduler."""
+    import signal
+    import threading
+    from drapo.utils import setup_logger
+    from drapo.common import request_cancel
+    from drapo.sampler import configure_sampler
+    from drapo.distributed import configure_distributed
+    from drapo.resources import configure_resources
+    from drapo.metrics import start_metrics
+
+    plan = _plan(CONFIG, args.env)
+    if plan is None:
+        return None
+    setup_logger(CONFIG)
+    configure_sampler(CONFIG["sampling"])
+    configure_distributed(CONFIG)
+    configure_resources(plan.config)
+    start_metrics(CONFIG, serve_http=False)
+    # SIGTERM / Ctrl-C : arrête les process des jobs en cours (hors du handler, qui ne doit pas bloquer)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: threading.Thread(target=request_cancel, daemon=True).start())
+    return plan
+
+
+def cmd_run_job(CONFIG: dict, args) -> int:
+    if args.dry_run:
+        return _preview_job(CONFIG, args)
+    plan = _prepare_run(CONFIG, args)
+    if plan is None:
+        return 1
+    job = plan.jobs.get(args.name)
+    if job is None or job["type"] == "flow":
+        print(f"Unknown job: {args.name} (use run-flow for flows)", file=sys.stderr)
+        return 1
+    from drapo.orchestrer import run_job
+    status = run_job(CONFIG, job, python_distrib=sys.executable, args=args)
+    return EXIT_CODES.get(status, 1)
+
+
+def _preview_job(CONFIG: dict, args) -> int:
+    plan = _plan(CONFIG, args.env)
+    if plan is None:
+        return 1
+    job = plan.jobs.get(args.name)
+    if job is None or job["type"] == "flow":
+        print(f"Unknown job: {args.name} (use run-flow for flows)", file=sys.stderr)
+        return 1
+    from drapo.preview import estimate_durations, format_preview, preview_flow
+    preview = preview_flow({"name": job["name"], "steps": [job["name"]]}, plan.jobs, estimate_durations(CONFIG))
+    print(format_preview(preview))
+    return 0
+
+
+def cmd_run_flow(CONFIG: dict, args) -> int:
+    if args.dry_run:
+        args.flows = [args.name]
+        return cmd_plan(CONFIG, args)
+    plan = _prepare_run(CONFIG, args)
+    if plan is None:
+        return 1
+    try:
+        flow = plan.flow(args.name)
+    except KeyError as e:
+        print(e.args[0], file=sys.stderr)
+        return 1
+    from drapo.orchestrer import run_flow, timeout_seconds, _flow_status
+    from drapo.overlap import guard_for_flow
+    result = {}
+    ran = guard_for_flow(CONFIG, flow).run(lambda: result.update(run_flow(
+        CONFIG, python_distrib=sys.executable, steps=flow["steps"], jobs_map=plan.jobs, args=args,
+        max_parallel=flow.get("max_parallel"), flow_name=flow["name"], timeout_s=timeout_seconds(flow))))
+    if not ran:
+        return 1
+    return EXIT_CODES.get(_flow_status(result), 1)
+
+
+COMMANDS = {
+    "list": cmd_list,
+    "validate": cmd_validate,
+    "plan": cmd_plan,
+    "run-job": cmd_run_job,
+    "run-flow": cmd_run_flow,
+}
@@ -1,39 +1,434 @@
 import os
+import time
+import atexit
+import signal
+import asyncio
 import logging
-import subprocess
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 
+from drapo.sampler import ProcessUsage, sample_process
 
-# stream_subprocess est utilisé pour exécuter des jobs en streaming (avec des logs en temps réel),
-def stream_subprocess(cmd: list[str], cwd: str | None = None, args : list | None = None) -> int:
+
+# Taille max d'une ligne lue sur stdout/stderr d'un process enfant (dbt peut produire de longues lignes)
+STREAM_LIMIT = 1024 * 1024
+# Délai laissé au groupe de process d'un job entre SIGTERM et SIGKILL
+TERM_GRACE_S = 10
+
+
+@dataclass
+class RunResult:
+    """
+    Résultat de l'exécution d'une commande : code retour et timing.
+    """
+    name: str
+    cmd: list[str]
+    returncode: int
+    started_at: float
+    ended_at: float
+    pid: int | None = None
+    output_bytes: int = 0
+    peak_rss_kb: int | None = None
+    # Relevés /proc du process (voir drapo.sampler) ; None si indisponibles
+    cpu_s: float | None = None
+    io_read_bytes: int | None = None
+    io_write_bytes: int | None = None
+    max_threads: int | None = None
+    # "timed_out" ou "cancelled" si Drapo a interrompu la commande
+    termination: str | None = None
+    extra: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.ended_at - self.started_at
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    def apply_usage(self, usage: ProcessUsage):
+        """Reporte les relevés de l'échantillonneur sur le résultat."""
+        if usage.cpu_s or usage.peak_rss_kb:
+            self.cpu_s = usage.cpu_s
+            self.peak_rss_kb = usage.peak_rss_kb or None
+            self.io_read_bytes = usage.read_bytes
+            self.io_write_bytes = usage.write_bytes
+            self.max_threads = usage.max_threads or None
+
+    @classmethod
+    def not_run(cls, name: str, cmd: list[str] | None = None, returncode: int = 1,
+                termination: str | None = None) -> "RunResult":
+        """Résultat d'une commande qui n'a pas été lancée."""
+        now = time.time()
+        return cls(name=name, cmd=cmd or [], returncode=returncode, started_at=now, ended_at=now,
+                   termination=termination)
+
+
+def combine_results(name: str, results: list[RunResult]) -> RunResult:
+    """
+    Agrège les résultats de plusieurs commandes d'un même job (ex: git fetch + reset).
+    Le code retour est celui de la première commande en échec.
+    """
+    if not results:
+        return RunResult.not_run(name, returncode=0)
+    failed = next((r for r in results if r.returncode != 0), None)
+    return RunResult(
+        name=name,
+        cmd=[arg for r in results for arg in r.cmd],
+        returncode=failed.returncode if failed else 0,
+        started_at=min(r.started_at for r in results),
+        ended_at=max(r.ended_at for r in results),
+        output_bytes=sum(r.output_bytes for r in results),
+        peak_rss_kb=max((r.peak_rss_kb for r in results if r.peak_rss_kb is not None), default=None),
+        cpu_s=_sum_known(r.cpu_s for r in results),
+        io_read_bytes=_sum_known(r.io_read_bytes for r in results),
+        io_write_bytes=_sum_known(r.io_write_bytes for r in results),
+        max_threads=max((r.max_threads for r in results if r.max_threads is not None), default=None),
+        termination=next((r.termination for r in results if r.termination), None),
+    )
+
+
+def _sum_known(values) -> float | None:
+    known = [v for v in values if v is not None]
+    return sum(known) if known else None
+
+
+################################################# Timeouts & cancellation #################################################
+# Échéance (horloge time.monotonic) du job ou du flow en cours. Propagée aux tâches du moteur asyncio
+# comme current_job_log : chaque commande lancée pour le job connaît le temps qu'il lui reste.
+current_deadline: ContextVar[float | None] = ContextVar("drapo_deadline", default=None)
+
+
+class CancelScope:
+    """
+    Groupe d'exécutions annulables ensemble (une exécution de flow, ou tout le process).
+    Les jobs lancés dans le scope courant (voir cancel_scope) s'arrêtent quand il est annulé.
+    """
+
+    def __init__(self, name: str = "drapo"):
+        self.name = name
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        ENGINE.cancel_supervised(self)
+
+
+# Annulation globale (SIGTERM, Ctrl-C) et scope de l'exécution courante
+_PROCESS_SCOPE = CancelScope()
+current_scope: ContextVar[CancelScope | None] = ContextVar("drapo_cancel_scope", default=None)
+# Tâches du moteur qui supervisent un process enfant, avec leur scope (manipulé uniquement depuis la boucle)
+_SUPERVISED: dict[asyncio.Task, CancelScope | None] = {}
+
+
+@contextmanager
+def cancel_scope(scope: CancelScope):
+    """Rattache le bloc (et les commandes qu'il lance) à `scope`."""
+    token = current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        current_scope.reset(token)
+
+
+def _cancelled() -> bool:
+    scope = current_scope.get()
+    return _PROCESS_SCOPE.cancelled or (scope is not None and scope.cancelled)
+
+
+@contextmanager
+def deadline(timeout_s: float | None):
+    """Borne la durée du bloc (et des commandes qu'il lance) ; une échéance englobante plus proche reste prioritaire."""
+    if not timeout_s:
+        yield
+        return
+    new = time.monotonic() + timeout_s
+    current = current_deadline.get()
+    token = current_deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining_time() -> float | None:
+    """Secondes restantes avant l'échéance courante ; None sans timeout."""
+    value = current_deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+def interrupted() -> str | None:
+    """Raison d'interruption : "cancelled" si un arrêt a été demandé, "timed_out" si l'échéance est passée, sinon None."""
+    if _cancelled():
+        return "cancelled"
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        return "timed_out"
+    return None
+
+
+def cancel_requested() -> bool:
+    """True après un arrêt global (SIGTERM, Ctrl-C)."""
+    return _PROCESS_SCOPE.cancelled
+
+
+def request_cancel():
+    """
+    Annule toutes les exécutions en cours (SIGTERM, Ctrl-C) : les process enfants sont arrêtés
+    et les jobs qui n'ont pas encore démarré ne démarrent plus.
+    """
+    _PROCESS_SCOPE.cancel()
+
+
+def signal_process_group(pid: int, sig: int):
+    """Envoie `sig` à tout le groupe de process de `pid` (au process seul hors POSIX)."""
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def terminate_process_group(pid: int | None, finished: asyncio.Future, grace: float = TERM_GRACE_S):
+    """SIGTERM au groupe de process, puis SIGKILL si `finished` (la fin du process) n'arrive pas dans le délai."""
+    if pid is None:
+        await finished
+        return
+    signal_process_group(pid, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(asyncio.shield(finished), grace)
+    except asyncio.TimeoutError:
+        logging.warning("Process %d toujours actif après %ds : SIGKILL.", pid, grace)
+        signal_process_group(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        await finished
+
+
+@contextmanager
+def cancellable():
+    """Expose la tâche asyncio courante à l'annulation (globale ou de son scope) le temps du bloc."""
+    task = asyncio.current_task()
+    _SUPERVISED[task] = current_scope.get()
+    try:
+        yield task
+    finally:
+        _SUPERVISED.pop(task, None)
+
+
+async def supervise(work, name: str, pid) -> tuple[object, str | None]:
+    """
+    Attend `work` (coroutine qui se termine avec le process enfant) en respectant l'échéance courante
+    et les demandes d'annulation. Sur timeout ou annulation, le groupe du process `pid()` est arrêté.
+    Retourne (résultat de work, None | "timed_out" | "cancelled").
+    """
+    task = asyncio.ensure_future(work)
+    with cancellable() as current:
+        termination = "cancelled" if _cancelled() else None
+        if termination is None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), remaining_time()), None
+            except asyncio.TimeoutError:
+                termination = "timed_out"
+                logging.error("[%s] Timeout dépassé : arrêt du groupe de process.", name)
+            except asyncio.CancelledError:
+                # L'annulation est traitée ici : le job se termine avec un résultat "cancelled"
+                if hasattr(current, "uncancel"):
+                    current.uncancel()
+                termination = "cancelled"
+                logging.warning("[%s] Annulation demandée : arrêt du groupe de process.", name)
+        await terminate_process_group(pid(), task)
+        return task.result(), termination
+
+
+################################################# Async runner #################################################
+async def _pump(stream: asyncio.StreamReader, name: str, tag: str) -> int:
+    """
+    Lit un flux ligne par ligne et l'envoie au logger, préfixé par le nom du job.
+    Les records portent l'attribut `job` : le pipeline de logs peut les ignorer s'il est saturé.
+    Retourne le nombre d'octets lus.
+    """
+    extra = {"job": name}
+    total = 0
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        total += len(line)
+        logging.info("[%s] %s", tag, line.decode("utf-8", errors="replace").rstrip(), extra=extra)
+    return total
+
+
+async def run_command(cmd: list[str], cwd: str | None = None, name: str | None = None,
+                      env: dict | None = None) -> RunResult:
     """
-    Exécute `cmd` et stream stdout+stderr ligne par ligne vers le logger,
-    en mode texte, ligne-buffered.
+    Lance `cmd` via asyncio et streame stdout et stderr en parallèle vers le logger,
+    chaque ligne étant taguée avec le nom du job. Retourne le code retour et le timing.
     """
-    
-    logging.info("[>>>RUN>>>] : %s", " ".join(cmd))
-    env = os.environ.copy()
+    name = name or os.path.basename(cmd[0])
+    reason = interrupted()
+    if reason:
+        logging.warning("[%s] Non lancé (%s) : %s", name, reason, " ".join(cmd))
+        return RunResult.not_run(name, list(cmd), termination=reason)
+    logging.info("[>>>RUN>>>] [%s] : %s", name, " ".join(cmd))
+    if env is None:
+        env = os.environ.copy()
     env["PYTHONIOENCODING"] = "utf-8"
+    env["PYTHONUNBUFFERED"] = "1"
 
-    # text=True pour recevoir str, bufsize=1 pour line-buffered
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
+    started = time.time()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
         cwd=cwd,
         env=env,
-        text=True,
-        bufsize=1
+        limit=STREAM_LIMIT,
+        # Groupe de process propre au job : un timeout arrête aussi ses descendants
+        start_new_session=True,
     )
 
-    # Itérer directement sur proc.stdout pour chaque ligne
-    assert proc.stdout
-    for line in proc.stdout:
-        logging.info(line.rstrip())
+    async def finish():
+        out, err = await asyncio.gather(
+            _pump(proc.stdout, name, name),
+            _pump(proc.stderr, name, f"{name}:stderr"),
+        )
+        return out + err, await proc.wait()
+
+    usage = ProcessUsage()
+    sampler = asyncio.ensure_future(sample_process(proc.pid, usage))
+    try:
+        (output_bytes, code), termination = await supervise(finish(), name, lambda: proc.pid)
+    finally:
+        sampler.cancel()
+    ended = time.time()
+    logging.info("[<<<END<<<] [%s] : code %d en %.1fs", name, code, ended - started)
+    result = RunResult(name=name, cmd=list(cmd), returncode=code, started_at=started, ended_at=ended, pid=proc.pid,
+                       output_bytes=output_bytes, termination=termination)
+    result.apply_usage(usage)
+    return result
+
+
+async def run_commands(specs: list[dict]) -> list[RunResult]:
+    """
+    Lance plusieurs commandes en parallèle. Chaque spec contient les arguments de run_command
+    (cmd, cwd, name, env). Les résultats sont retournés dans l'ordre des specs.
+    """
+    return list(await asyncio.gather(*(run_command(**spec) for spec in specs)))
+
+
+async def capture_command(cmd: list[str], cwd: str | None = None, name: str | None = None) -> tuple[RunResult, str]:
+    """
+    Lance une commande courte (git rev-parse, dbt ls…) et retourne (RunResult, stdout) sans streamer
+    sa sortie ; stderr est dans extra["stderr"]. Supervisée comme run_command : échéance et annulation
+    du job arrêtent son groupe de process.
+    """
+    name = name or os.path.basename(cmd[0])
+    reason = interrupted()
+    if reason:
+        return RunResult.not_run(name, list(cmd), termination=reason), ""
+    started = time.time()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd, start_new_session=True)
+
+    async def finish():
+        out, err = await proc.communicate()
+        return out, err, await proc.wait()
+
+    (out, err, code), termination = await supervise(finish(), name, lambda: proc.pid)
+    result = RunResult(name=name, cmd=list(cmd), returncode=code, started_at=started, ended_at=time.time(),
+                       pid=proc.pid, output_bytes=len(out) + len(err), termination=termination)
+    result.extra["stderr"] = err.decode("utf-8", errors="replace")
+    return result, out.decode("utf-8", errors="replace")
 
-    if args.dry_run:
+
+class SubprocessEngine:
+    """
+    Boucle asyncio unique, dans un thread dédié, qui supervise tous les process enfants du process Drapo.
+    Les threads appelants (jobs d'un flow, flows planifiés) y soumettent leurs commandes et attendent le résultat.
+    """
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="drapo-subprocess", daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+            return self._loop
+
+    def submit(self, coro):
+        """Planifie une coroutine sur la boucle du moteur ; retourne un concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, cmd: list[str], cwd: str | None = None, name: str | None = None, env: dict | None = None) -> RunResult:
+        return self.submit(run_command(cmd, cwd=cwd, name=name, env=env)).result()
+
+    def capture(self, cmd: list[str], cwd: str | None = None, name: str | None = None) -> tuple[RunResult, str]:
+        return self.submit(capture_command(cmd, cwd=cwd, name=name)).result()
+
+    def run_many(self, specs: list[dict]) -> list[RunResult]:
+        return self.submit(run_commands(specs)).result()
+
+    def cancel_supervised(self, scope: CancelScope):
+        """
+        Annule, depuis n'importe quel thread, les tâches qui supervisent un process enfant
+        dans `scope` (toutes pour le scope du process).
+        """
+        with self._lock:
+            loop = self._loop
+        if loop is None or not loop.is_running():
+            return
+
+        def cancel():
+            for task, task_scope in list(_SUPERVISED.items()):
+                if scope is _PROCESS_SCOPE or task_scope is scope:
+                    task.cancel()
+        loop.call_soon_threadsafe(cancel)
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None and self._loop.is_running():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+ENGINE = SubprocessEngine()
+
+
+def run_subprocess(cmd: list[str], cwd: str | None = None, name: str | None = None, dry_run: bool = False) -> RunResult:
+    """
+    Exécute `cmd` sur le moteur asyncio partagé et retourne son RunResult.
+    En dry_run, la commande est seulement journalisée.
+    """
+    if dry_run:
         logging.info("[DRY RUN] Commande: %s", " ".join(cmd))
-        return 0
+        return RunResult.not_run(name or os.path.basename(cmd[0]), cmd, returncode=0)
+    return ENGINE.run(cmd, cwd=cwd, name=name)
 
-    code = proc.wait()
-    return code
 
+def run_output(cmd: list[str], cwd: str | None = None, name: str | None = None,
+               timeout_s: float | None = None) -> tuple[RunResult, str]:
+    """Exécute une commande courte et retourne (RunResult, stdout), dans la limite de `timeout_s` et de l'échéance courante."""
+    with deadline(timeout_s):
+        return ENGINE.capture(cmd, cwd=cwd, name=name)
+
+
+# stream_subprocess est utilisé pour exécuter des jobs en streaming (avec des logs en temps réel),
+def stream_subprocess(cmd: list[str], cwd: str | None = None, name: str | None = None, dry_run: bool = False) -> int:
+    """
+    Exécute `cmd` et stream stdout et stderr ligne par ligne vers le logger.
+    Retourne le code de sortie.
+    """
+    return run_subprocess(cmd, cwd=cwd, name=name, dry_run=dry_run).returncode
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# dbt_inprocess.py
+"""
+Exécution de dbt dans un process worker persistant (`mode = "inprocess"` sur un job dbt).
+
+    Le worker importe dbt une seule fois et appelle son runner programmatique (dbtRunner).
+    Le manifest parsé au premier appel est réutilisé par les commandes suivantes du même flow :
+    on ne paie qu'une fois l'import, le chargement de l'adapter et le parse du projet. Il est
+    reparsé quand le HEAD git du projet change (un job git du flow a mis le projet à jour).
+    Un flow garde jusqu'à MAX_SESSION_WORKERS workers par projet : les jobs dbt inprocess
+    parallèles d'un DAG prennent chacun un worker libre (chaque worker fait son propre parse) ;
+    au-delà, un job attend qu'un worker se libère, et le journalise.
+    Les événements dbt sont renvoyés au process Drapo et journalisés comme la sortie d'un
+    sous-process (la console de dbt est coupée et la sortie standard du worker suit le même
+    chemin) ; après chaque commande le manifest en mémoire est écrit dans <target>/manifest.json.
+    Le résultat est un RunResult avec le même code retour que la CLI dbt
+    (0 succès, 1 échec de modèles/tests, 2 erreur).
+    Si dbt n'est pas importable dans l'interpréteur de Drapo, l'appelant repasse en sous-process.
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+
+from drapo.common import TERM_GRACE_S, RunResult, interrupted, run_output
+from drapo.sampler import read_process_usage
+
+
+# Options globales qui changent le résultat du parse : le manifest est mis en cache par combinaison
+PARSE_FLAGS = {"--target", "-t", "--profiles-dir", "--project-dir", "--vars", "--profile"}
+WORKER_STOP_TIMEOUT_S = 10
+# Workers dbt simultanés par (flow, projet) ; chacun garde son propre manifest en mémoire
+MAX_SESSION_WORKERS = 4
+GIT_STATE_TIMEOUT_S = 10
+# Période de vérification du timeout et des annulations pendant une commande
+POLL_S = 0.5
+
+
+################################################# Worker process #################################################
+def _parse_key(args: list[str]) -> tuple[str, ...]:
+    key = []
+    for i, arg in enumerate(args):
+        if arg in PARSE_FLAGS and i + 1 < len(args):
+            key += [arg, args[i + 1]]
+    return tuple(key)
+
+
+def _quiet(args: list[str]) -> list[str]:
+    """Coupe la console de dbt : ses événements passent déjà par le callback (sauf --log-level explicite)."""
+    return args if "--log-level" in args else [*args, "--log-level", "none"]
+
+
+class _LogWriter:
+    """Remplace sys.stdout/sys.stderr du worker : chaque ligne écrite part au parent comme un log du job."""
+
+    def __init__(self, send):
+        self.send = send
+        self.buffer = ""
+
+    def write(self, text: str) -> int:
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                self.send("log", line)
+        return len(text)
+
+    def flush(self):
+        if self.buffer.strip():
+            self.send("log", self.buffer)
+        self.buffer = ""
+
+    def isatty(self) -> bool:
+        return False
+
+
+def _write_manifest(manifest, args: list[str]):
+    """Écrit le manifest en mémoire dans <target>/manifest.json : dbt ne le fait pas quand on lui fournit le manifest."""
+    from drapo.dbt_state import target_path
+    path = os.path.join(target_path(args, os.getcwd()), "manifest.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    manifest.writable_manifest().write(path)
+
+
+def _worker_main(conn, project_dir: str):
+    """Boucle du process worker : reçoit des listes d'arguments dbt, répond par des logs puis un code retour."""
+    os.chdir(project_dir)
+    try:
+        from dbt.cli.main import dbtRunner
+    except ImportError as e:
+        conn.send(("unavailable", str(e)))
+        return
+    conn.send(("ready", None))
+
+    send_lock = threading.Lock()
+
+    def send(kind, payload):
+        # dbt émet ses événements depuis plusieurs threads (--threads)
+        with send_lock:
+            conn.send((kind, payload))
+
+    def callback(event):
+        try:
+            if event.info.level != "debug":
+                send("log", event.info.msg)
+        except Exception:
+            pass
+
+    # Tout ce que dbt (ou une macro) écrit encore sur la console suit le pipeline de logs du job en cours
+    sys.stdout = sys.stderr = _LogWriter(send)
+
+    # {options de parse: (état du projet, manifest)} : un autre état du projet remplace le manifest
+    manifests = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        args, state = message
+        try:
+            key = _parse_key(args)
+            if key not in manifests or manifests[key][0] != state:
+                parsed = dbtRunner(callbacks=[callback]).invoke(_quiet(["parse", *key]))
+                manifests[key] = (state, parsed.result if parsed.success else None)
+            manifest = manifests[key][1]
+            res = dbtRunner(manifest=manifest, callbacks=[callback]).invoke(_quiet(args))
+            if res.exception is not None:
+                send("log", f"{type(res.exception).__name__}: {res.exception}")
+            code = 0 if res.success else (2 if res.exception is not None else 1)
+            if manifest is not None:
+                # Le target doit décrire ce run (state_aware archive <target>/manifest.json après la commande)
+                try:
+                    _write_manifest(manifest, args)
+                except Exception as e:
+                    send("log", f"manifest.json non écrit : {type(e).__name__}: {e}")
+        except BaseException as e:
+            send("log", f"{type(e).__name__}: {e}")
+            code = 2
+        sys.stdout.flush()
+        send("done", code)
+
+
+################################################# Parent side #################################################
+class DbtWorker:
+    """Process worker dbt pour un projet ; une commande à la fois."""
+
+    def __init__(self, project_dir: str):
+        self.project_dir = project_dir
+        self.busy = False
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, project_dir),
+                                   name="drapo-dbt-worker", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+        try:
+            kind, payload = self.conn.recv()
+        except EOFError:
+            kind, payload = "unavailable", "le worker s'est arrêté au démarrage"
+        self.available = kind == "ready"
+        self.reason = payload
+
+    def invoke(self, cmd: list[str], name: str) -> RunResult:
+        """Exécute `cmd` (["dbt", ...]) dans le worker en streamant ses événements vers le logger."""
+        extra = {"job": name}
+        with self.lock:
+            reason = interrupted()
+            if reason:
+                logging.warning("[%s] Non lancé (%s) : %s", name, reason, " ".join(cmd))
+                return RunResult.not_run(name, list(cmd), termination=reason)
+            logging.info("[>>>RUN>>>] [%s] (inprocess) : %s", name, " ".join(cmd))
+            started = time.time()
+            before = read_process_usage(self.process.pid)
+            output_bytes = 0
+            termination = None
+            self.conn.send((list(cmd[1:]), project_state(self.project_dir, name)))
+            while True:
+                if not self.conn.poll(POLL_S):
+                    termination = interrupted()
+                    if termination:
+                        # dbt ne sait pas s'interrompre proprement en cours de run : on arrête le worker,
+                        # il sera recréé à la prochaine commande de la session
+                        logging.error("[%s] Commande dbt interrompue (%s) : arrêt du worker.", name, termination)
+                        self.terminate()
+                        code = 2
+                        break
+                    continue
+                try:
+                    kind, payload = self.conn.recv()
+                except EOFError:
+                    logging.error("[%s] Le worker dbt s'est arrêté pendant la commande.", name)
+                    code = 2
+                    break
+                if kind == "log":
+                    output_bytes += len(payload)
+                    logging.info("[%s] %s", name, payload, extra=extra)
+                elif kind == "done":
+                    code = payload
+                    break
+            ended = time.time()
+            after = read_process_usage(self.process.pid)
+        logging.info("[<<<END<<<] [%s] : code %d en %.1fs", name, code, ended - started)
+        result = RunResult(name=name, cmd=list(cmd), returncode=code, started_at=started, ended_at=ended,
+                           pid=self.process.pid, output_bytes=output_bytes, termination=termination)
+        if before is not None and after is not None:
+            # Worker persistant : on ne compte que la consommation de cette commande
+            result.apply_usage(after.since(before))
+        return result
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def terminate(self):
+        """Arrêt immédiat du worker : SIGTERM, puis SIGKILL après TERM_GRACE_S."""
+        self.process.terminate()
+        self.process.join(TERM_GRACE_S)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def close(self):
+        if not self.alive:
+            self.conn.close()
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(WORKER_STOP_TIMEOUT_S)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+def project_state(project_dir: str, name: str) -> str | None:
+    """HEAD git du projet (None hors dépôt git) : le manifest en cache n'est valable que pour cet état."""
+    try:
+        result, out = run_output(["git", "rev-parse", "HEAD"], cwd=project_dir, name=name, timeout_s=GIT_STATE_TIMEOUT_S)
+    except OSError:
+        return None
+    return out.strip() if result.ok else None
+
+
+# Workers par (session, projet) : une session correspond à une exécution de flow
+_WORKERS: dict[tuple[str, str], list[DbtWorker]] = {}
+_STARTING: dict[tuple[str, str], int] = {}
+_WORKERS_LOCK = threading.Condition()
+
+
+def _checkout(key: tuple[str, str], project_dir: str, name: str) -> DbtWorker | None:
+    """
+    Réserve un worker libre de la session, en démarre un s'il en manque (hors du verrou : l'import
+    de dbt ne bloque pas les autres jobs), ou attend qu'un worker se libère. None si le job est interrompu.
+    """
+    waiting = False
+    with _WORKERS_LOCK:
+        while True:
+            workers = _WORKERS.setdefault(key, [])
+            # Worker arrêté après une interruption : il sera remplacé
+            for dead in [w for w in workers if w.available and not w.alive and not w.busy]:
+                workers.remove(dead)
+                dead.close()
+            unavailable = next((w for w in workers if not w.available), None)
+            if unavailable is not None:
+                return unavailable
+            idle = next((w for w in workers if not w.busy), None)
+            if idle is not None:
+                idle.busy = True
+                return idle
+            if len(workers) + _STARTING.get(key, 0) < MAX_SESSION_WORKERS:
+                _STARTING[key] = _STARTING.get(key, 0) + 1
+                break
+            if interrupted():
+                return None
+            if not waiting:
+                logging.info("[%s] En attente d'un worker dbt inprocess libre (%d par flow et par projet).",
+                             name, MAX_SESSION_WORKERS)
+                waiting = True
+            _WORKERS_LOCK.wait(POLL_S)
+    try:
+        worker = DbtWorker(project_dir)
+    finally:
+        with _WORKERS_LOCK:
+            _STARTING[key] -= 1
+    worker.busy = worker.available
+    with _WORKERS_LOCK:
+        _WORKERS.setdefault(key, []).append(worker)
+        _WORKERS_LOCK.notify_all()
+    return worker
+
+
+def _checkin(worker: DbtWorker):
+    with _WORKERS_LOCK:
+        worker.busy = False
+        _WORKERS_LOCK.notify_all()
+
+
+def run_inprocess(cmd: list[str], project_dir: str, name: str, session: str | None = None) -> RunResult | None:
+    """
+    Exécute une commande dbt dans un worker libre de la session (créé à la demande).
+    Sans session, un worker éphémère est utilisé. Retourne None si dbt n'est pas importable.
+    """
+    if session is None:
+        worker = DbtWorker(project_dir)
+        try:
+            return worker.invoke(cmd, name) if worker.available else _unavailable(worker)
+        finally:
+            worker.close()
+
+    worker = _checkout((session, project_dir), project_dir, name)
+    if worker is None:
+        reason = interrupted()
+        logging.warning("[%s] Non lancé (%s) : %s", name, reason, " ".join(cmd))
+        return RunResult.not_run(name, list(cmd), termination=reason)
+    if not worker.available:
+        return _unavailable(worker)
+    try:
+        return worker.invoke(cmd, name)
+    finally:
+        _checkin(worker)
+
+
+def _unavailable(worker: DbtWorker) -> None:
+    logging.warning("dbt inprocess indisponible (%s) : exécution en sous-process.", worker.reason)
+    return None
+
+
+def close_session(session: str):
+    """Arrête les workers dbt d'une session (fin du flow)."""
+    with _WORKERS_LOCK:
+        keys = [key for key in _WORKERS if key[0] == session]
+        workers = [worker for key in keys for worker in _WORKERS.pop(key)]
+    for worker in workers:
+        worker.close()
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# dbt_shards.py
+"""
+Exécution d'une commande dbt en plusieurs invocations parallèles (`shard_by` sur un job dbt).
+
+    [[jobs]]
+    name = "dbt_build"
+    type = "dbt"
+    cmd = ["dbt", "build", "--target", "prod", "-m", "from_this_model+"]
+    shard_by = "components"   # ou "tags"
+    max_shards = 4            # invocations dbt simultanées (4 par défaut)
+
+    La sélection de la commande est résolue par `dbt ls`, puis découpée d'après le graphe du manifest
+    (deux nœuds sélectionnés sont liés dès qu'un chemin du graphe complet les relie) :
+      - components : composantes connexes de la sélection, réparties en au plus `max_shards` shards
+        indépendants ;
+      - tags : un shard par tag (premier tag du nœud ; un nœud sans tag suit son premier ancêtre sélectionné).
+        Un shard attend les shards dont il dépend ; des shards interdépendants sont fusionnés.
+    Chaque shard est une commande dbt séparée avec son propre --target-path et --log-path
+    (<target>/shards/<shard>/) : les invocations ne s'écrasent pas, et chacune a son pool de
+    connexions et son --threads. L'échec d'un shard n'arrête que les shards qui en dépendent.
+    Les run_results.json des shards sont fusionnés dans <target>/shards/run_results.json et le job
+    retourne un seul RunResult.
+    Si la sélection ne peut pas être résolue, ou tient en un seul shard, la commande est lancée
+    telle quelle.
+"""
+
+import os
+import json
+import shutil
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from drapo.common import RunResult, combine_results, interrupted, run_output, run_subprocess
+from drapo.dbt_state import load_manifest, target_path
+from drapo.flowspec import STRATEGIES
+
+
+DEFAULT_MAX_SHARDS = 4
+# Sous-commandes dbt qui construisent des nœuds et peuvent être découpées
+SHARD_COMMANDS = {"build", "run", "test", "seed", "snapshot", "compile"}
+# Options de sélection : remplacées par la liste des nœuds du shard
+SELECTION_FLAGS = {"-m", "--models", "--model", "-s", "--select", "--exclude", "--selector"}
+# Options transmises à `dbt ls` pour résoudre la même sélection
+LS_FLAGS = SELECTION_FLAGS | {"--state", "--target", "-t", "--profiles-dir", "--project-dir", "--vars", "--profile",
+                              "--resource-type", "--resource-types", "--indirect-selection"}
+LS_TIMEOUT_S = 600
+
+
+################################################# Selection #################################################
+def partition_args(cmd: list[str], flags: set[str]) -> tuple[list[str], list[str]]:
+    """Sépare les options de `flags` (avec leurs valeurs) du reste de la commande : (options, reste)."""
+    matched, rest = [], []
+    i = 0
+    while i < len(cmd):
+        arg = cmd[i]
+        if arg.split("=", 1)[0] in flags:
+            matched.append(arg)
+            i += 1
+            if "=" not in arg:
+                while i < len(cmd) and not cmd[i].startswith("-"):
+                    matched.append(cmd[i])
+                    i += 1
+            continue
+        rest.append(arg)
+        i += 1
+    return matched, rest
+
+
+def _subcommand(cmd: list[str]) -> str | None:
+    return next((arg for arg in cmd[1:] if not arg.startswith("-")), None)
+
+
+def list_selection(cmd: list[str], project_dir: str, ls_target: str, name: str) -> list[str] | None:
+    """
+    unique_id des nœuds sélectionnés par la commande, résolus par `dbt ls` (le manifest est écrit
+    dans `ls_target`). None si dbt ls échoue.
+    """
+    selection, _ = partition_args(cmd, LS_FLAGS)
+    ls_cmd = [cmd[0], "ls", *selection, "--output", "json", "--output-keys", "unique_id", "--target-path", ls_target]
+    logging.info("[%s] Résolution de la sélection : %s", name, " ".join(ls_cmd))
+    try:
+        result, out = run_output(ls_cmd, cwd=project_dir, name=f"{name}:ls", timeout_s=LS_TIMEOUT_S)
+    except OSError as e:
+        logging.warning("[%s] dbt ls impossible : %s", name, e)
+        return None
+    if not result.ok:
+        logging.warning("[%s] dbt ls a échoué (%s) : %s", name, result.termination or f"code {result.returncode}",
+                        result.extra.get("stderr", "").strip()[-2000:])
+        return None
+    selected = []
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith("{"):
+            try:
+                selected.append(json.loads(line)["unique_id"])
+            except (ValueError, KeyError):
+                continue
+    return selected
+
+
+################################################# Sharding #################################################
+def _parents(manifest: dict, uid: str) -> list[str]:
+    node = manifest["nodes"].get(uid, {})
+    parents = (node.get("depends_on") or {}).get("nodes")
+    return list(parents if parents is not None else manifest.get("parent_map", {}).get(uid, []))
+
+
+def selected_ancestors(selected: list[str], manifest: dict) -> dict[str, set[str]]:
+    """
+    {nœud sélectionné: ses ancêtres sélectionnés les plus proches}, en traversant les nœuds non
+    sélectionnés du manifest complet : avec a → x → c et seulement a et c sélectionnés, c dépend de a.
+    """
+    chosen = set(selected)
+    memo: dict[str, set[str]] = {}
+
+    def resolve(start: str) -> set[str]:
+        stack, visiting = [start], {start}
+        while stack:
+            uid = stack[-1]
+            missing = [p for p in _parents(manifest, uid) if p not in chosen and p not in memo and p not in visiting]
+            if missing:
+                stack.extend(missing)
+                visiting.update(missing)
+                continue
+            memo[uid] = set().union(*({p} if p in chosen else memo.get(p, set()) for p in _parents(manifest, uid)))
+            stack.pop()
+        return memo[start]
+
+    return {uid: resolve(uid) - {uid} for uid in selected}
+
+
+def components(selected: list[str], manifest: dict, ancestors: dict[str, set[str]] | None = None) -> list[set[str]]:
+    """Composantes connexes de la sélection, reliées par les chemins du graphe complet (voir selected_ancestors)."""
+    ancestors = ancestors if ancestors is not None else selected_ancestors(selected, manifest)
+    root = {uid: uid for uid in selected}
+
+    def find(uid: str) -> str:
+        while root[uid] != uid:
+            root[uid] = root[root[uid]]
+            uid = root[uid]
+        return uid
+
+    for uid in selected:
+        for parent in ancestors[uid]:
+            root[find(uid)] = find(parent)
+    groups: dict[str, set[str]] = {}
+    for uid in selected:
+        groups.setdefault(find(uid), set()).add(uid)
+    return list(groups.values())
+
+
+def pack(groups: list[set[str]], max_shards: int) -> list[set[str]]:
+    """Répartit des groupes indépendants en au plus `max_shards` shards équilibrés (en nombre de nœuds)."""
+    shards: list[set[str]] = [set() for _ in range(min(max_shards, len(groups)))]
+    for group in sorted(groups, key=len, reverse=True):
+        min(shards, key=len).update(group)
+    return shards
+
+
+def by_tags(selected: list[str], manifest: dict, ancestors: dict[str, set[str]]) -> dict[str, set[str]]:
+    """Un shard par tag : premier tag (ordre alphabétique) du nœud, sinon celui de son premier ancêtre sélectionné."""
+    keys: dict[str, str] = {}
+
+    def key(uid: str, seen: frozenset = frozenset()) -> str:
+        if uid not in keys:
+            tags = sorted(manifest["nodes"].get(uid, {}).get("tags") or [])
+            parent = next((p for p in sorted(ancestors[uid]) if p not in seen), None)
+            keys[uid] = tags[0] if tags else (key(parent, seen | {uid}) if parent else "untagged")
+        return keys[uid]
+
+    shards: dict[str, set[str]] = {}
+    for uid in selected:
+        shards.setdefault(key(uid), set()).add(uid)
+    return shards
+
+
+def shard_dependencies(shards: dict[str, set[str]], ancestors: dict[str, set[str]]) -> dict[str, set[str]]:
+    """
+    {shard: {shards dont il dépend}}, d'après les ancêtres sélectionnés de ses nœuds ;
+    les shards interdépendants sont fusionnés (shards modifié).
+    """
+    while True:
+        owner = {uid: shard for shard, uids in shards.items() for uid in uids}
+        deps = {shard: {owner[p] for uid in uids for p in ancestors[uid]} - {shard}
+                for shard, uids in shards.items()}
+
+        def reach(start: str) -> set[str]:
+            seen, todo = set(), [start]
+            while todo:
+                for dep in deps[todo.pop()]:
+                    if dep not in seen:
+                        seen.add(dep)
+                        todo.append(dep)
+            return seen
+
+        reachable = {shard: reach(shard) for shard in shards}
+        cycle = next(((a, b) for a in shards for b in reachable[a] if a in reachable[b]), None)
+        if cycle is None:
+            return deps
+        a, b = cycle
+        logging.info("Shards %s et %s interdépendants : fusionnés.", a, b)
+        shards[a] |= shards.pop(b)
+
+
+def plan_shards(selected: list[str], manifest: dict, strategy: str, max_shards: int) -> tuple[dict[str, set[str]], dict[str, set[str]]]:
+    """Retourne ({shard: unique_ids}, {shard: dépendances}) des nœuds construits par dbt."""
+    nodes = [uid for uid in selected if uid in manifest["nodes"]]
+    ancestors = selected_ancestors(nodes, manifest)
+    if strategy == "tags":
+        shards = by_tags(nodes, manifest, ancestors)
+    else:
+        shards = {f"shard-{i + 1}": uids for i, uids in enumerate(pack(components(nodes, manifest, ancestors), max_shards))}
+    return shards, shard_dependencies(shards, ancestors)
+
+
+def selectors(uids: set[str], manifest: dict) -> list[str]:
+    """Sélecteurs dbt exacts (fqn:) des nœuds d'un shard."""
+    return sorted("fqn:" + ".".join(manifest["nodes"][uid]["fqn"]) for uid in uids)
+
+
+################################################# Execution #################################################
+def run_sharded(cmd: list[str], project_dir: str, name: str, strategy: str = "components",
+                max_shards: int = DEFAULT_MAX_SHARDS) -> RunResult | None:
+    """
+    Exécute `cmd` en shards parallèles. Retourne le RunResult fusionné, ou None si la commande
+    doit être lancée telle quelle (sélection non résolue, un seul shard, sous-commande non découpable).
+    """
+    if _subcommand(cmd) not in SHARD_COMMANDS:
+        logging.info("[%s] Sous-commande %s non découpable : invocation unique.", name, _subcommand(cmd))
+        return None
+    _, base = partition_args(cmd, SELECTION_FLAGS | {"--target-path", "--log-path"})
+    root = os.path.join(target_path(cmd, project_dir), "shards")
+    ls_target = os.path.join(root, "ls")
+    selected = list_selection(cmd, project_dir, ls_target, name)
+    manifest = load_manifest(os.path.join(ls_target, "manifest.json")) if selected else None
+    if manifest is None:
+        logging.warning("[%s] Sélection non résolue : invocation unique.", name)
+        return None
+    shards, deps = plan_shards(selected, manifest, strategy, max_shards)
+    if len(shards) < 2:
+        logging.info("[%s] Sélection en un seul shard : invocation unique.", name)
+        return None
+
+    commands = {}
+    for shard, uids in shards.items():
+        shard_target = os.path.join(root, shard)
+        os.makedirs(shard_target, exist_ok=True)
+        # Le parse partiel de dbt ls évite à chaque shard de reparser tout le projet
+        partial = os.path.join(ls_target, "partial_parse.msgpack")
+        if os.path.exists(partial):
+            shutil.copyfile(partial, os.path.join(shard_target, "partial_parse.msgpack"))
+        commands[shard] = base + ["--select", *selectors(uids, manifest), "--target-path", shard_target,
+                                  "--log-path", os.path.join(shard_target, "logs")]
+    logging.info("[%s] %d nœuds en %d shards (%s, %d simultanés) : %s", name, sum(map(len, shards.values())),
+                 len(shards), strategy, max_shards,
+                 ", ".join(f"{shard}={len(uids)}" + (f"←{'+'.join(sorted(deps[shard]))}" if deps[shard] else "")
+                           for shard, uids in shards.items()))
+
+    results = run_shard_dag(commands, deps, project_dir, name, max_shards)
+    return merge_results(name, root, ls_target, shards, results)
+
+
+def run_shard_dag(commands: dict[str, list[str]], deps: dict[str, set[str]], project_dir: str, name: str,
+                  max_shards: int) -> dict[str, RunResult]:
+    """Lance chaque shard dès que ses dépendances ont réussi ; les dépendants d'un shard en échec ne sont pas lancés."""
+    results: dict[str, RunResult] = {}
+    pending = {shard: set(d) for shard, d in deps.items()}
+    with ThreadPoolExecutor(max_workers=max(1, max_shards), thread_name_prefix="drapo-dbt-shard") as pool:
+        running = {}
+
+        def submit_ready():
+            for shard in [s for s, d in pending.items() if not d]:
+                del pending[shard]
+                # L'échéance et la portée d'annulation du job suivent chaque shard
+                future = pool.submit(contextvars.copy_context().run, run_subprocess, commands[shard],
+                                     cwd=project_dir, name=f"{name}:{shard}")
+                running[future] = shard
+
+        def skip_dependents(failed: str):
+            for shard in [s for s, d in pending.items() if failed in d]:
+                del pending[shard]
+                logging.warning("[%s] Shard %s non lancé : le shard %s a échoué.", name, shard, failed)
+                results[shard] = RunResult.not_run(f"{name}:{shard}", commands[shard], termination=interrupted())
+                skip_dependents(shard)
+
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = running.pop(future)
+                results[shard] = future.result()
+                if results[shard].ok:
+                    for d in pending.values():
+                        d.discard(shard)
+                else:
+                    skip_dependents(shard)
+            submit_ready()
+    return results
+
+
+def merge_results(name: str, root: str, ls_target: str, shards: dict[str, set[str]],
+                  results: dict[str, RunResult]) -> RunResult:
+    """Fusionne les run_results.json des shards et agrège leurs RunResult en un seul résultat de job."""
+    merged: dict = {"results": []}
+    report = []
+    for shard in shards:
+        result = results[shard]
+        run_results = _read_json(os.path.join(root, shard, "run_results.json")) if result.pid is not None else None
+        statuses: dict[str, int] = {}
+        for node in (run_results or {}).get("results", []):
+            statuses[node.get("status")] = statuses.get(node.get("status"), 0) + 1
+        if run_results:
+            merged.setdefault("metadata", run_results.get("metadata"))
+            merged.setdefault("args", run_results.get("args"))
+            merged["results"].extend(run_results.get("results", []))
+        state = "success" if result.ok else ("skipped" if result.pid is None and not result.termination else
+                                             result.termination or "failed")
+        report.append({"shard": shard, "nodes": len(shards[shard]), "status": state,
+                       "duration": result.duration, "returncode": result.returncode, "results": statuses})
+        logging.info("[%s] Shard %-12s %-9s %4d nœuds %8.1fs  %s", name, shard, state, len(shards[shard]),
+                     result.duration, " ".join(f"{k}={v}" for k, v in sorted(statuses.items(), key=str)) or "-")
+
+    # Les shards lancés d'abord : le code retour fusionné est celui du premier shard en échec
+    ordered = sorted(results.values(), key=lambda r: r.pid is None)
+    result = combine_results(name, ordered)
+    merged["elapsed_time"] = result.duration
+    path = os.path.join(root, "run_results.json")
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(merged, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.warning("[%s] run_results fusionné non écrit (%s) : %s", name, path, e)
+    result.extra.update(shards=report, run_results=path, target_path=ls_target)
+    return result
+
+
+def _read_json(path: str) -> dict | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# dbt_state.py
+"""
+Sélection incrémentale dbt basée sur l'état du dernier succès.
+
+    Pour un job dbt avec `state_aware = true`, Drapo conserve le target/manifest.json du dernier run
+    réussi dans <drapostate>/dbt_state/<job>/. Les runs suivants ne construisent que les modèles modifiés
+    depuis (et leurs descendants) : --select state:modified+ --defer --state <dir>.
+    Si l'état est absent ou corrompu, la commande complète du TOML est exécutée.
+"""
+
+import os
+import json
+import shutil
+import logging
+
+from drapo.utils import resolve_path
+
+
+# Sous-commandes dbt qui acceptent --select/--state/--defer
+STATE_COMMANDS = {"build", "run", "test", "seed", "snapshot", "compile", "ls", "list"}
+SELECT_FLAGS = {"-m", "--models", "--model", "-s", "--select"}
+STATE_FLAGS = {"--state", "--defer-state"}
+
+
+def state_dir(CONFIG: dict, job_name: str) -> str:
+    return os.path.join(resolve_path("${drapostate}", CONFIG), "dbt_state", job_name)
+
+
+def load_manifest(path: str) -> dict | None:
+    """Charge un manifest.json ; None s'il est absent ou corrompu."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning("Manifest dbt illisible (%s) : %s", path, e)
+        return None
+    if not isinstance(manifest.get("metadata"), dict) or not isinstance(manifest.get("nodes"), dict):
+        logging.warning("Manifest dbt incomplet : %s", path)
+        return None
+    return manifest
+
+
+def _subcommand(cmd: list[str]) -> str | None:
+    for arg in cmd[1:]:
+        if not arg.startswith("-"):
+            return arg
+    return None
+
+
+def split_selection(cmd: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Sépare les sélecteurs (-m/-s/--select …) du reste de la commande.
+    Retourne (commande sans sélection ni --state/--defer, liste des sélecteurs).
+    """
+    rest, selectors = [], []
+    i = 0
+    while i < len(cmd):
+        arg = cmd[i]
+        if arg in SELECT_FLAGS:
+            i += 1
+            while i < len(cmd) and not cmd[i].startswith("-"):
+                selectors.extend(cmd[i].split())
+                i += 1
+            continue
+        if arg in STATE_FLAGS:
+            i += 2
+            continue
+        if arg == "--defer":
+            i += 1
+            continue
+        rest.append(arg)
+        i += 1
+    return rest, selectors
+
+
+def with_state_selection(cmd: list[str], state_path: str) -> list[str]:
+    """
+    Restreint la commande aux modèles modifiés depuis l'état : chaque sélecteur d'origine est
+    intersecté avec state:modified+ (union de sélecteurs ∩ state:modified+).
+    """
+    rest, selectors = split_selection(cmd)
+    if selectors:
+        selection = [f"{sel},state:modified+" for sel in selectors]
+    else:
+        selection = ["state:modified+"]
+    return rest + ["--select", *selection, "--defer", "--state", state_path]
+
+
+def target_path(cmd: list[str], project_dir: str) -> str:
+    """Répertoire target utilisé par la commande (--target-path, DBT_TARGET_PATH ou target/)."""
+    if "--target-path" in cmd:
+        idx = cmd.index("--target-path")
+        if idx + 1 < len(cmd):
+            return os.path.join(project_dir, cmd[idx + 1])
+    return os.path.join(project_dir, os.environ.get("DBT_TARGET_PATH", "target"))
+
+
+def prepare_command(CONFIG: dict, job_name: str, cmd: list[str]) -> list[str]:
+    """
+    Retourne la commande à lancer : sélection state:modified+ si un état valide existe,
+    sinon la commande complète.
+    """
+    if _subcommand(cmd) not in STATE_COMMANDS:
+        logging.info("dbt state : sous-commande %s non concernée, commande complète.", _subcommand(cmd))
+        return cmd
+    directory = state_dir(CONFIG, job_name)
+    if load_manifest(os.path.join(directory, "manifest.json")) is None:
+        logging.info("dbt state : pas d'état valide pour %s, exécution de la commande complète.", job_name)
+        return cmd
+    state_cmd = with_state_selection(cmd, directory)
+    logging.info("dbt state : sélection incrémentale depuis %s", directory)
+    return state_cmd
+
+
+def save_state(CONFIG: dict, job_name: str, cmd: list[str], project_dir: str, source_dir: str | None = None) -> bool:
+    """
+    Après un succès, conserve le manifest.json produit comme nouvel état de référence
+    (celui de `source_dir` s'il est donné, sinon celui du target de la commande).
+    """
+    source = os.path.join(source_dir or target_path(cmd, project_dir), "manifest.json")
+    if load_manifest(source) is None:
+        logging.warning("dbt state : pas de manifest exploitable dans %s, état non mis à jour.", source)
+        return False
+    directory = state_dir(CONFIG, job_name)
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, "manifest.json.tmp")
+    shutil.copyfile(source, tmp)
+    os.replace(tmp, os.path.join(directory, "manifest.json"))
+    logging.info("dbt state : état mis à jour (%s)", directory)
+    return True
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# distributed.py
+"""
+Exécution distribuée : le scheduler (coordinateur) dépose les jobs prêts dans une file SQLite,
+des process `drapo-worker` (voir drapo.worker) les prennent, les exécutent avec les runners
+habituels et y écrivent leur résultat.
+
+    Réglé par la section `distributed` de config.yml :
+
+        distributed:
+          enabled: true
+          queue: "${drapostate}/queue.sqlite"   # fichier partagé par le coordinateur et les workers
+          journal_mode: WAL      # DELETE si le fichier est sur un stockage réseau (NFS, SMB)
+          heartbeat_s: 5         # un worker signale chaque job en cours à cette période
+          lease_s: 30            # un job sans signal depuis lease_s est remis en file (worker mort)
+          max_attempts: 3        # au-delà, le job est en échec
+          poll_s: 0.5            # période de scrutation de la file
+
+    Côté coordinateur, rien ne change pour les flows : run_job garde le cache, les pools de
+    ressources, les timeouts, l'historique et les métriques ; seule l'exécution du job est
+    déléguée (les jobs `connection` restent locaux). Un timeout ou une annulation côté
+    coordinateur est transmis au worker, qui arrête le groupe de process du job.
+    N'importe quel participant remet en file les jobs dont le worker ne signale plus rien.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from dataclasses import asdict
+from contextlib import contextmanager
+
+from drapo.common import RunResult, interrupted, remaining_time
+from drapo.utils import resolve_path
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id       TEXT,
+    flow         TEXT,
+    job          TEXT NOT NULL,
+    payload      TEXT NOT NULL,
+    priority     INTEGER NOT NULL DEFAULT 0,
+    state        TEXT NOT NULL DEFAULT 'queued',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    worker       TEXT,
+    cancel       INTEGER NOT NULL DEFAULT 0,   -- 0, ou statut demandé par le coordinateur (cancelled, timed_out)
+    enqueued_at  REAL NOT NULL,
+    started_at   REAL,
+    heartbeat_at REAL,
+    ended_at     REAL,
+    status       TEXT,
+    result       TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id);
+CREATE TABLE IF NOT EXISTS workers (
+    name         TEXT PRIMARY KEY,
+    host         TEXT,
+    pid          INTEGER,
+    started_at   REAL,
+    heartbeat_at REAL,
+    running      INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+DEFAULTS = {
+    "queue": "${drapostate}/queue.sqlite",
+    "journal_mode": "WAL",
+    "heartbeat_s": 5.0,
+    "lease_s": 30.0,
+    "max_attempts": 3,
+    "poll_s": 0.5,
+}
+# Options de la ligne de commande transmises au worker avec le job
+FORWARDED_ARGS = ("dry_run", "python_args", "dbt_args")
+
+
+class JobQueue:
+    """File de jobs partagée, dans une base SQLite (une connexion par thread)."""
+
+    def __init__(self, db_path: str, settings: dict | None = None):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.settings = {**DEFAULTS, **(settings or {})}
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute(f"PRAGMA journal_mode={self.settings['journal_mode']}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE : un seul écrivain à la fois entre tous les process."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # ---- coordinateur ----
+    def enqueue(self, job: dict, run_id: str | None = None, flow: str | None = None, args: dict | None = None,
+                deadline_at: float | None = None) -> int:
+        payload = json.dumps({"job": job, "args": args or {}, "deadline_at": deadline_at})
+        cur = self._conn().execute(
+            "INSERT INTO jobs (run_id, flow, job, payload, priority, enqueued_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (run_id, flow, job["name"], payload, int(job.get("priority", 0)), time.time()))
+        return cur.lastrowid
+
+    def poll(self, job_id: int) -> tuple[str, str | None, str | None, str | None]:
+        """(state, worker, status, result) d'un job."""
+        return self._conn().execute("SELECT state, worker, status, result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def cancel(self, job_id: int, status: str):
+        """Retire un job encore en file, ou demande son arrêt au worker qui l'exécute."""
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET state = 'done', status = ?, ended_at = ? WHERE id = ? AND state = 'queued'",
+                         (status, time.time(), job_id))
+            conn.execute("UPDATE jobs SET cancel = ? WHERE id = ? AND state = 'running'", (status, job_id))
+
+    def requeue_expired(self) -> int:
+        """
+        Remet en file les jobs dont le worker ne signale plus rien ; échec au-delà de max_attempts.
+        Un job dont le coordinateur a demandé l'arrêt n'est pas relancé : il est clos avec le statut demandé.
+        """
+        now = time.time()
+        limit = now - float(self.settings["lease_s"])
+        with self._transaction() as conn:
+            lost = conn.execute("SELECT id, job, worker, attempts, cancel FROM jobs WHERE state = 'running' AND heartbeat_at < ?",
+                                (limit,)).fetchall()
+            for job_id, name, worker, attempts, cancel in lost:
+                if cancel:
+                    logging.warning("Job %s : worker %s perdu après la demande d'arrêt, job clos (%s).", name, worker, cancel)
+                    conn.execute("UPDATE jobs SET state = 'done', status = ?, ended_at = ? WHERE id = ?", (cancel, now, job_id))
+                elif attempts < int(self.settings["max_attempts"]):
+                    logging.warning("Job %s : worker %s muet depuis %gs, remis en file.", name, worker, self.settings["lease_s"])
+                    conn.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE id = ?", (job_id,))
+                else:
+                    logging.error("Job %s : worker %s perdu après %d tentatives, job en échec.", name, worker, attempts)
+                    conn.execute("UPDATE jobs SET state = 'done', status = 'failed', ended_at = ?, result = ? WHERE id = ?",
+                                 (now, json.dumps({"error": f"worker {worker} perdu"}), job_id))
+        return len(lost)
+
+    # ---- worker ----
+    def register(self, worker: str, pid: int):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO workers (name, host, pid, started_at, heartbeat_at, running) VALUES (?, ?, ?, ?, ?, 0)",
+            (worker, socket.gethostname(), pid, time.time(), time.time()))
+
+    def unregister(self, worker: str):
+        self._conn().execute("DELETE FROM workers WHERE name = ?", (worker,))
+
+    def claim(self, worker: str) -> tuple[int, dict] | None:
+        """Prend le job en file le plus prioritaire (le plus ancien à priorité égale)."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT id, payload FROM jobs WHERE state = 'queued' ORDER BY priority DESC, id LIMIT 1").fetchone()
+            if row is not None:
+                now = time.time()
+                conn.execute("UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, started_at = ?,"
+                             " heartbeat_at = ? WHERE id = ?", (worker, now, now, row[0]))
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def heartbeat(self, worker: str, job_ids: list[int]) -> dict[int, str]:
+        """
+        Signale les jobs en cours du worker. Retourne {id: raison} des jobs à arrêter :
+        "cancelled" (demandé par le coordinateur) ou "lost" (job repris par un autre worker).
+        """
+        now = time.time()
+        stop = {}
+        with self._transaction() as conn:
+            conn.execute("UPDATE workers SET heartbeat_at = ?, running = ? WHERE name = ?", (now, len(job_ids), worker))
+            for job_id in job_ids:
+                row = conn.execute("SELECT state, worker, cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is None or row[0] != "running" or row[1] != worker:
+                    stop[job_id] = "lost"
+                    continue
+                conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (now, job_id))
+                if row[2]:
+                    stop[job_id] = "cancelled"
+        return stop
+
+    def complete(self, job_id: int, worker: str, status: str, result: dict | None) -> bool:
+        """Enregistre le résultat ; False si le job n'appartient plus à ce worker (remis en file entre-temps)."""
+        cur = self._conn().execute(
+            "UPDATE jobs SET state = 'done', status = ?, result = ?, ended_at = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (status, json.dumps(result), time.time(), job_id, worker))
+        return cur.rowcount == 1
+
+    def release(self, job_id: int, worker: str):
+        """Rend un job à la file sans compter la tentative (arrêt du worker), sauf si le coordinateur l'a arrêté."""
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET state = 'done', status = cancel, ended_at = ?"
+                         " WHERE id = ? AND worker = ? AND state = 'running' AND cancel != 0", (time.time(), job_id, worker))
+            conn.execute("UPDATE jobs SET state = 'queued', worker = NULL, attempts = attempts - 1"
+                         " WHERE id = ? AND worker = ? AND state = 'running'", (job_id, worker))
+
+
+_QUEUE: JobQueue | None = None
+
+
+def configure_distributed(CONFIG: dict) -> JobQueue | None:
+    """Ouvre la file si la section `distributed` de config.yml l'active (coordinateur et workers)."""
+    global _QUEUE
+    settings = CONFIG.get("distributed", {})
+    if not settings.get("enabled", False):
+        _QUEUE = None
+        return None
+    db_path = resolve_path(settings.get("queue", DEFAULTS["queue"]), CONFIG)
+    _QUEUE = JobQueue(db_path, settings)
+    logging.info("Exécution distribuée : file %s", db_path)
+    return _QUEUE
+
+
+def get_queue() -> JobQueue | None:
+    return _QUEUE
+
+
+def encode_result(result: RunResult | None) -> dict | None:
+    return None if result is None else asdict(result)
+
+
+def decode_result(data: dict | None) -> RunResult | None:
+    return None if data is None else RunResult(**data)
+
+
+def run_remote(queue: JobQueue, job: dict, args: argparse.Namespace | None = None, run_id: str | None = None,
+               flow: str | None = None) -> tuple[bool, RunResult | None]:
+    """
+    Dépose le job dans la file et attend son résultat, comme _run_job l'exécuterait localement.
+    Un timeout ou une annulation est transmis au worker ; le job est alors rapporté interrompu.
+    """
+    remaining = remaining_time()
+    forwarded = {key: getattr(args, key) for key in FORWARDED_ARGS if hasattr(args, key)}
+    job_id = queue.enqueue(job, run_id, flow, forwarded, None if remaining is None else time.time() + remaining)
+    logging.info("Job %s déposé dans la file distribuée (#%d).", job["name"], job_id)
+    poll_s = float(queue.settings["poll_s"])
+    sweep_s = float(queue.settings["heartbeat_s"])
+    next_sweep = time.monotonic() + sweep_s
+    worker = None
+    stop_sent = False
+    while True:
+        state, current, status, data = queue.poll(job_id)
+        if current and current != worker:
+            worker = current
+            logging.info("Job %s pris par le worker %s.", job["name"], worker)
+        if state == "done":
+            break
+        reason = interrupted()
+        if reason and not stop_sent:
+            logging.warning("Job %s : arrêt demandé au worker (%s).", job["name"], reason)
+            queue.cancel(job_id, reason)
+            stop_sent = True
+        if time.monotonic() >= next_sweep:
+            queue.requeue_expired()
+            next_sweep = time.monotonic() + sweep_s
+        time.sleep(poll_s)
+
+    data = json.loads(data) if data else None
+    if data and "error" in data:
+        logging.error("Job %s en erreur : %s", job["name"], data["error"])
+        return False, None
+    result = decode_result(data)
+    if result is None:
+        # Retiré de la file avant d'être pris, ou rien à faire pour le runner
+        if status == "success":
+            return True, None
+        return False, RunResult.not_run(job["name"], termination=status if status in ("timed_out", "cancelled") else None)
+    return result.ok, result
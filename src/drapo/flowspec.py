@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# flowspec.py
+"""
+Définition statique des flows, sans dépendance vers les modules d'exécution.
+
+    Graphe de dépendances d'un flow (build_dag), triggers de planification (make_trigger),
+    politiques overlap et stratégies de sharding dbt acceptées. plan.validate n'importe que
+    ce module : `drapo-run list` ou `validate` sur un plan non compilé ne chargent ni le moteur
+    de sous-process, ni les runners, ni les métriques.
+"""
+
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+
+# Politiques d'un flow encore en cours à son trigger suivant (voir drapo.overlap)
+POLICIES = ("skip", "queue_one", "allow", "cancel_previous")
+# Découpage d'une commande dbt en shards (voir drapo.dbt_shards)
+STRATEGIES = ("components", "tags")
+
+
+################################################# DAG #################################################
+def build_dag(steps: list[str], jobs_map: dict[str, dict]) -> dict[str, set[str]]:
+    """
+    Construit le graphe de dépendances {job: {dépendances}} des jobs d'un flow.
+    Lève ValueError si une dépendance est inconnue du flow ou si le graphe contient un cycle.
+    """
+    dag = {}
+    for name in steps:
+        job = jobs_map.get(name)
+        if not job:
+            raise ValueError(f"Job inconnu dans le flow: {name}")
+        declared = job.get("depends_on", [])
+        if isinstance(declared, str):
+            declared = [declared]
+        unknown = [d for d in declared if d not in steps]
+        if unknown:
+            raise ValueError(f"Le job '{name}' dépend de jobs absents du flow: {', '.join(unknown)}")
+        dag[name] = set(declared)
+
+    # Détection de cycle (tri topologique de Kahn)
+    remaining = {name: set(deps) for name, deps in dag.items()}
+    ready = [name for name, deps in remaining.items() if not deps]
+    seen = 0
+    while ready:
+        current = ready.pop()
+        seen += 1
+        for name, deps in remaining.items():
+            if current in deps:
+                deps.discard(current)
+                if not deps:
+                    ready.append(name)
+    if seen != len(dag):
+        cyclic = sorted(name for name, deps in remaining.items() if deps)
+        raise ValueError(f"Cycle de dépendances dans le flow: {', '.join(cyclic)}")
+    return dag
+
+
+def is_dag_flow(steps: list[str], jobs_map: dict[str, dict]) -> bool:
+    """
+    Un flow est exécuté en DAG dès qu'un de ses jobs déclare `depends_on`.
+    """
+    return any("depends_on" in jobs_map.get(name, {}) for name in steps)
+
+
+################################################# Triggers #################################################
+def _parse_hms(tm: str, fields: int) -> list[int]:
+    """Découpe "HH:MM[:SS]", "MM:SS" / ":MM" ou ":SS" en entiers."""
+    parts = tm.strip().split(":")
+    if parts[0] == "":
+        parts = parts[1:]
+    if not 1 <= len(parts) <= fields or not all(p.isdigit() for p in parts):
+        raise ValueError(f"Horaire invalide: {tm!r}")
+    return [int(p) for p in parts]
+
+
+class Trigger(ABC):
+    """Calcule la prochaine date d'exécution strictement postérieure à `after`."""
+
+    @abstractmethod
+    def next_after(self, after: datetime) -> datetime:
+        ...
+
+
+class DailyAt(Trigger):
+    """Tous les jours à "HH:MM" ou "HH:MM:SS"."""
+
+    def __init__(self, tm: str):
+        values = _parse_hms(tm, 3)
+        if len(values) < 2:
+            raise ValueError(f"daily_at attend HH:MM[:SS]: {tm!r}")
+        self.hour, self.minute = values[0], values[1]
+        self.second = values[2] if len(values) > 2 else 0
+
+    def next_after(self, after: datetime) -> datetime:
+        candidate = after.replace(hour=self.hour, minute=self.minute, second=self.second, microsecond=0)
+        if candidate <= after:
+            candidate += timedelta(days=1)
+        return candidate
+
+
+class HourlyAt(Trigger):
+    """Toutes les heures à "MM:SS" ou ":MM"."""
+
+    def __init__(self, tm: str):
+        values = _parse_hms(tm, 2)
+        self.minute = values[0]
+        self.second = values[1] if len(values) > 1 else 0
+
+    def next_after(self, after: datetime) -> datetime:
+        candidate = after.replace(minute=self.minute, second=self.second, microsecond=0)
+        if candidate <= after:
+            candidate += timedelta(hours=1)
+        return candidate
+
+
+class MinuteAt(Trigger):
+    """Toutes les minutes à ":SS"."""
+
+    def __init__(self, tm: str):
+        values = _parse_hms(tm, 1)
+        self.second = values[0]
+
+    def next_after(self, after: datetime) -> datetime:
+        candidate = after.replace(second=self.second, microsecond=0)
+        if candidate <= after:
+            candidate += timedelta(minutes=1)
+        return candidate
+
+
+class CronTrigger(Trigger):
+    """
+    Expression cron à 5 champs : minute heure jour-du-mois mois jour-de-la-semaine.
+    Chaque champ accepte *, des valeurs, des listes (1,5), des plages (1-5) et des pas (*/15, 0-30/5).
+    Les mois et les jours de la semaine acceptent aussi leur nom anglais abrégé (JAN-DEC, SUN-SAT,
+    sans distinction de casse), y compris dans les plages (MON-FRI).
+    Le dimanche vaut 0 ou 7. Comme cron, si jour-du-mois et jour-de-la-semaine sont tous deux
+    restreints, une date correspondant à l'un OU l'autre est retenue.
+    """
+    BOUNDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    MONTHS = {name: i for i, name in enumerate(
+        ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"], start=1)}
+    WEEKDAYS = {name: i for i, name in enumerate(["SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT"])}
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expression cron invalide (5 champs attendus): {expr!r}")
+        self.expr = expr
+        names = [{}, {}, {}, self.MONTHS, self.WEEKDAYS]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse_field(f, lo, hi, n) for f, (lo, hi), n in zip(fields, self.BOUNDS, names)
+        )
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # Comme cron, un champ commençant par * (y compris */2) ne restreint pas : pas de règle du OU
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+
+    @staticmethod
+    def _parse_field(field: str, lo: int, hi: int, names: dict[str, int]) -> set[int]:
+        def value(token: str) -> int:
+            if token.upper() in names:
+                return names[token.upper()]
+            if not token.isdigit():
+                raise ValueError(f"Champ cron invalide: {field!r} ({token!r} n'est ni un nombre ni un nom connu)")
+            return int(token)
+
+        values = set()
+        for part in field.split(","):
+            rng, _, step = part.partition("/")
+            if step and not step.isdigit():
+                raise ValueError(f"Champ cron invalide: {field!r}")
+            step = int(step) if step else 1
+            if rng == "*":
+                start, end = lo, hi
+            elif "-" in rng:
+                start, end = (value(v) for v in rng.split("-", 1))
+            else:
+                start = value(rng)
+                end = hi if step > 1 else start
+            if not (lo <= start <= end <= hi) or step < 1:
+                raise ValueError(f"Champ cron invalide: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        dom = dt.day in self.days
+        dow = (dt.isoweekday() % 7) in self.weekdays
+        if self.any_day:
+            return dow
+        if self.any_weekday:
+            return dom
+        return dom or dow
+
+    def next_after(self, after: datetime) -> datetime:
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=366 * 5)
+        while dt <= limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f"Aucune date ne correspond à l'expression cron {self.expr!r}")
+
+
+def make_trigger(flow: dict) -> Trigger:
+    """
+    Construit le trigger d'un flow à partir de ses clés `schedule` et `time` (ou `cron`).
+    """
+    sched = flow["schedule"]
+    if sched == "daily_at":
+        return DailyAt(flow["time"])
+    if sched == "hourly_at":
+        return HourlyAt(flow["time"])
+    if sched == "minute_at":
+        return MinuteAt(flow["time"])
+    if sched == "cron":
+        return CronTrigger(flow.get("cron") or flow["time"])
+    raise ValueError(f"Cron type non supporté: {sched}")
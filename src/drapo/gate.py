@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# gate.py
+"""
+Porte de connexion : attend que des hôtes soient joignables avant de laisser passer un flow.
+
+    Un job `connection` peut déclarer plusieurs cibles, testées en parallèle (asyncio) :
+
+        [[jobs]]
+        name = "warehouse_up"
+        type = "connection"
+        targets = ["db1:5432", "db2:5432"]   # ou host/port pour une seule cible
+        backoff_initial_s = 5                # premier délai entre deux tentatives
+        retry_interval_min = 10              # délai max entre deux tentatives (backoff exponentiel + jitter)
+        deadline_min = 60                    # abandon après ce délai (défaut : attente illimitée)
+
+    Les tentatives s'espacent de façon exponentielle (avec jitter) jusqu'au délai max : un serveur qui
+    revient 30 secondes après un échec est détecté en quelques secondes, pas 10 minutes plus tard.
+    La porte tourne sur la boucle asyncio du moteur de sous-process : dans un flow en DAG, elle n'occupe
+    aucun worker et les jobs qui n'en dépendent pas démarrent pendant l'attente.
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+
+from drapo.common import RunResult, cancellable, interrupted, remaining_time
+from drapo.metrics import GATE_WAIT
+
+
+DEFAULT_BACKOFF_INITIAL_S = 5.0
+DEFAULT_BACKOFF_MAX_S = 600.0
+DEFAULT_PROBE_TIMEOUT_S = 5.0
+
+
+def parse_targets(job: dict) -> list[tuple[str, int]]:
+    """Cibles "host:port" du job (clé `targets`, ou `host`/`port`)."""
+    targets = []
+    for target in job.get("targets", []):
+        host, _, port = target.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"Cible de connexion invalide (host:port attendu) : {target!r}")
+        targets.append((host.strip("[]"), int(port)))
+    if "host" in job:
+        # Poste de développement Windows : l'hôte du TOML n'est pas joignable directement
+        host = job["host"] if os.name != "nt" else "10.0.0.45"
+        targets.append((host, int(job["port"])))
+    if not targets:
+        raise ValueError("Job de connexion sans cible (targets ou host/port)")
+    return targets
+
+
+async def probe(host: str, port: int, timeout: float = DEFAULT_PROBE_TIMEOUT_S) -> bool:
+    """Teste une connexion TCP ; True si elle aboutit dans le délai."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        logging.warning("Serveur %s:%d non joignable : %s", host, port, e or type(e).__name__)
+        return False
+    writer.close()
+    return True
+
+
+def backoff_delay(attempt: int, initial: float, maximum: float) -> float:
+    """Délai avant la tentative suivante : exponentiel, plafonné, avec « full jitter » sur la moitié haute."""
+    ceiling = min(maximum, initial * (2 ** attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+async def wait_for_targets(targets: list[tuple[str, int]], name: str = "connection",
+                           initial_s: float = DEFAULT_BACKOFF_INITIAL_S, max_s: float = DEFAULT_BACKOFF_MAX_S,
+                           deadline_s: float | None = None, probe_timeout_s: float = DEFAULT_PROBE_TIMEOUT_S) -> RunResult:
+    """
+    Sonde toutes les cibles en parallèle jusqu'à ce qu'elles soient toutes joignables
+    ou que le délai global soit dépassé. Code retour 0 si toutes sont joignables, 1 sinon.
+    """
+    started = time.time()
+    pending = list(targets)
+    attempt = 0
+    while True:
+        logging.info("[%s] Vérification de %s …", name, ", ".join(f"{h}:{p}" for h, p in pending))
+        reachable = await asyncio.gather(*(probe(h, p, probe_timeout_s) for h, p in pending))
+        pending = [t for t, ok in zip(pending, reachable) if not ok]
+        if not pending:
+            logging.info("[%s] Connexion OK après %.1fs, on poursuit le flow.", name, time.time() - started)
+            return _result(name, targets, 0, started)
+
+        delay = backoff_delay(attempt, initial_s, max_s)
+        if deadline_s is not None:
+            remaining = started + deadline_s - time.time()
+            if remaining <= 0:
+                logging.error("[%s] Délai dépassé (%.0fs) : %s toujours injoignable(s).", name, deadline_s,
+                              ", ".join(f"{h}:{p}" for h, p in pending))
+                return _result(name, targets, 1, started)
+            delay = min(delay, remaining)
+        logging.info("[%s] Nouvelle tentative dans %.1fs.", name, delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def _result(name: str, targets: list[tuple[str, int]], code: int, started: float) -> RunResult:
+    ended = time.time()
+    result = RunResult(name=name, cmd=[f"{h}:{p}" for h, p in targets], returncode=code, started_at=started, ended_at=ended)
+    result.extra["waited_s"] = ended - started
+    return result
+
+
+async def run_gate(job: dict) -> RunResult:
+    """
+    Attend les cibles d'un job `connection` selon ses paramètres de backoff et de délai.
+    Le timeout du job ou du flow borne aussi l'attente ; une annulation l'interrompt immédiatement.
+    """
+    deadlines = [float(job["deadline_min"]) * 60] if job.get("deadline_min") is not None else []
+    remaining = remaining_time()
+    if remaining is not None:
+        deadlines.append(max(0.0, remaining))
+    targets = parse_targets(job)
+    started = time.time()
+    try:
+        with cancellable() as task:
+            if interrupted() == "cancelled":
+                raise asyncio.CancelledError()
+            result = await wait_for_targets(
+                targets,
+                name=job["name"],
+                initial_s=float(job.get("backoff_initial_s", DEFAULT_BACKOFF_INITIAL_S)),
+                max_s=float(job["retry_interval_min"]) * 60 if "retry_interval_min" in job else DEFAULT_BACKOFF_MAX_S,
+                deadline_s=min(deadlines) if deadlines else None,
+                probe_timeout_s=float(job.get("probe_timeout_s", DEFAULT_PROBE_TIMEOUT_S)),
+            )
+    except asyncio.CancelledError:
+        if hasattr(task, "uncancel"):
+            task.uncancel()
+        logging.warning("[%s] Attente de connexion annulée.", job["name"])
+        result = _result(job["name"], targets, 1, started)
+        result.termination = "cancelled"
+        GATE_WAIT.observe(result.extra["waited_s"], job=job["name"], result="cancelled")
+        return result
+    if not result.ok:
+        result.termination = interrupted()
+    GATE_WAIT.observe(result.extra["waited_s"], job=job["name"], result="success" if result.ok else (result.termination or "failed"))
+    return result
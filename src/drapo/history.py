@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# history.py
+"""
+Historique des exécutions de Drapo, stocké dans une base SQLite locale (<drapostate>/runs.sqlite).
+
+    Chaque exécution de flow et de job y est enregistrée (début, fin, code retour, volume de sortie,
+    RSS max, temps CPU, octets lus/écrits et threads du process enfant). Les écritures sont déposées dans une file et insérées par lots par un
+    thread dédié, en mode WAL : enregistrer une exécution ne coûte rien au flow.
+    duration_stats calcule p50/p95 et tendance par job pour la sous-commande `drapo-run stats`.
+"""
+
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import logging
+import threading
+from urllib.request import pathname2url
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flow_runs (
+    run_id      TEXT PRIMARY KEY,
+    flow        TEXT NOT NULL,
+    started_at  REAL NOT NULL,
+    ended_at    REAL,
+    status      TEXT
+);
+CREATE TABLE IF NOT EXISTS job_runs (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id       TEXT,
+    flow         TEXT,
+    job          TEXT NOT NULL,
+    job_type     TEXT,
+    started_at   REAL NOT NULL,
+    ended_at     REAL NOT NULL,
+    duration     REAL NOT NULL,
+    exit_code    INTEGER,
+    status       TEXT,
+    output_bytes INTEGER,
+    peak_rss_kb  INTEGER,
+    cpu_s          REAL,
+    io_read_bytes  INTEGER,
+    io_write_bytes INTEGER,
+    max_threads    INTEGER
+);
+CREATE INDEX IF NOT EXISTS job_runs_job_started ON job_runs (job, started_at);
+"""
+# Colonnes ajoutées après la création du schéma : ajoutées aux bases existantes à l'ouverture
+ADDED_COLUMNS = {
+    "job_runs": [("cpu_s", "REAL"), ("io_read_bytes", "INTEGER"), ("io_write_bytes", "INTEGER"), ("max_threads", "INTEGER")],
+}
+
+BATCH_SIZE = 200
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, kind in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+    return conn
+
+
+class RunStore:
+    """
+    Base d'historique des exécutions. Les méthodes record_* ne font que mettre en file ;
+    un thread écrivain insère par lots, chaque lot dans une seule transaction.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self._queue: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="drapo-history", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    # ---- write path ----
+    def record_flow_start(self, run_id: str, flow: str, started_at: float):
+        self._queue.put(("INSERT OR REPLACE INTO flow_runs (run_id, flow, started_at) VALUES (?, ?, ?)",
+                         (run_id, flow, started_at)))
+
+    def record_flow_end(self, run_id: str, ended_at: float, status: str):
+        self._queue.put(("UPDATE flow_runs SET ended_at = ?, status = ? WHERE run_id = ?",
+                         (ended_at, status, run_id)))
+
+    def record_job(self, run_id: str | None, flow: str | None, job: str, job_type: str, started_at: float,
+                   ended_at: float, exit_code: int | None, status: str, output_bytes: int = 0,
+                   peak_rss_kb: int | None = None, cpu_s: float | None = None, io_read_bytes: int | None = None,
+                   io_write_bytes: int | None = None, max_threads: int | None = None):
+        self._queue.put((
+            "INSERT INTO job_runs (run_id, flow, job, job_type, started_at, ended_at, duration, exit_code,"
+            " status, output_bytes, peak_rss_kb, cpu_s, io_read_bytes, io_write_bytes, max_threads)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run_id, flow, job, job_type, started_at, ended_at, ended_at - started_at, exit_code, status,
+             output_bytes, peak_rss_kb, cpu_s, io_read_bytes, io_write_bytes, max_threads)))
+
+    def flush(self):
+        """Attend que toutes les écritures en file soient en base."""
+        self._queue.join()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def _write_loop(self):
+        conn = connect(self.db_path)
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            statements = [item for item in batch if item is not None]
+            stopping = len(statements) != len(batch)
+            try:
+                with conn:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+            except sqlite3.Error as e:
+                logging.error("Historique : échec d'écriture de %d lignes : %s", len(statements), e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        conn.close()
+
+    # ---- read path ----
+    def job_durations(self, since: float, job: str | None = None, flow: str | None = None) -> dict[str, list[tuple[float, float]]]:
+        """Retourne {job: [(started_at, duration), ...]} des exécutions réussies depuis `since`."""
+        conn = connect(self.db_path)
+        try:
+            return query_job_durations(conn, since, job, flow)
+        finally:
+            conn.close()
+
+
+_STORES: dict[str, RunStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def history_path(CONFIG: dict) -> str | None:
+    """Chemin de la base d'historique, ou None si `drapostate` n'est pas configuré."""
+    from drapo.utils import resolve_path
+    try:
+        return os.path.join(resolve_path("${drapostate}", CONFIG), "runs.sqlite")
+    except ValueError:
+        return None
+
+
+def get_store(CONFIG: dict) -> RunStore | None:
+    """
+    Retourne la base d'historique du projet (une par process), ou None si `drapostate` n'est pas configuré.
+    """
+    db_path = history_path(CONFIG)
+    if db_path is None:
+        return None
+    with _STORES_LOCK:
+        if db_path not in _STORES:
+            _STORES[db_path] = RunStore(db_path)
+        return _STORES[db_path]
+
+
+def read_job_durations(CONFIG: dict, since: float, job: str | None = None,
+                       flow: str | None = None) -> dict[str, list[tuple[float, float]]]:
+    """
+    job_durations sans effet de bord (prévisualisation) : base ouverte en lecture seule, ni création
+    ni thread écrivain ; {} si la base n'existe pas encore ou n'est pas lisible.
+    """
+    db_path = history_path(CONFIG)
+    if db_path is None or not os.path.exists(db_path):
+        return {}
+    try:
+        conn = sqlite3.connect(f"file:{pathname2url(db_path)}?mode=ro", uri=True, timeout=30)
+        try:
+            return query_job_durations(conn, since, job, flow)
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+
+
+def query_job_durations(conn: sqlite3.Connection, since: float, job: str | None = None,
+                        flow: str | None = None) -> dict[str, list[tuple[float, float]]]:
+    sql = "SELECT job, started_at, duration FROM job_runs WHERE started_at >= ? AND status = 'success'"
+    params: list = [since]
+    if job:
+        sql += " AND job = ?"
+        params.append(job)
+    if flow:
+        sql += " AND flow = ?"
+        params.append(flow)
+    sql += " ORDER BY started_at"
+    durations: dict[str, list[tuple[float, float]]] = {}
+    for name, started_at, duration in conn.execute(sql, params).fetchall():
+        durations.setdefault(name, []).append((started_at, duration))
+    return durations
+
+
+################################################# Statistics #################################################
+def percentile(values: list[float], pct: float) -> float:
+    """Percentile par interpolation linéaire (values non vide)."""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def duration_stats(durations: dict[str, list[tuple[float, float]]], now: float | None = None,
+                   trend_days: int = 7) -> list[dict]:
+    """
+    Calcule par job : nombre d'exécutions, p50, p95, dernière durée et tendance
+    (p50 des `trend_days` derniers jours comparé au p50 des `trend_days` jours précédents).
+    """
+    now = now or time.time()
+    recent_since = now - trend_days * 86400
+    previous_since = now - 2 * trend_days * 86400
+    stats = []
+    for job, runs in sorted(durations.items()):
+        values = [d for _, d in runs]
+        recent = [d for ts, d in runs if ts >= recent_since]
+        previous = [d for ts, d in runs if previous_since <= ts < recent_since]
+        trend = None
+        if recent and previous:
+            before = percentile(previous, 50)
+            trend = (percentile(recent, 50) - before) / before * 100 if before else None
+        stats.append({
+            "job": job,
+            "runs": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "last": values[-1],
+            "trend_pct": trend,
+        })
+    return stats
+
+
+def format_stats(stats: list[dict]) -> str:
+    header = f"{'job':<32} {'runs':>5} {'p50 (s)':>9} {'p95 (s)':>9} {'last (s)':>9} {'trend':>8}"
+    lines = [header, "-" * len(header)]
+    for row in stats:
+        trend = f"{row['trend_pct']:+.0f}%" if row["trend_pct"] is not None else "-"
+        lines.append(f"{row['job']:<32} {row['runs']:>5} {row['p50']:>9.1f} {row['p95']:>9.1f} "
+                     f"{row['last']:>9.1f} {trend:>8}")
+    return "\n".join(lines)
+
+
+def print_stats(CONFIG: dict, args) -> int:
+    """Affiche les statistiques de durée par job (sous-commande `stats`)."""
+    store = get_store(CONFIG)
+    if store is None:
+        print("Run history disabled: no 'drapostate' path in config.yml")
+        return 1
+    durations = store.job_durations(time.time() - args.days * 86400, job=args.job, flow=args.flow)
+    if not durations:
+        print(f"No successful run recorded in the last {args.days} days.")
+        return 0
+    print(format_stats(duration_stats(durations, trend_days=args.trend_days)))
+    return 0
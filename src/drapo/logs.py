@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# logs.py
+"""
+Pipeline de logs non bloquant de Drapo.
+
+    Le logger racine n'a qu'un QueueHandler : les threads des jobs et la boucle asyncio des
+    process enfants ne font que déposer leurs records dans une file. Un BatchingQueueListener
+    les dépile par lots et les écrit sur la console, dans le fichier principal (rotation quotidienne,
+    gzip optionnel) et dans le fichier de log propre à chaque exécution de job.
+    Quand la file est pleine, une ligne de sortie d'un process enfant attend une place au plus
+    `backpressure_s` (le job est freiné au rythme du listener), puis est écrite directement dans le
+    fichier du job : seule sa copie console / fichier principal est perdue (et comptée). Un listener
+    bloqué ne peut donc ni figer l'orchestrateur ni faire perdre la sortie d'un job en échec.
+"""
+
+import os
+import gzip
+import atexit
+import queue
+import shutil
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from drapo.metrics import LOG_DROPPED
+
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BACKPRESSURE_S = 0.05
+
+# Clé du fichier de log du job en cours, propagée aux tâches asyncio qui streament ses process enfants
+current_job_log = contextvars.ContextVar("current_job_log", default=None)
+
+
+################################################# Compression #################################################
+def gzip_file(source: str, dest: str | None = None):
+    """Compresse `source` en `dest` (par défaut source + .gz) puis supprime `source`."""
+    dest = dest or source + ".gz"
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+
+################################################# Handlers #################################################
+def _write_no_flush(handler: logging.StreamHandler, record: logging.LogRecord):
+    # Comme StreamHandler.emit, sans le flush par record : le listener flushe une fois par lot.
+    if handler.stream is None:
+        handler.stream = handler._open()
+    handler.stream.write(handler.format(record) + handler.terminator)
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """StreamHandler qui ne flushe pas à chaque record."""
+
+    def emit(self, record):
+        try:
+            _write_no_flush(self, record)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class BatchTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """TimedRotatingFileHandler qui ne flushe pas à chaque record, avec compression gzip optionnelle."""
+
+    def __init__(self, *args, compress: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        if compress:
+            self.namer = _gzip_namer
+            self.rotator = gzip_file
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            _write_no_flush(self, record)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class JobLogRouter(logging.Handler):
+    """
+    Écrit chaque record dans le fichier de l'exécution de job à laquelle il appartient (attribut `job_log`).
+    Les fichiers sont ouverts par le thread du job et fermés par le listener, dans l'ordre de la file.
+    """
+
+    def __init__(self, compress: bool = False):
+        super().__init__()
+        self.compress = compress
+        self._files = {}
+        self._files_lock = threading.Lock()
+        self._compressions: list[threading.Thread] = []
+
+    def open(self, key: str, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._files_lock:
+            self._files[key] = (path, open(path, "a", encoding="utf-8"))
+
+    def emit(self, record):
+        key = getattr(record, "job_log", None)
+        if key is None:
+            return
+        closing = getattr(record, "job_log_close", False)
+        # Le verrou couvre l'écriture : les lignes déversées hors file (spill) arrivent d'autres threads
+        with self._files_lock:
+            entry = self._files.pop(key, None) if closing else self._files.get(key)
+            if entry is None:
+                return
+            path, stream = entry
+            try:
+                if not closing:
+                    stream.write(self.format(record) + "\n")
+                    return
+                stream.close()
+            except Exception:
+                self.handleError(record)
+                return
+        if self.compress:
+            worker = threading.Thread(target=gzip_file, args=(path,), name="drapo-gzip")
+            self._compressions = [t for t in self._compressions if t.is_alive()] + [worker]
+            worker.start()
+
+    def spill(self, record) -> bool:
+        """Écrit directement dans le fichier du job un record que la file n'a pas pu prendre ; False sans fichier ouvert."""
+        with self._files_lock:
+            if getattr(record, "job_log", None) not in self._files:
+                return False
+        self.handle(record)
+        return True
+
+    def flush(self):
+        with self._files_lock:
+            streams = [stream for _, stream in self._files.values()]
+        for stream in streams:
+            try:
+                stream.flush()
+            except ValueError:
+                pass  # fermé entre-temps
+
+    def wait_compressions(self):
+        for worker in list(self._compressions):
+            worker.join()
+
+
+class DrapoQueueHandler(QueueHandler):
+    """
+    QueueHandler attaché au logger racine.
+    Les lignes de sortie des process enfants (attribut `job`) attendent une place au plus
+    `backpressure_s`, puis sont écrites directement dans le fichier du job (router) ; leur copie
+    console est comptée comme perdue. Les autres messages attendent de la place.
+    """
+
+    def __init__(self, q, router: "JobLogRouter | None" = None, backpressure_s: float = DEFAULT_BACKPRESSURE_S):
+        super().__init__(q)
+        self.router = router
+        self.backpressure_s = backpressure_s
+        self.dropped = Counter()
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        if not hasattr(record, "job_log"):
+            record.job_log = current_job_log.get()
+        return record
+
+    def enqueue(self, record):
+        if getattr(record, "job", None) is not None:
+            try:
+                self.queue.put(record, timeout=self.backpressure_s)
+            except queue.Full:
+                # Le fichier du job garde la ligne, seule la copie console est perdue.
+                # Compté par exécution de job : les process d'un job (ex. shards dbt "job:shard") s'y additionnent
+                if self.router is not None:
+                    self.router.spill(record)
+                self.dropped[getattr(record, "job_log", None) or record.job] += 1
+                LOG_DROPPED.inc(job=record.job)
+        else:
+            self.queue.put(record)
+
+
+class BatchingQueueListener(QueueListener):
+    """QueueListener qui dépile jusqu'à `batch_size` records à la fois et ne flushe qu'une fois par lot."""
+
+    def __init__(self, q, *handlers, batch_size: int = DEFAULT_BATCH_SIZE):
+        super().__init__(q, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def enqueue_sentinel(self):
+        # La file est bornée : on attend une place plutôt que de perdre le signal d'arrêt
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        # Les demandes de fermeture d'un log de job ne concernent que le routeur
+        if getattr(record, "job_log_close", False):
+            for handler in self.handlers:
+                if isinstance(handler, JobLogRouter):
+                    handler.handle(record)
+            return
+        super().handle(record)
+
+    def _monitor(self):
+        q = self.queue
+        stopping = False
+        while not stopping:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is self._sentinel:
+                    stopping = True
+                else:
+                    self.handle(record)
+                q.task_done()
+            for handler in self.handlers:
+                handler.flush()
+
+
+################################################# Pipeline #################################################
+class LogPipeline:
+    def __init__(self, queue_handler: DrapoQueueHandler, listener: BatchingQueueListener,
+                 router: JobLogRouter | None, log_dir: str):
+        self.queue_handler = queue_handler
+        self.listener = listener
+        self.router = router
+        self.log_dir = log_dir
+
+    def stop(self):
+        self.listener.stop()
+        if self.router is not None:
+            self.router.wait_compressions()
+
+
+_PIPELINE: LogPipeline | None = None
+
+
+def setup_pipeline(handlers: list[logging.Handler], log_dir: str, settings: dict) -> LogPipeline:
+    """
+    Installe la file de logs sur le logger racine et démarre le listener qui alimente `handlers`.
+    settings (section `logging` de config.yml) : batch_size, queue_size, backpressure_s, job_logs, compress.
+    """
+    global _PIPELINE
+    q = queue.Queue(maxsize=settings.get("queue_size", DEFAULT_QUEUE_SIZE))
+    router = JobLogRouter(compress=settings.get("compress", False)) if settings.get("job_logs", True) else None
+    if router is not None:
+        router.setFormatter(handlers[0].formatter)
+        handlers = handlers + [router]
+    listener = BatchingQueueListener(q, *handlers, batch_size=settings.get("batch_size", DEFAULT_BATCH_SIZE))
+    queue_handler = DrapoQueueHandler(q, router, settings.get("backpressure_s", DEFAULT_BACKPRESSURE_S))
+
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+
+    if _PIPELINE is not None:
+        _PIPELINE.stop()
+    listener.start()
+    if _PIPELINE is None:
+        atexit.register(stop_pipeline)
+    _PIPELINE = LogPipeline(queue_handler, listener, router, log_dir)
+    return _PIPELINE
+
+
+def stop_pipeline():
+    """Vide la file et arrête le listener (à appeler avant de quitter)."""
+    global _PIPELINE
+    if _PIPELINE is not None:
+        _PIPELINE.stop()
+        _PIPELINE = None
+
+
+@contextmanager
+def job_log(job_name: str):
+    """
+    Ouvre le fichier de log de cette exécution du job (<drapolog>/jobs/<job>/<horodatage>.log) :
+    tous les messages émis depuis le thread du job, et les lignes de ses process enfants, y sont copiés.
+    Retourne le chemin du fichier, ou None si les logs par job sont désactivés.
+    """
+    pipeline = _PIPELINE
+    if pipeline is None or pipeline.router is None:
+        yield None
+        return
+
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    path = os.path.join(pipeline.log_dir, "jobs", job_name, f"{stamp}.log")
+    key = f"{job_name}:{stamp}:{threading.get_ident()}"
+    pipeline.router.open(key, path)
+    token = current_job_log.set(key)
+    try:
+        yield path
+    finally:
+        current_job_log.reset(token)
+        dropped = pipeline.queue_handler.dropped.pop(key, 0)
+        if dropped:
+            logging.warning("%d lignes de sortie du job %s absentes du log principal (file de logs pleine) ; "
+                            "elles sont dans %s.", dropped, job_name, path)
+        close = logging.LogRecord("drapo", logging.DEBUG, __file__, 0, "close job log", None, None)
+        close.job_log = key
+        close.job_log_close = True
+        pipeline.queue_handler.queue.put(close)
@@ -1,12 +1,9 @@
 import os
-import argparse
 import logging
 import sys
-import time
-import schedule
-from drapo.utils import *
-from drapo.orchestrer import run_flow
-from drapo.scheduler import schedule_jobs
+from drapo.utils import parse_args, load_config_cached, setup_logger
+# The orchestration modules are imported in run_orchestrator: the light subcommands
+# (drapo.cli) only import what they use.
 
 
 
@@ -16,20 +13,50 @@ def main():
     # 1. Parse command-line arguments
     args = parse_args()
 
-    # 2. Log startup
-    logging.info("---> Starting orchestrator (enforce=%s)...", args.enforce)
-    logging.info(f"Python interpreter in use: {sys.executable}")
-
     THIS_DIR = os.path.abspath(
         os.path.join(os.path.dirname(__file__), "..", "..")
     )
     CONFIG_PATH = os.path.join(THIS_DIR, "config.yml")
 
-    print(f"Using config path: {CONFIG_PATH}")
+    # Parsed config.yml is cached on disk until the file changes
+    CONFIG = load_config_cached(CONFIG_PATH)
+
+    # Sous-commandes de consultation : pas de logger fichier ni de scheduler
+    if args.command == "stats":
+        from drapo.history import print_stats
+        sys.exit(print_stats(CONFIG, args))
+    if args.command is not None:
+        from drapo.cli import COMMANDS
+        sys.exit(COMMANDS[args.command](CONFIG, args))
+    # --dry-run previews every flow of the environment: no process is started
+    if args.dry_run:
+        from drapo.cli import cmd_plan
+        sys.exit(cmd_plan(CONFIG, args))
 
-    CONFIG = load_config(CONFIG_PATH)
+    print(f"Using config path: {CONFIG_PATH}")
+    run_orchestrator(CONFIG, args)
+
+
+def run_orchestrator(CONFIG: dict, args):
+    """Scheduler loop, or every flow at once with --enforce."""
+    import signal
+    import threading
+    from drapo.common import cancel_requested, request_cancel
+    from drapo.orchestrer import run_flow, timeout_seconds
+    from drapo.resources import configure_resources
+    from drapo.overlap import guard_for_flow
+    from drapo.sampler import configure_sampler
+    from drapo.metrics import start_metrics
+    from drapo.plan import PlanError, load_plan, watch_plan
+    from drapo.distributed import configure_distributed
+    from drapo.scheduler import SchedulerEngine, schedule_jobs
 
     logger = setup_logger(CONFIG)
+    logging.info("---> Starting orchestrator (enforce=%s)...", args.enforce)
+    logging.info(f"Python interpreter in use: {sys.executable}")
+    configure_sampler(CONFIG["sampling"])
+    # Coordinator mode: jobs are pushed to the queue and run by drapo-worker processes
+    configure_distributed(CONFIG)
 
     # Accès aux fichiers de flows
     FLOWS = CONFIG["flows"]
@@ -39,42 +66,83 @@ def main():
 
     logging.info("Loading configuration %s", config_file)
     try:
-        flowconfig = load_orchestration_config(fn=config_file)
+        plan = load_plan(CONFIG, fn=config_file)
     except FileNotFoundError:
         logging.error("Config file %s not found.", config_file)
         sys.exit(1)
-    logging.info("Configuration loaded successfully.")
+    except PlanError as e:
+        logging.error("Invalid configuration: %s", e)
+        sys.exit(1)
+    logging.info("Configuration loaded successfully (%d jobs, %d flows).", len(plan.jobs), len(plan.flows))
 
-    # 4. Build jobs_map
-    jobs_map = { job["name"]: job for job in flowconfig.get("jobs", []) }
+    # Pools de ressources partagés par tous les flows ([resources] du TOML)
+    configure_resources(plan.config)
+
+    # 4. Jobs map, compiled with the plan
+    jobs_map = plan.jobs
 
     # 5. If enforce, immediately run each flow and exit
     if args.enforce:
         logging.info("Enforce mode: running flows immediately (no scheduling).")
+        # Pas d'endpoint HTTP pour un run ponctuel : le fichier texte est écrit à la sortie
+        start_metrics(CONFIG, serve_http=False)
+        # SIGTERM / Ctrl-C : arrête les process des jobs en cours (hors du handler, qui ne doit pas bloquer)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: threading.Thread(target=request_cancel, daemon=True).start())
         # find all 'flow' jobs
-        for flow in (j for j in jobs_map.values() if j["type"] == "flow"):
+        for flow in plan.flows:
+            if cancel_requested():
+                break
             logging.info("→ Enforce-running flow '%s'", flow["name"])
             try:
-                run_flow(CONFIG, python_distrib=sys.executable, steps=flow["steps"], jobs_map=jobs_map)
+                # Verrou fichier éventuel : pas de run simultané avec le scheduler d'un autre process
+                guard_for_flow(CONFIG, flow).run(lambda: run_flow(
+                    CONFIG, python_distrib=sys.executable, steps=flow["steps"], jobs_map=jobs_map,
+                    args=args, max_parallel=flow.get("max_parallel"), flow_name=flow["name"],
+                    timeout_s=timeout_seconds(flow)))
             except Exception as e:
                 logging.error("Error in flow %s: %s", flow["name"], e)
+        if cancel_requested():
+            logging.warning("Enforce mode interrupted: remaining flows cancelled.")
+            sys.exit(130)
         logging.info("All flows executed in enforce mode. Exiting.")
         sys.exit(0)
 
     # 6. Otherwise schedule normally
+    engine = SchedulerEngine()
     try:
-        schedule_jobs(flowconfig)
+        schedule_jobs(CONFIG, plan, engine, python_distrib=sys.executable, args=args)
     except Exception as e:
         logging.error("Error scheduling jobs: %s", e)
         sys.exit(1)
 
+    # SIGHUP or file change: recompile the plan and replace the schedule.
+    # Running flows keep the plan they started with; an invalid file keeps the current plan.
+    current = {"plan": plan}
+
+    def reload(engine: SchedulerEngine):
+        try:
+            new_plan = load_plan(CONFIG, fn=config_file)
+        except (OSError, PlanError) as e:
+            logging.error("Reload refused, keeping the current plan: %s", e)
+            return
+        if new_plan.sha256 == current["plan"].sha256:
+            logging.info("Configuration unchanged, schedule kept.")
+            return
+        configure_resources(new_plan.config)
+        engine.clear()
+        schedule_jobs(CONFIG, new_plan, engine, python_distrib=sys.executable, args=args)
+        current["plan"] = new_plan
+        logging.info("Configuration reloaded (%d jobs, %d flows).", len(new_plan.jobs), len(new_plan.flows))
+
+    engine.install_signal_handlers(on_reload=reload)
+    watch_plan(CONFIG, config_file, engine.request_reload)
+    metrics = start_metrics(CONFIG)
     logging.info("Job scheduling complete. Waiting for executions...")
-    try:
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
-    except KeyboardInterrupt:
-        logging.info("Scheduler interrupted manually.")
+    engine.run_forever()
+    if metrics is not None:
+        metrics.stop()
+    logging.info("Scheduler interrupted manually.")
 
 
 if __name__ == "__main__":
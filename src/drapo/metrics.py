@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# metrics.py
+"""
+Métriques Drapo au format Prometheus : fichier texte pour node-exporter et/ou endpoint HTTP /metrics.
+
+    Réglé par la section `metrics` de config.yml :
+
+        metrics:
+          textfile: "/var/lib/node_exporter/textfile_collector/drapo.prom"  # réécrit toutes les interval_s
+          interval_s: 15
+          http_port: 9464          # sert http://<http_host>:9464/metrics depuis le scheduler (0 = désactivé)
+          http_host: "127.0.0.1"
+
+    Les compteurs et histogrammes sont incrémentés sans verrou : chaque thread écrit dans son propre
+    shard (threading.local) et seule la collecte (scrape ou écriture du fichier) parcourt les shards.
+    Les shards des threads terminés sont fusionnés dans un shard de base à la collecte suivante.
+    L'endpoint répond en OpenMetrics si le client le demande (Accept), sinon au format texte 0.0.4.
+"""
+
+import os
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DURATION_BUCKETS = (0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+DEFAULT_INTERVAL_S = 15.0
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+################################################# Shards #################################################
+class _Shard:
+    """Valeurs écrites par un thread : {(métrique, labels): valeur} et {(métrique, labels): [buckets..., +Inf, somme]}."""
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters: dict = {}
+        self.histograms: dict = {}
+
+    def merge(self, other: "_Shard"):
+        # list(dict.items()) copie le dict d'un bloc sous le GIL : sûr pendant que son thread écrit
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0.0) + value
+        for key, entry in list(other.histograms.items()):
+            mine = self.histograms.get(key)
+            if mine is None:
+                self.histograms[key] = list(entry)
+            else:
+                for i, value in enumerate(entry):
+                    mine[i] += value
+
+
+_local = threading.local()
+_SHARDS: list[tuple[threading.Thread, _Shard]] = []
+_BASE = _Shard()
+_LOCK = threading.Lock()
+_METRICS: list["_Metric"] = []
+_GAUGES: list[tuple[str, str, object]] = []
+
+
+def _shard() -> _Shard:
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = _Shard()
+        with _LOCK:
+            _SHARDS.append((threading.current_thread(), shard))
+        return shard
+
+
+def _collect() -> _Shard:
+    merged = _Shard()
+    with _LOCK:
+        alive = []
+        for thread, shard in _SHARDS:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _BASE.merge(shard)
+        _SHARDS[:] = alive
+        merged.merge(_BASE)
+        for _, shard in alive:
+            merged.merge(shard)
+    return merged
+
+
+################################################# Metrics #################################################
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labels
+        _METRICS.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return (self.name, tuple(str(labels.get(label, "")) for label in self.labelnames))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1.0, **labels):
+        counters = _shard().counters
+        key = self._key(labels)
+        counters[key] = counters.get(key, 0.0) + value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        histograms = _shard().histograms
+        key = self._key(labels)
+        entry = histograms.get(key)
+        if entry is None:
+            # Un compteur par bucket, un pour +Inf, puis la somme
+            entry = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+
+def register_gauge(name: str, help_text: str, callback):
+    """Jauge évaluée à la collecte : callback() retourne [(labels dict, valeur), ...]."""
+    _GAUGES.append((name, help_text, callback))
+
+
+FLOW_RUNS = Counter("drapo_flow_runs_total", "Exécutions de flows terminées, par statut.", ("flow", "status"))
+FLOW_DURATION = Histogram("drapo_flow_duration_seconds", "Durée des exécutions de flows.", ("flow",))
+FLOW_SKIPPED = Counter("drapo_flow_runs_skipped_total", "Runs de flows abandonnés (overlap, verrou).", ("flow",))
+JOB_RUNS = Counter("drapo_job_runs_total", "Exécutions de jobs terminées, par statut.", ("job", "type", "status"))
+JOB_DURATION = Histogram("drapo_job_duration_seconds", "Durée des exécutions de jobs (hors cache).", ("job", "type"))
+QUEUE_WAIT = Histogram("drapo_job_queue_wait_seconds", "Attente d'un job avant son démarrage (workers du DAG, pools de ressources).",
+                       ("job", "queue"), WAIT_BUCKETS)
+SCHEDULER_LAG = Histogram("drapo_scheduler_lag_seconds", "Retard du démarrage d'un flow sur son heure planifiée.",
+                          ("flow",), WAIT_BUCKETS)
+GATE_WAIT = Histogram("drapo_gate_wait_seconds", "Attente des jobs de connexion.", ("job", "result"), WAIT_BUCKETS)
+OUTPUT_BYTES = Counter("drapo_child_output_bytes_total", "Octets écrits sur stdout/stderr par les process des jobs.", ("job",))
+LOG_DROPPED = Counter("drapo_log_lines_dropped_total", "Lignes de sortie ignorées, file de logs pleine.", ("job",))
+
+
+################################################# Exposition #################################################
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: tuple = ()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render(openmetrics: bool = False) -> str:
+    """Texte d'exposition de toutes les métriques."""
+    data = _collect()
+    lines = []
+    for metric in _METRICS:
+        # En OpenMetrics, la famille d'un compteur se nomme sans le suffixe _total
+        family = metric.name[:-len("_total")] if openmetrics and metric.kind == "counter" else metric.name
+        lines.append(f"# HELP {family} {metric.help}")
+        lines.append(f"# TYPE {family} {metric.kind}")
+        if metric.kind == "counter":
+            for (name, values), value in sorted(data.counters.items()):
+                if name == metric.name:
+                    lines.append(f"{metric.name}{_labels(metric.labelnames, values)} {_number(value)}")
+            continue
+        for (name, values), entry in sorted(data.histograms.items()):
+            if name != metric.name:
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float("inf"),), entry[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{metric.name}_bucket{_labels(metric.labelnames, values, (('le', le),))} {cumulative}")
+            lines.append(f"{metric.name}_count{_labels(metric.labelnames, values)} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(metric.labelnames, values)} {_number(entry[-1])}")
+    for name, help_text, callback in _GAUGES:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        try:
+            samples = callback()
+        except Exception as e:
+            logging.warning("Métrique %s indisponible : %s", name, e)
+            samples = []
+        for labels, value in samples:
+            lines.append(f"{name}{_labels(tuple(labels), tuple(str(v) for v in labels.values()))} {_number(value)}")
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str):
+    """Écrit les métriques pour le textfile collector de node-exporter (remplacement atomique)."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        body = render(openmetrics).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Les scrapes ne polluent pas le log de Drapo
+        pass
+
+
+class MetricsExporter:
+    """Écriture périodique du fichier texte et/ou serveur HTTP /metrics, dans des threads démons."""
+
+    def __init__(self, settings: dict):
+        self.textfile = settings.get("textfile") or None
+        self.interval_s = float(settings.get("interval_s", DEFAULT_INTERVAL_S))
+        self.http_port = int(settings.get("http_port") or 0)
+        self.http_host = settings.get("http_host", "127.0.0.1")
+        self._stop = threading.Event()
+        self._server = None
+
+    def start(self, serve_http: bool = True):
+        if self.textfile:
+            threading.Thread(target=self._textfile_loop, name="drapo-metrics-textfile", daemon=True).start()
+            atexit.register(self.stop)
+            logging.info("Métriques écrites dans %s toutes les %ss", self.textfile, _number(self.interval_s))
+        if serve_http and self.http_port:
+            self._server = ThreadingHTTPServer((self.http_host, self.http_port), _Handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name="drapo-metrics-http", daemon=True).start()
+            logging.info("Métriques exposées sur http://%s:%d/metrics", self.http_host, self.http_port)
+
+    def _textfile_loop(self):
+        while not self._stop.wait(self.interval_s):
+            self._write()
+
+    def _write(self):
+        try:
+            write_textfile(self.textfile)
+        except OSError as e:
+            logging.warning("Écriture des métriques impossible (%s) : %s", self.textfile, e)
+
+    def stop(self):
+        """Arrête l'export ; le fichier texte reçoit un dernier état complet."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self.textfile:
+            self._write()
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def start_metrics(CONFIG: dict, serve_http: bool = True) -> MetricsExporter | None:
+    """Démarre l'export configuré dans config.yml ; None si rien n'est configuré."""
+    settings = CONFIG.get("metrics", {})
+    if not settings.get("textfile") and not settings.get("http_port"):
+        return None
+    exporter = MetricsExporter(settings)
+    try:
+        exporter.start(serve_http)
+    except OSError as e:
+        logging.error("Export des métriques impossible : %s", e)
+        return None
+    return exporter
@@ -2,77 +2,415 @@
 # # orchestrer.py
 """
 Module pour orchestrer l'exécution des workflows de jobs Python, dbt et git.
-    
+
     run_flow est la fonction principale qui permet orchestrer les jobs définis dans la configuration.
+    Un flow dont les jobs déclarent `depends_on` est exécuté comme un DAG : chaque job prêt
+    est lancé dès que ses dépendances ont réussi, sur un pool de `max_parallel` workers.
+    Un flow composé d'une simple liste `steps` reste exécuté dans l'ordre.
+    Les jobs qui déclarent `resources` attendent leurs réservations dans les pools partagés
+    (voir drapo.resources) ; l'attente compte dans leur timeout.
+    `timeout_min` sur un job ou un flow borne sa durée : à l'échéance, le groupe de process
+    du job en cours est arrêté (SIGTERM puis SIGKILL) et le job est marqué "timed_out".
 
 """
 
 import os
 import sys
 import time
+import uuid
 import logging
 import argparse
-import subprocess
+import contextvars
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from drapo.utils import resolve_path
+from drapo.logs import job_log
+from drapo.history import get_store
+from drapo.cache import check_job_cache
+from drapo import dbt_inprocess, dbt_shards
+from drapo.flowspec import build_dag, is_dag_flow
+from drapo.common import ENGINE, deadline, interrupted
+from drapo.gate import run_gate
+from drapo.resources import POOLS, WAIT_POLL_S, Waiter
+from drapo.distributed import get_queue, run_remote
+from drapo.metrics import FLOW_RUNS, FLOW_DURATION, JOB_RUNS, JOB_DURATION, OUTPUT_BYTES, QUEUE_WAIT
+from drapo.sampler import format_usage_table
 from drapo.runners import *
 
 
-def run_flow(CONFIG, python_distrib : str, steps: list[str], jobs_map: dict[str, dict], args: argparse.Namespace):
+DEFAULT_MAX_PARALLEL = 4
+# Statuts d'un job dans le résultat d'un flow
+OK_STATUSES = ("success",)
+
+
+@dataclass
+class FlowRun:
+    """Contexte d'une exécution de flow, partagé par ses jobs."""
+    name: str
+    run_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    started_at: float = field(default_factory=time.time)
+    # Une ligne par job terminé (statut, durée, relevés /proc) pour le rapport de fin de flow
+    usage: list[dict] = field(default_factory=list)
+
+
+def timeout_seconds(item: dict) -> float | None:
+    """Timeout d'un job ou d'un flow (`timeout_min` dans le TOML), en secondes."""
+    value = item.get("timeout_min")
+    return float(value) * 60 if value else None
+
+
+################################################# Job dispatch #################################################
+def run_job(CONFIG, job: dict, python_distrib: str | None = None, args: argparse.Namespace | None = None,
+            flow_run: FlowRun | None = None, claimed: bool = False) -> str:
     """
-    Orchestrate a sequence of jobs:
-     - first step must be a connection check
-     - then python and dbt steps
+    Exécute un job unique selon son type et l'enregistre dans l'historique des exécutions.
+    Avec claimed, ses ressources ont déjà été réservées par l'appelant (run_dag), qui les rend.
+    Retourne son statut : "success", "failed", "timed_out" (timeout du job ou du flow)
+    ou "cancelled" (arrêt demandé par SIGTERM/Ctrl-C).
     """
-    # 1) connection check
-    conn_job = jobs_map.get(steps[0])
-    if conn_job and conn_job["type"] == "connection":
-        ip    = conn_job["host"] if os.name != "nt" else "10.0.0.45"
-        port  = conn_job["port"]
-        retry = conn_job.get("retry_interval_min", 10)
-        while True:
-            logging.info("Vérification de %s:%d …", ip, port)
-            if is_server_reachable(ip, port):
-                logging.info("Connexion OK, on poursuit le flow.")
-                break
-            logging.info("Attente %d min avant nouvelle tentative.", retry)
-            time.sleep(retry * 60)
-    else:
-        logging.error("Metajob de connexion manquant ou incorrect.")
+    with job_log(job["name"]) as log_path, deadline(timeout_seconds(job)):
+        if log_path:
+            logging.info("Log du job %s : %s", job["name"], log_path)
+        started = time.time()
+        cache, fingerprint, hit = (None, None, False)
+        result = None
+        reason = interrupted()
+        if reason:
+            logging.warning("Job %s non lancé (%s).", job["name"], reason)
+            ok = False
+        else:
+            if not getattr(args, "dry_run", False):
+                extra_args = [getattr(args, "python_args", ""), getattr(args, "dbt_args", "")]
+                cache, fingerprint, hit = check_job_cache(CONFIG, job, extra_args)
+            if hit:
+                logging.info("♻️ Cache hit pour le job %s : entrées inchangées depuis le dernier succès, job sauté.", job["name"])
+                ok = True
+            else:
+                # Pools de ressources partagés entre flows : le job attend ses réservations par priorité
+                with POOLS.claim(job, held=claimed) as reason:
+                    if reason:
+                        ok = False
+                    else:
+                        ok, result = _dispatch_job(CONFIG, job, python_distrib, args, flow_run, log_path)
+                        if ok and cache is not None:
+                            cache.put(job["name"], fingerprint)
+                        elif not ok:
+                            # Un runner qui lève une exception après un timeout ne retourne pas de RunResult
+                            reason = result.termination if result is not None and result.termination else interrupted()
+        ended = time.time()
+    status = "success" if ok else (reason or "failed")
+    job_type = job.get("type", "")
+    JOB_RUNS.inc(job=job["name"], type=job_type, status="cached" if hit else status)
+    if result is not None:
+        JOB_DURATION.observe(result.duration, job=job["name"], type=job_type)
+        OUTPUT_BYTES.inc(result.output_bytes, job=job["name"])
+
+    store = get_store(CONFIG)
+    if store is not None:
+        store.record_job(
+            run_id=flow_run.run_id if flow_run else None,
+            flow=flow_run.name if flow_run else None,
+            job=job["name"],
+            job_type=job_type,
+            started_at=started,
+            ended_at=ended,
+            exit_code=result.returncode if result is not None else (0 if ok else None),
+            status="cached" if hit else status,
+            output_bytes=result.output_bytes if result is not None else 0,
+            peak_rss_kb=result.peak_rss_kb if result is not None else None,
+            cpu_s=result.cpu_s if result is not None else None,
+            io_read_bytes=result.io_read_bytes if result is not None else None,
+            io_write_bytes=result.io_write_bytes if result is not None else None,
+            max_threads=result.max_threads if result is not None else None,
+        )
+    if flow_run is not None:
+        row = {"job": job["name"], "status": "cached" if hit else status, "duration": ended - started}
+        if result is not None:
+            row.update(cpu_s=result.cpu_s, peak_rss_kb=result.peak_rss_kb, io_read_bytes=result.io_read_bytes,
+                       io_write_bytes=result.io_write_bytes, max_threads=result.max_threads)
+        flow_run.usage.append(row)
+    return status
+
+
+def _dispatch_job(CONFIG, job: dict, python_distrib: str | None = None, args: argparse.Namespace | None = None,
+                  flow_run: FlowRun | None = None, log_path: str | None = None) -> tuple[bool, RunResult | None]:
+    """Exécute le job ici, ou via la file distribuée si elle est activée (les jobs de connexion restent locaux)."""
+    queue = get_queue()
+    if queue is None or job["type"] == "connection":
+        return _run_job(CONFIG, job, python_distrib, args, flow_run, log_path)
+    return run_remote(queue, job, args,
+                      run_id=flow_run.run_id if flow_run else None,
+                      flow=flow_run.name if flow_run else None)
 
-    # 2) subsequent steps
-    for step_name in steps[1:]:
-        job = jobs_map.get(step_name)
-        logging.info(">>>>>>>>>>>>>>>>> JOB : %s >>>>>>>>>>>>>>>>>", step_name)
-        if not job:
-            logging.error("Job inconnu dans le flow: %s", step_name)
-            continue
 
-        if job["type"] == "python":
+def _run_job(CONFIG, job: dict, python_distrib: str | None = None, args: argparse.Namespace | None = None,
+             flow_run: FlowRun | None = None, log_path: str | None = None) -> tuple[bool, RunResult | None]:
+    step_name = job["name"]
+    logging.info(">>>>>>>>>>>>>>>>> JOB : %s >>>>>>>>>>>>>>>>>", step_name)
+    try:
+        dry_run = getattr(args, "dry_run", False)
+        if job["type"] == "connection":
+            # Les sondes tournent sur la boucle asyncio du moteur ; ce thread ne fait qu'attendre le verdict
+            result = ENGINE.submit(run_gate(job)).result()
+        elif job["type"] == "python":
             interp = python_distrib if python_distrib else job.get("interpreter", sys.executable)
             script_path = resolve_path("${python_scripts}",CONFIG)
-            script_file = job["script_file"]
+            script_file = job.get("script_file")
             script = os.path.join(script_path, script_file) if script_file else job.get("script_path", "")
-            args.python_args = args.python_args if hasattr(args, "python_args") else ""
             logging.info("Exécution du script Python %s avec interpréteur %s", script, interp)
-            run_python_script(CONFIG,
+            result = run_python_script(CONFIG,
                 python_interpreter=interp,
                 script_path=script,
-                args=args.python_args if hasattr(args, "python_args") else ""
+                args=getattr(args, "python_args", ""),
+                name=step_name,
+                dry_run=dry_run,
+                warm=job.get("warm", True),
+                profile=_profilers(job),
+                artifacts_prefix=_artifacts_prefix(CONFIG, step_name, log_path) if _profilers(job) else None
             )
         elif job["type"] == "dbt":
-            run_dbt_command(CONFIG,
-                cmd = job["cmd"] + args.dbt_args.split() if "dbt_args" in args else [],
-                working_dir=job.get("working_dir")
+            dbt_args = getattr(args, "dbt_args", "")
+            result = run_dbt_command(CONFIG,
+                cmd=job["cmd"] + (dbt_args.split() if dbt_args else []),
+                working_dir=job.get("working_dir"),
+                name=step_name,
+                dry_run=dry_run,
+                state_aware=job.get("state_aware", False),
+                mode=job.get("mode", "subprocess"),
+                session=flow_run.run_id if flow_run else None,
+                shard_by=job.get("shard_by"),
+                max_shards=job.get("max_shards", dbt_shards.DEFAULT_MAX_SHARDS)
             )
         elif job["type"] == "git":
-            update_git_repo(CONFIG,
+            result = update_git_repo(CONFIG,
                 repo_dir=job["repo_dir"],
-                branch=job["branch"]
+                branch=job["branch"],
+                name=step_name,
+                dry_run=dry_run,
+                sync=job.get("sync", "reset"),
+                depth=job.get("depth"),
+                fetch_filter=job.get("filter")
             )
         elif job["type"] == "dependencies":
-            install_dependencies(CONFIG)
+            result = install_dependencies(CONFIG,
+                name=step_name,
+                python_interpreter=job.get("interpreter"),
+                dry_run=dry_run
+            )
         else:
             logging.error("Type de job non géré: %s", job["type"])
+            return False, None
+    except Exception as e:
+        logging.error("Job %s en erreur : %s", step_name, e)
+        return False, None
+
+    logging.info("<<<<<<<<<<<<<<<<< JOB %s terminé <<<<<<<<<<<<<<<<<", step_name)
+    # Les runners retournent None quand il n'y a rien à faire (ex: git sous Windows)
+    return result is None or result.ok, result
+
+
+def _profilers(job: dict) -> list[str]:
+    """Profilages demandés par un job python (`profile = "cprofile"` ou une liste)."""
+    profile = job.get("profile") or []
+    return [profile] if isinstance(profile, str) else list(profile)
+
+
+def _artifacts_prefix(CONFIG, job_name: str, log_path: str | None) -> str:
+    """Préfixe des rapports d'un job : son fichier de log sans extension, sinon <drapolog>/jobs/<job>/<horodatage>."""
+    if log_path:
+        return os.path.splitext(log_path)[0]
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(resolve_path("${drapolog}", CONFIG), "jobs", job_name, stamp)
+
+
+################################################# DAG #################################################
+def run_dag(CONFIG, dag: dict[str, set[str]], jobs_map: dict[str, dict], python_distrib: str | None = None,
+            args: argparse.Namespace | None = None, max_parallel: int = DEFAULT_MAX_PARALLEL,
+            flow_run: FlowRun | None = None) -> dict[str, str]:
+    """
+    Exécute les jobs du DAG : chaque job dont toutes les dépendances ont réussi est lancé
+    immédiatement sur un pool borné à `max_parallel` workers.
+    Les jobs de connexion attendent hors de ce pool : pendant qu'ils sondent leurs hôtes,
+    les jobs qui n'en dépendent pas occupent les workers.
+    Un job qui déclare `resources` n'occupe un worker qu'une fois ses réservations obtenues :
+    un pool saturé ne bloque pas les autres jobs prêts.
+    Les dépendants d'un job en échec ne sont pas lancés.
+    Retourne le statut de chaque job : "success", "failed", "timed_out", "cancelled" ou "skipped".
+    """
+    status: dict[str, str] = {}
+    pending = {name: set(deps) for name, deps in dag.items()}
+    claims: dict[str, tuple[Waiter, float]] = {}
+
+    gates = sum(1 for name in dag if jobs_map[name]["type"] == "connection")
+    with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="drapo-job") as pool, \
+            ThreadPoolExecutor(max_workers=max(1, gates), thread_name_prefix="drapo-gate") as gate_pool:
+        running = {}
 
-        logging.info("<<<<<<<<<<<<<<<<< JOB %s terminé <<<<<<<<<<<<<<<<<", job["name"])
\ No newline at end of file
+        def submit(name: str, waiter: Waiter | None = None):
+            executor = gate_pool if jobs_map[name]["type"] == "connection" else pool
+            # Le contexte (échéance du flow) suit le job dans le thread du pool
+            future = executor.submit(contextvars.copy_context().run, _queued_job, time.monotonic(), waiter,
+                                     CONFIG, jobs_map[name], python_distrib, args, flow_run)
+            running[future] = name
+
+        def submit_ready():
+            for name in [n for n, deps in pending.items() if not deps]:
+                del pending[name]
+                job = jobs_map[name]
+                try:
+                    waiter = None if interrupted() else POOLS.request(name, job.get("resources") or {},
+                                                                      int(job.get("priority", 0)))
+                except ValueError:
+                    # Réservation invalide : run_job la refuse ("failed") et l'enregistre
+                    waiter = None
+                if waiter is not None and not waiter.granted:
+                    logging.info("Job %s en attente de ressources (%s, priorité %d).", name,
+                                 ", ".join(f"{p}={a:g}" for p, a in waiter.claim.items()), waiter.priority)
+                    claims[name] = (waiter, time.monotonic())
+                else:
+                    submit(name, waiter)
+
+        def submit_granted():
+            reason = interrupted()
+            for name, (waiter, since) in list(claims.items()):
+                if waiter.granted or reason:
+                    del claims[name]
+                    if waiter.granted:
+                        QUEUE_WAIT.observe(time.monotonic() - since, job=name, queue="resources")
+                    else:
+                        # Le job est lancé sans ressources : run_job constate l'interruption et l'enregistre
+                        POOLS.withdraw(waiter)
+                        waiter = None
+                    submit(name, waiter)
+
+        def finish(name: str, result: str):
+            status[name] = result
+            if result in OK_STATUSES:
+                for deps in pending.values():
+                    deps.discard(name)
+            else:
+                skip_dependents(name)
+
+        def skip_dependents(failed: str):
+            for name in [n for n, deps in pending.items() if failed in deps]:
+                del pending[name]
+                status[name] = "skipped"
+                logging.warning("Job %s ignoré : la dépendance %s n'a pas réussi.", name, failed)
+                skip_dependents(name)
+
+        submit_ready()
+        while running or claims:
+            if running:
+                done, _ = wait(running, timeout=WAIT_POLL_S if claims else None, return_when=FIRST_COMPLETED)
+            else:
+                POOLS.wait_granted([waiter for waiter, _ in claims.values()], WAIT_POLL_S)
+                done = set()
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Une erreur hors du runner (historique, métriques, cache…) n'arrête que ce job
+                    logging.error("Job %s en erreur : %s", name, e)
+                    result = "failed"
+                finish(name, result)
+            submit_granted()
+            submit_ready()
+
+    return status
+
+
+def _queued_job(submitted: float, waiter: Waiter | None, CONFIG, job: dict, *args) -> str:
+    """
+    run_job depuis un worker du DAG, en mesurant l'attente d'un worker libre.
+    `waiter` porte les ressources déjà obtenues pour le job : elles sont rendues à la fin.
+    """
+    QUEUE_WAIT.observe(time.monotonic() - submitted, job=job["name"], queue="workers")
+    try:
+        return run_job(CONFIG, job, *args, claimed=waiter is not None)
+    finally:
+        if waiter is not None:
+            POOLS.release(waiter.claim)
+
+
+################################################# Flow #################################################
+def run_flow(CONFIG, python_distrib : str, steps: list[str], jobs_map: dict[str, dict], args: argparse.Namespace | None = None,
+             max_parallel: int | None = None, flow_name: str = "flow", timeout_s: float | None = None) -> dict[str, str]:
+    """
+    Orchestrate a flow of jobs:
+     - if any job of the flow declares `depends_on`, jobs run as a DAG on a bounded worker pool
+     - otherwise steps run one after the other, in order (connection check first)
+    `timeout_s` bounds the whole flow: jobs still running at the deadline are stopped,
+    jobs not yet started are marked "timed_out".
+    The flow run and each job run are recorded in the run history.
+    Returns the status of each job.
+    """
+    flow_run = FlowRun(flow_name)
+    store = get_store(CONFIG)
+    if store is not None:
+        store.record_flow_start(flow_run.run_id, flow_name, flow_run.started_at)
+    try:
+        with deadline(timeout_s):
+            status = _run_flow(CONFIG, python_distrib, steps, jobs_map, args, max_parallel, flow_run)
+    except Exception:
+        if store is not None:
+            store.record_flow_end(flow_run.run_id, time.time(), "error")
+        FLOW_RUNS.inc(flow=flow_name, status="error")
+        raise
+    finally:
+        # Les workers dbt inprocess vivent le temps du flow
+        dbt_inprocess.close_session(flow_run.run_id)
+
+    failed = [name for name, s in status.items() if s not in OK_STATUSES]
+    ended = time.time()
+    FLOW_RUNS.inc(flow=flow_name, status=_flow_status(status))
+    FLOW_DURATION.observe(ended - flow_run.started_at, flow=flow_name)
+    if store is not None:
+        store.record_flow_end(flow_run.run_id, ended, _flow_status(status))
+    if flow_run.usage:
+        logging.info("Jobs les plus coûteux du flow %s :\n%s", flow_name, format_usage_table(flow_run.usage))
+    if failed:
+        logging.error("Flow terminé avec des jobs en échec ou ignorés : %s", ", ".join(failed))
+    else:
+        logging.info("Flow terminé : %d jobs réussis.", len(status))
+    return status
+
+
+def _flow_status(status: dict[str, str]) -> str:
+    values = set(status.values())
+    for flow_status in ("cancelled", "timed_out", "failed"):
+        if flow_status in values:
+            return flow_status
+    return "failed" if values - set(OK_STATUSES) else "success"
+
+
+def _run_flow(CONFIG, python_distrib: str, steps: list[str], jobs_map: dict[str, dict], args: argparse.Namespace | None,
+              max_parallel: int | None, flow_run: FlowRun) -> dict[str, str]:
+    if is_dag_flow(steps, jobs_map):
+        dag = build_dag(steps, jobs_map)
+        workers = max_parallel or DEFAULT_MAX_PARALLEL
+        logging.info("Flow exécuté en DAG (%d jobs, max_parallel=%d).", len(dag), workers)
+        return run_dag(CONFIG, dag, jobs_map, python_distrib, args, workers, flow_run)
+
+    # 1) connection check
+    conn_job = jobs_map.get(steps[0])
+    if not conn_job or conn_job["type"] != "connection":
+        logging.error("Metajob de connexion manquant ou incorrect.")
+
+    # 2) steps, in order
+    status = {}
+    for step_name in steps:
+        job = jobs_map.get(step_name)
+        if not job:
+            logging.error("Job inconnu dans le flow: %s", step_name)
+            status[step_name] = "failed"
+            continue
+        status[step_name] = run_job(CONFIG, job, python_distrib, args, flow_run)
+        if job["type"] == "connection" and status[step_name] not in OK_STATUSES:
+            # Délai de connexion dépassé : les étapes suivantes ont besoin de l'hôte
+            skipped = [name for name in steps if name not in status]
+            status.update({name: "skipped" for name in skipped})
+            logging.error("Connexion impossible : étapes suivantes ignorées (%s).", ", ".join(skipped) or "-")
+            break
+    return status
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# overlap.py
+"""
+Politique de chevauchement des exécutions d'un même flow.
+
+    Un flow encore en cours quand son trigger suivant arrive est traité selon sa clé `overlap` :
+
+        skip             le nouveau run est abandonné
+        queue_one        (défaut) le nouveau run attend la fin du précédent ; au plus un run en attente,
+                         les triggers suivants sont fusionnés avec lui
+        allow            les runs se chevauchent librement
+        cancel_previous  le run en cours est annulé (ses process sont arrêtés), puis le nouveau démarre
+
+    Avec `lock = true`, le flow prend aussi un verrou fichier dans <drapostate>/locks/ : un autre
+    process Drapo sur la même machine (scheduler, --enforce lancé à la main) ne peut pas exécuter
+    le même flow en même temps ; le run qui trouve le verrou pris est abandonné.
+"""
+
+import os
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from drapo.utils import resolve_path
+from drapo.common import CancelScope, cancel_scope
+from drapo.metrics import FLOW_SKIPPED
+from drapo.flowspec import POLICIES
+
+
+DEFAULT_POLICY = "queue_one"
+
+
+@contextmanager
+def file_lock(path: str):
+    """Verrou exclusif non bloquant sur `path` ; produit True s'il est obtenu, False s'il est déjà pris."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = open(path, "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        yield False
+        return
+    try:
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        yield True
+    finally:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        f.close()
+
+
+def lock_path(state_dir: str, flow_name: str) -> str:
+    return os.path.join(state_dir, "locks", f"{flow_name}.lock")
+
+
+class FlowGuard:
+    """Applique la politique de chevauchement et le verrou fichier d'un flow."""
+
+    def __init__(self, name: str, policy: str = DEFAULT_POLICY, lock_file: str | None = None):
+        self.name = name
+        self._cond = threading.Condition()
+        self._scopes: set[CancelScope] = set()
+        self._queued = False
+        self.skipped = 0
+        self.configure(policy, lock_file)
+
+    def configure(self, policy: str, lock_file: str | None = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Politique overlap inconnue pour le flow '{self.name}' : {policy} ({', '.join(POLICIES)})")
+        with self._cond:
+            self.policy = policy
+            self.lock_file = lock_file
+
+    @property
+    def running(self) -> int:
+        with self._cond:
+            return len(self._scopes)
+
+    def _skip(self, reason: str) -> bool:
+        with self._cond:
+            self.skipped += 1
+        FLOW_SKIPPED.inc(flow=self.name)
+        logging.warning("Flow '%s' non lancé : %s.", self.name, reason)
+        return False
+
+    def run(self, fn) -> bool:
+        """
+        Exécute fn() selon la politique du flow, dans un CancelScope propre à ce run.
+        Retourne False si le run a été abandonné (politique ou verrou fichier).
+        """
+        scope = CancelScope(self.name)
+        with self._cond:
+            if self._scopes:
+                if self.policy == "skip":
+                    return self._skip("le run précédent est toujours en cours (overlap = skip)")
+                if self.policy == "queue_one":
+                    if self._queued:
+                        return self._skip("un run est déjà en attente (overlap = queue_one)")
+                    logging.info("Flow '%s' en attente de la fin du run en cours.", self.name)
+                    self._queued = True
+                    while self._scopes:
+                        self._cond.wait()
+                    self._queued = False
+                elif self.policy == "cancel_previous":
+                    logging.warning("Flow '%s' : annulation du run en cours (overlap = cancel_previous).", self.name)
+                    for previous in self._scopes:
+                        previous.cancel()
+                    while self._scopes:
+                        self._cond.wait()
+            self._scopes.add(scope)
+            lock_file = self.lock_file
+
+        try:
+            if lock_file is None:
+                with cancel_scope(scope):
+                    fn()
+                return True
+            with file_lock(lock_file) as acquired:
+                if not acquired:
+                    return self._skip(f"verrou {lock_file} détenu par un autre process")
+                with cancel_scope(scope):
+                    fn()
+                return True
+        finally:
+            with self._cond:
+                self._scopes.discard(scope)
+                self._cond.notify_all()
+
+
+_GUARDS: dict[str, FlowGuard] = {}
+_GUARDS_LOCK = threading.Lock()
+
+
+def get_guard(name: str, policy: str = DEFAULT_POLICY, lock_file: str | None = None) -> FlowGuard:
+    """
+    Garde du flow `name`, conservée d'un rechargement à l'autre pour que les runs en cours
+    restent pris en compte ; la politique et le verrou sont mis à jour.
+    """
+    with _GUARDS_LOCK:
+        guard = _GUARDS.get(name)
+        if guard is None:
+            guard = _GUARDS[name] = FlowGuard(name, policy, lock_file)
+        else:
+            guard.configure(policy, lock_file)
+        return guard
+
+
+def guard_for_flow(CONFIG: dict, flow: dict) -> FlowGuard:
+    """Garde d'un flow du TOML (`overlap`, `lock`). Lève ValueError si la configuration est invalide."""
+    lock_file = None
+    if flow.get("lock"):
+        lock_file = lock_path(resolve_path("${drapostate}", CONFIG), flow["name"])
+    return get_guard(flow["name"], flow.get("overlap", DEFAULT_POLICY), lock_file)
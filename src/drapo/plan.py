@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# plan.py
+"""
+Plan d'orchestration compilé : le TOML des flows, validé une fois et figé.
+
+    load_plan lit le fichier, vérifie les jobs et les flows (clés requises par type, étapes connues,
+    DAG sans cycle, trigger, politique overlap, réservations de ressources) et produit un Plan
+    immuable avec sa table des jobs. Les plans sont gardés en mémoire par fichier : tant que le mtime (ou, à défaut,
+    le contenu haché) ne change pas, le même Plan est rendu sans relire le TOML. Ils sont aussi
+    écrits dans le cache disque de Drapo (voir utils.read_cache) : une nouvelle commande
+    `drapo-run` n'importe ni toml ni les modules d'exécution pour un fichier déjà compilé.
+
+    Le scheduler recharge le plan sur SIGHUP, et sur modification du fichier si la section
+    `reload` de config.yml l'active :
+
+        reload:
+          watch: true
+          poll_s: 5
+
+    Un flow en cours garde le plan avec lequel il a démarré ; seuls les déclenchements suivants
+    utilisent le nouveau. Un fichier invalide est refusé et le plan courant reste en place.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass, replace
+
+from drapo.utils import FrozenDict, file_signature, read_cache, resolve_path, write_cache
+
+
+JOB_TYPES = ("connection", "python", "dbt", "git", "dependencies", "flow")
+# Clés obligatoires par type de job : chaque groupe exige au moins une de ses clés
+REQUIRED_KEYS = {
+    "connection": [("targets", "host")],
+    "python": [("script_file", "script_path")],
+    "dbt": [("cmd",)],
+    "git": [("repo_dir",), ("branch",)],
+}
+DEFAULT_POLL_S = 5.0
+
+
+class PlanError(ValueError):
+    """Fichier d'orchestration invalide ; `errors` liste tous les problèmes trouvés."""
+
+    def __init__(self, path: str, errors: list[str]):
+        self.path = path
+        self.errors = errors
+        super().__init__(f"{path} : " + " ; ".join(errors))
+
+
+def freeze(value):
+    """Copie profonde figée : dicts en FrozenDict ; les listes restent des listes (copiées)."""
+    if isinstance(value, dict):
+        return FrozenDict({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [freeze(v) for v in value]
+    return value
+
+
+@dataclass(frozen=True)
+class Plan:
+    path: str
+    sha256: str
+    mtime_ns: int
+    size: int
+    config: FrozenDict                # contenu du TOML
+    jobs: FrozenDict                  # {nom: job}
+    flows: tuple                      # jobs de type flow, dans l'ordre du fichier
+
+    def flow(self, name: str) -> FrozenDict:
+        job = self.jobs.get(name)
+        if job is None or job.get("type") != "flow":
+            raise KeyError(f"Flow inconnu : {name}")
+        return job
+
+
+def validate(config: dict) -> list[str]:
+    """Problèmes de structure du TOML d'orchestration (liste vide si le fichier est valide)."""
+    from drapo.flowspec import POLICIES, STRATEGIES, build_dag, make_trigger
+
+    errors = []
+    capacities = config.get("resources", {})
+    if not isinstance(capacities, dict):
+        return ["[resources] doit être une table"]
+    for pool, value in capacities.items():
+        if not isinstance(value, (int, float)) or value < 0:
+            errors.append(f"capacité invalide pour la ressource '{pool}' : {value!r}")
+
+    jobs = config.get("jobs", [])
+    if not isinstance(jobs, list) or not all(isinstance(job, dict) for job in jobs):
+        return errors + ["[[jobs]] doit être une liste de tables"]
+    jobs_map = {}
+    for job in jobs:
+        name = job.get("name")
+        if not name:
+            errors.append(f"job sans nom : {dict(job)}")
+            continue
+        if name in jobs_map:
+            errors.append(f"job '{name}' défini plusieurs fois")
+        jobs_map[name] = job
+        if job.get("type") not in JOB_TYPES:
+            errors.append(f"job '{name}' : type inconnu {job.get('type')!r} ({', '.join(JOB_TYPES)})")
+        for group in REQUIRED_KEYS.get(job.get("type"), []):
+            if not any(key in job for key in group):
+                errors.append(f"job '{name}' ({job['type']}) : clé requise manquante : {' ou '.join(group)}")
+        if job.get("type") == "dbt" and "cmd" in job and not (
+                isinstance(job["cmd"], list) and all(isinstance(arg, str) for arg in job["cmd"])):
+            errors.append(f"job '{name}' : cmd doit être une liste de chaînes (ex. [\"dbt\", \"build\"])")
+        if "host" in job and "port" not in job:
+            errors.append(f"job '{name}' : port requis avec host")
+        if not isinstance(job.get("resources") or {}, dict):
+            errors.append(f"job '{name}' : resources doit être une table (ex. {{ warehouse = 1 }})")
+            continue
+        for pool, amount in (job.get("resources") or {}).items():
+            if pool not in capacities:
+                errors.append(f"job '{name}' : ressource inconnue '{pool}'")
+            elif not isinstance(amount, (int, float)) or amount > capacities[pool]:
+                errors.append(f"job '{name}' : {pool}={amount!r} dépasse la capacité du pool ({capacities[pool]:g})")
+        if "shard_by" in job and job["shard_by"] not in STRATEGIES:
+            errors.append(f"job '{name}' : shard_by inconnu {job['shard_by']!r} ({', '.join(STRATEGIES)})")
+        if not isinstance(job.get("max_shards", 1), int) or job.get("max_shards", 1) < 1:
+            errors.append(f"job '{name}' : max_shards doit être un entier >= 1")
+
+    for flow in (j for j in jobs_map.values() if j.get("type") == "flow"):
+        name = flow["name"]
+        steps = flow.get("steps") or []
+        if not steps:
+            errors.append(f"flow '{name}' : aucune étape")
+        nested = [s for s in steps if jobs_map.get(s, {}).get("type") == "flow"]
+        if nested:
+            errors.append(f"flow '{name}' : un flow ne peut pas être une étape ({', '.join(nested)})")
+        try:
+            build_dag(steps, jobs_map)
+        except ValueError as e:
+            errors.append(f"flow '{name}' : {e}")
+        try:
+            make_trigger(flow)
+        except (KeyError, ValueError) as e:
+            errors.append(f"flow '{name}' : planification invalide ({e})")
+        if flow.get("overlap", "queue_one") not in POLICIES:
+            errors.append(f"flow '{name}' : politique overlap inconnue {flow['overlap']!r} ({', '.join(POLICIES)})")
+    return errors
+
+
+def compile_plan(path: str, data: bytes, mtime_ns: int = 0, size: int = 0) -> Plan:
+    """Compile le contenu d'un TOML d'orchestration. Lève PlanError s'il est invalide."""
+    import toml
+    try:
+        config = toml.loads(data.decode("utf-8"))
+    except (UnicodeDecodeError, toml.TomlDecodeError) as e:
+        raise PlanError(path, [f"TOML illisible : {e}"])
+    errors = validate(config)
+    if errors:
+        raise PlanError(path, errors)
+    config = freeze(config)
+    jobs = FrozenDict({job["name"]: job for job in config.get("jobs", [])})
+    return Plan(
+        path=path,
+        sha256=hashlib.sha256(data).hexdigest(),
+        mtime_ns=mtime_ns,
+        size=size,
+        config=config,
+        jobs=jobs,
+        flows=tuple(job for job in jobs.values() if job["type"] == "flow"),
+    )
+
+
+# Modules dont dépendent validate et compile_plan : leurs fichiers signent le cache disque des plans
+VALIDATION_SOURCES = tuple(os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{module}.py")
+                           for module in ("plan", "flowspec"))
+
+_PLANS: dict[str, Plan] = {}
+_PLANS_LOCK = threading.Lock()
+
+
+def load_plan(CONFIG: dict, fn: str) -> Plan:
+    """
+    Plan du fichier `fn`, recompilé seulement s'il a changé : mtime et taille (en mémoire, puis
+    dans le cache disque), puis empreinte sha256.
+    Lève FileNotFoundError, ou PlanError si le fichier est invalide.
+    """
+    path = resolve_path(fn, CONFIG)
+    st = os.stat(path)
+    with _PLANS_LOCK:
+        cached = _PLANS.get(path)
+        if cached is not None and (cached.mtime_ns, cached.size) == (st.st_mtime_ns, st.st_size):
+            return cached
+        # Le code de validation fait partie de la signature : un plan compilé par une autre version est refait
+        signature = ((st.st_mtime_ns, st.st_size),) + file_signature(*VALIDATION_SOURCES)
+        plan = read_cache("plan", path, signature)
+        if plan is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            if cached is not None and cached.sha256 == hashlib.sha256(data).hexdigest():
+                # Fichier touché sans changement de contenu : on garde le plan compilé
+                plan = replace(cached, mtime_ns=st.st_mtime_ns, size=st.st_size)
+            else:
+                logging.info("Lecture de la config depuis %s", path)
+                plan = compile_plan(path, data, st.st_mtime_ns, st.st_size)
+            write_cache("plan", path, signature, plan)
+        _PLANS[path] = plan
+        return plan
+
+
+def watch_plan(CONFIG: dict, fn: str, on_change, stop: threading.Event | None = None) -> threading.Thread | None:
+    """
+    Surveille le fichier du plan (section `reload` de config.yml) et appelle on_change()
+    quand son mtime ou sa taille change. Retourne le thread démon, ou None si la surveillance est désactivée.
+    """
+    settings = CONFIG.get("reload", {})
+    if not settings.get("watch", False):
+        return None
+    path = resolve_path(fn, CONFIG)
+    poll_s = float(settings.get("poll_s", DEFAULT_POLL_S))
+    stop = stop or threading.Event()
+
+    def signature():
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def loop(last):
+        while not stop.wait(poll_s):
+            current = signature()
+            if current is not None and current != last:
+                last = current
+                logging.info("%s modifié : rechargement du plan.", path)
+                on_change()
+
+    thread = threading.Thread(target=loop, args=(signature(),), name="drapo-plan-watch", daemon=True)
+    thread.start()
+    logging.info("Surveillance de %s (toutes les %gs).", path, poll_s)
+    return thread
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# preview.py
+"""
+Prévisualisation de l'exécution des flows, sans lancer aucun process (`drapo-run plan`, `--dry-run`).
+
+    Pour chaque flow : ordre ou dépendances des jobs, durée estimée de chaque job d'après
+    l'historique (p50 des exécutions réussies, voir drapo.history), chemin critique et heure
+    de fin attendue, en séquentiel et en parallèle.
+
+    L'estimation parallèle rejoue le flow comme run_dag : au plus `max_parallel` jobs à la fois
+    (les jobs de connexion attendent hors du pool), chaque job prêt démarre dès que ses
+    réservations tiennent dans les pools [resources], par priorité décroissante.
+    Un flow en simple liste `steps` s'exécute dans l'ordre : ses trois durées sont égales.
+    Un job sans historique compte pour 0 s et est signalé.
+"""
+
+import heapq
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+
+DEFAULT_DAYS = 30
+DEFAULT_PERCENTILE = 50
+
+
+@dataclass
+class JobEstimate:
+    name: str
+    type: str
+    depends_on: list[str]
+    duration_s: float | None      # None : aucune exécution réussie dans l'historique
+    runs: int = 0
+    start_s: float = 0.0          # début et fin simulés, relatifs au début du flow
+    end_s: float = 0.0
+    critical: bool = False
+
+
+@dataclass
+class FlowPreview:
+    name: str
+    mode: str                     # "dag" ou "steps"
+    workers: int
+    jobs: list[JobEstimate]
+    sequential_s: float
+    critical_path: list[str]
+    critical_s: float
+    parallel_s: float
+    next_run: datetime | None = None
+    timeout_s: float | None = None
+    unknown: list[str] = field(default_factory=list)
+
+
+################################################# Estimates #################################################
+def estimate_durations(CONFIG: dict, days: int = DEFAULT_DAYS, pct: float = DEFAULT_PERCENTILE) -> dict[str, tuple[float, int]]:
+    """
+    Retourne {job: (durée estimée, nombre d'exécutions)} d'après l'historique des `days` derniers jours.
+    L'historique est lu en lecture seule : la prévisualisation ne crée pas la base.
+    """
+    from drapo.history import percentile, read_job_durations
+    durations = read_job_durations(CONFIG, time.time() - days * 86400)
+    return {job: (percentile([d for _, d in runs], pct), len(runs)) for job, runs in durations.items()}
+
+
+################################################# Simulation #################################################
+def critical_path(dag: dict[str, set[str]], durations: dict[str, float]) -> tuple[list[str], float]:
+    """Plus long chemin du DAG pondéré par les durées (parallélisme illimité)."""
+    finish: dict[str, float] = {}
+    previous: dict[str, str | None] = {}
+
+    def visit(name: str) -> float:
+        if name not in finish:
+            deps = sorted(dag[name])
+            before = max(deps, key=visit, default=None)
+            previous[name] = before
+            finish[name] = (finish[before] if before else 0.0) + durations[name]
+        return finish[name]
+
+    last = max(dag, key=visit, default=None)
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[last]
+    return path[::-1], (finish[path[0]] if path else 0.0)
+
+
+def simulate(dag: dict[str, set[str]], jobs_map: dict[str, dict], durations: dict[str, float], workers: int,
+             capacities: dict[str, float] | None = None) -> dict[str, tuple[float, float]]:
+    """
+    Rejoue l'ordonnancement de run_dag : retourne {job: (début, fin)} en secondes depuis le début du flow.
+    """
+    capacities = dict(capacities or {})
+    order = {name: i for i, name in enumerate(dag)}
+    ready_at: dict[str, float] = {name: 0.0 for name, deps in dag.items() if not deps}
+    pending = {name: set(deps) for name, deps in dag.items() if deps}
+    schedule: dict[str, tuple[float, float]] = {}
+    running: list[tuple[float, int, str]] = []
+    busy = 0
+    now = 0.0
+
+    def claim(name: str) -> dict[str, float]:
+        return {pool: float(n) for pool, n in (jobs_map[name].get("resources") or {}).items()}
+
+    while ready_at or running:
+        # Les jobs prêts démarrent par priorité décroissante s'ils tiennent dans les pools
+        for name in sorted(ready_at, key=lambda n: (-int(jobs_map[n].get("priority", 0)), ready_at[n], order[n])):
+            gate = jobs_map[name]["type"] == "connection"
+            needs = claim(name)
+            if (not gate and busy >= workers) or any(capacities.get(p, n) < n for p, n in needs.items()):
+                continue
+            del ready_at[name]
+            busy += 0 if gate else 1
+            for pool, n in needs.items():
+                if pool in capacities:
+                    capacities[pool] -= n
+            schedule[name] = (now, now + durations[name])
+            heapq.heappush(running, (now + durations[name], order[name], name))
+        if not running:
+            break
+        now, _, name = heapq.heappop(running)
+        busy -= 0 if jobs_map[name]["type"] == "connection" else 1
+        for pool, n in claim(name).items():
+            if pool in capacities:
+                capacities[pool] += n
+        for other in [o for o, deps in pending.items() if name in deps]:
+            pending[other].discard(name)
+            if not pending[other]:
+                del pending[other]
+                ready_at[other] = now
+    return schedule
+
+
+def preview_flow(flow: dict, jobs_map: dict[str, dict], estimates: dict[str, tuple[float, int]],
+                 capacities: dict[str, float] | None = None, now: datetime | None = None) -> FlowPreview:
+    """Estime l'exécution d'un flow (ou d'une simple liste `steps`) sans rien lancer."""
+    from drapo.flowspec import build_dag, is_dag_flow
+    from drapo.orchestrer import DEFAULT_MAX_PARALLEL, timeout_seconds
+    steps = list(flow["steps"])
+    if is_dag_flow(steps, jobs_map):
+        mode, workers = "dag", int(flow.get("max_parallel") or DEFAULT_MAX_PARALLEL)
+        dag = build_dag(steps, jobs_map)
+    else:
+        # Liste ordonnée : chaque étape attend la précédente
+        mode, workers = "steps", 1
+        dag = {name: ({steps[i - 1]} if i else set()) for i, name in enumerate(steps)}
+
+    durations = {name: estimates.get(name, (0.0, 0))[0] for name in dag}
+    path, critical_s = critical_path(dag, durations)
+    schedule = simulate(dag, jobs_map, durations, workers, capacities if mode == "dag" else None)
+
+    jobs = []
+    for name in dag:
+        estimate, runs = estimates.get(name, (None, 0))
+        start, end = schedule.get(name, (0.0, 0.0))
+        jobs.append(JobEstimate(name, jobs_map[name]["type"], sorted(dag[name]) if mode == "dag" else [],
+                                estimate, runs, start, end, name in path))
+
+    next_run = None
+    if "schedule" in flow:
+        from drapo.flowspec import make_trigger
+        next_run = make_trigger(flow).next_after(now or datetime.now())
+    return FlowPreview(
+        name=flow["name"], mode=mode, workers=workers, jobs=jobs,
+        sequential_s=sum(durations.values()), critical_path=path, critical_s=critical_s,
+        parallel_s=max((end for _, end in schedule.values()), default=0.0),
+        next_run=next_run, timeout_s=timeout_seconds(flow),
+        unknown=[job.name for job in jobs if job.duration_s is None],
+    )
+
+
+################################################# Report #################################################
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, sec = divmod(int(round(seconds)), 60)
+    if minutes < 60:
+        return f"{minutes}m{sec:02d}s"
+    return f"{minutes // 60}h{minutes % 60:02d}m"
+
+
+def format_preview(preview: FlowPreview, now: datetime | None = None) -> str:
+    start = preview.next_run or now or datetime.now()
+    mode = f"DAG, max_parallel={preview.workers}" if preview.mode == "dag" else "steps, in order"
+    header = f"{'':2}{'job':<30} {'type':<11} {'estimate':>9} {'runs':>5} {'start':>9} {'end':>9}  depends on"
+    lines = [f"Flow {preview.name} ({mode})" + (f", next run {start:%Y-%m-%d %H:%M}" if preview.next_run else ""),
+             header, "  " + "-" * (len(header) - 2)]
+    for job in preview.jobs:
+        estimate = format_duration(job.duration_s) if job.duration_s is not None else "?"
+        lines.append(f"{'*' if job.critical else ' ':<2}{job.name:<30} {job.type:<11} {estimate:>9} {job.runs:>5} "
+                     f"{format_duration(job.start_s):>9} {format_duration(job.end_s):>9}  {', '.join(job.depends_on) or '-'}")
+
+    def ends(seconds: float) -> str:
+        return f"{format_duration(seconds)} (ends {start + timedelta(seconds=seconds):%H:%M})"
+
+    lines.append(f"  sequential    : {ends(preview.sequential_s)}")
+    lines.append(f"  critical path : {format_duration(preview.critical_s)}  ({' → '.join(preview.critical_path) or '-'})")
+    if preview.mode == "dag":
+        lines.append(f"  parallel      : {ends(preview.parallel_s)}")
+    if preview.timeout_s and max(preview.parallel_s, preview.critical_s) > preview.timeout_s:
+        lines.append(f"  warning: estimate exceeds the flow timeout ({format_duration(preview.timeout_s)})")
+    if preview.unknown:
+        lines.append(f"  no history (counted as 0s): {', '.join(preview.unknown)}")
+    return "\n".join(lines)
+
+
+def print_preview(CONFIG: dict, plan, flow_names: list[str] | None = None, days: int = DEFAULT_DAYS,
+                  pct: float = DEFAULT_PERCENTILE) -> int:
+    """Affiche la prévisualisation des flows du plan (tous si `flow_names` est vide)."""
+    flows = [plan.flow(name) for name in flow_names] if flow_names else list(plan.flows)
+    estimates = estimate_durations(CONFIG, days, pct)
+    capacities = dict(plan.config.get("resources") or {})
+    now = datetime.now()
+    print(f"Estimates: p{pct:g} of successful runs over the last {days} days. Nothing is run.")
+    for flow in flows:
+        print()
+        print(format_preview(preview_flow(flow, plan.jobs, estimates, capacities, now), now))
+    return 0
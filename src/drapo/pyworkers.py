@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# pyworkers.py
+"""
+Pool d'interpréteurs Python « chauds » pour les jobs python.
+
+    Activé par la section `python_pool` de config.yml :
+
+        python_pool:
+          enabled: true
+          preload: ["pandas", "sqlalchemy"]   # modules importés une fois par le serveur
+          size: 1                             # serveurs par interpréteur
+
+    Pour chaque interpréteur utilisé, Drapo démarre des serveurs _warm_worker.py qui préchargent
+    ces modules. Chaque script est exécuté via runpy dans un process forké depuis un serveur chaud :
+    état isolé, sortie capturée (stdout et stderr fusionnés) et code retour réel.
+    Un job peut s'en passer avec `warm = false` (script qui exige un process vierge).
+    Non disponible sous Windows (pas de fork) : les jobs y sont lancés en sous-process.
+"""
+
+import os
+import json
+import time
+import atexit
+import shutil
+import socket
+import asyncio
+import logging
+import tempfile
+import threading
+import itertools
+import subprocess
+
+from drapo.common import ENGINE, STREAM_LIMIT, RunResult, interrupted, supervise
+from drapo.sampler import ProcessUsage, sample_process
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_warm_worker.py")
+PID_MARKER = b"\x00DRAPO-PID:"
+EXIT_MARKER = b"\x00DRAPO-EXIT:"
+
+
+def supported() -> bool:
+    return os.name == "posix" and hasattr(os, "fork") and hasattr(socket, "AF_UNIX")
+
+
+class WarmWorker:
+    """Un serveur _warm_worker.py démarré avec un interpréteur donné."""
+
+    def __init__(self, interpreter: str, preload: list[str]):
+        self.interpreter = interpreter
+        self.tmpdir = tempfile.mkdtemp(prefix="drapo-warm-")
+        self.sock_path = os.path.join(self.tmpdir, "worker.sock")
+        started = time.time()
+        self.process = subprocess.Popen(
+            [interpreter, WORKER_SCRIPT, self.sock_path, json.dumps(preload)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        # Attend le "ready" du serveur ; les lignes précédentes sont des avertissements de préchargement
+        for line in self.process.stdout:
+            line = line.rstrip()
+            if line == "ready":
+                break
+            logging.warning("[warm %s] %s", os.path.basename(interpreter), line)
+        else:
+            raise RuntimeError(f"Le serveur chaud {interpreter} s'est arrêté au démarrage")
+        # Après le "ready", le pipe doit rester lu : plein, il bloquerait le serveur (et ses forks) sur un print
+        threading.Thread(target=self._drain, name=f"drapo-warm-{os.path.basename(interpreter)}", daemon=True).start()
+        logging.info("Interpréteur chaud prêt : %s (préchargé %s en %.1fs)",
+                     interpreter, ", ".join(preload) or "-", time.time() - started)
+
+    def _drain(self):
+        """Journalise la sortie du serveur jusqu'à son arrêt (avertissements, sortie émise hors d'un script)."""
+        label = os.path.basename(self.interpreter)
+        for line in self.process.stdout:
+            logging.warning("[warm %s] %s", label, line.rstrip())
+        self.process.stdout.close()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    async def run(self, script: str, args: list[str], cwd: str, name: str) -> RunResult:
+        """Exécute `script` dans un process forké du serveur et streame sa sortie vers le logger."""
+        cmd = [self.interpreter, script] + args
+        reason = interrupted()
+        if reason:
+            logging.warning("[%s] Non lancé (%s) : %s", name, reason, " ".join(cmd))
+            return RunResult.not_run(name, cmd, termination=reason)
+        logging.info("[>>>RUN>>>] [%s] (warm) : %s", name, " ".join(cmd))
+        env = os.environ.copy()
+        env["PYTHONIOENCODING"] = "utf-8"
+        request = {"script": script, "args": args, "cwd": cwd, "env": env}
+
+        started = time.time()
+        reader, writer = await asyncio.open_unix_connection(self.sock_path, limit=STREAM_LIMIT)
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+
+        extra = {"job": name}
+        state = {"pid": None, "output_bytes": 0}
+        usage = ProcessUsage()
+        watchers = []
+
+        async def stream() -> int:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    logging.error("[%s] Connexion au serveur chaud perdue avant le code retour.", name)
+                    return 1
+                if PID_MARKER in line and state["pid"] is None:
+                    state["pid"] = int(line.split(PID_MARKER, 1)[1])
+                    watchers.append(asyncio.ensure_future(sample_process(state["pid"], usage)))
+                    continue
+                if EXIT_MARKER in line:
+                    before, _, after = line.partition(EXIT_MARKER)
+                    if before:
+                        state["output_bytes"] += len(before)
+                        logging.info("[%s] %s", name, before.decode("utf-8", errors="replace").rstrip(), extra=extra)
+                    return int(after)
+                state["output_bytes"] += len(line)
+                logging.info("[%s] %s", name, line.decode("utf-8", errors="replace").rstrip(), extra=extra)
+
+        try:
+            # Le script tourne dans sa propre session (setsid) : son pid est aussi celui de son groupe
+            code, termination = await supervise(stream(), name, lambda: state["pid"])
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+            writer.close()
+        ended = time.time()
+        logging.info("[<<<END<<<] [%s] : code %d en %.1fs", name, code, ended - started)
+        result = RunResult(name=name, cmd=cmd, returncode=code, started_at=started, ended_at=ended, pid=state["pid"],
+                           output_bytes=state["output_bytes"], termination=termination)
+        result.apply_usage(usage)
+        return result
+
+    def close(self):
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class WarmPool:
+    """Serveurs chauds par interpréteur, démarrés à la demande et utilisés à tour de rôle."""
+
+    def __init__(self, preload: list[str], size: int = 1):
+        self.preload = list(preload)
+        self.size = max(1, size)
+        self._workers: dict[str, list[WarmWorker]] = {}
+        self._cycles: dict[str, itertools.cycle] = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def worker(self, interpreter: str) -> WarmWorker:
+        with self._lock:
+            workers = self._workers.get(interpreter)
+            if workers is None or not all(w.alive for w in workers):
+                for w in workers or []:
+                    w.close()
+                workers = self._workers[interpreter] = [WarmWorker(interpreter, self.preload) for _ in range(self.size)]
+                self._cycles[interpreter] = itertools.cycle(workers)
+            return next(self._cycles[interpreter])
+
+    def run(self, interpreter: str, script: str, args: list[str], cwd: str, name: str) -> RunResult:
+        worker = self.worker(interpreter)
+        return ENGINE.submit(worker.run(script, args, cwd, name)).result()
+
+    def close(self):
+        with self._lock:
+            for workers in self._workers.values():
+                for w in workers:
+                    w.close()
+            self._workers.clear()
+
+
+_POOL: WarmPool | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool(CONFIG: dict) -> WarmPool | None:
+    """Pool d'interpréteurs chauds si `python_pool.enabled` est vrai et la plateforme le permet."""
+    global _POOL
+    settings = CONFIG.get("python_pool", {})
+    if not settings.get("enabled") or not supported():
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = WarmPool(settings.get("preload", []), settings.get("size", 1))
+        return _POOL
+
+
+def run_warm(CONFIG: dict, interpreter: str, script: str, args: list[str], cwd: str, name: str) -> RunResult | None:
+    """
+    Exécute le script dans le pool chaud ; retourne None si le pool est désactivé ou si le serveur
+    ne peut pas démarrer (l'appelant lance alors un sous-process classique).
+    """
+    pool = get_pool(CONFIG)
+    if pool is None:
+        return None
+    try:
+        return pool.run(interpreter, script, args, cwd, name)
+    except (OSError, RuntimeError) as e:
+        logging.warning("Pool chaud indisponible pour %s (%s) : exécution en sous-process.", interpreter, e)
+        return None
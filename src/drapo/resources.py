@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# resources.py
+"""
+Pools de ressources nommés partagés par tous les flows du process Drapo.
+
+    Les capacités sont déclarées dans le TOML d'orchestration, les jobs réservent des unités :
+
+        [resources]
+        warehouse = 2        # connexions simultanées à l'entrepôt
+        memory_gb = 12       # mémoire que les jobs lourds peuvent se partager
+
+        [[jobs]]
+        name = "dbt_build"
+        type = "dbt"
+        resources = { warehouse = 1 }
+        priority = 10        # les jobs en attente sont servis par priorité décroissante (0 par défaut)
+
+    Un job attend que toutes ses réservations soient disponibles avant de démarrer, puis les rend
+    à la fin. Les jobs plus prioritaires gardent leur place : un job moins prioritaire ne passe devant
+    que s'il tient dans ce qui reste une fois les besoins des jobs plus prioritaires réservés.
+"""
+
+import time
+import logging
+import threading
+from itertools import count
+from contextlib import contextmanager
+
+from drapo.common import interrupted, remaining_time
+from drapo.metrics import QUEUE_WAIT, register_gauge
+
+
+# Période de vérification des timeouts et annulations pendant l'attente
+WAIT_POLL_S = 1.0
+
+
+class Waiter:
+    """Une demande de ressources en attente."""
+
+    def __init__(self, name: str, claim: dict[str, float], priority: int, seq: int):
+        self.name = name
+        self.claim = claim
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+
+    @property
+    def order(self) -> tuple[int, int]:
+        return (-self.priority, self.seq)
+
+
+class ResourcePools:
+    """Capacités nommées et file d'attente par priorité des jobs qui les réservent."""
+
+    def __init__(self, capacities: dict[str, float] | None = None):
+        self._cond = threading.Condition()
+        self._seq = count()
+        self.capacity: dict[str, float] = {}
+        self.in_use: dict[str, float] = {}
+        self._waiters: list[Waiter] = []
+        self.configure(capacities or {})
+
+    def configure(self, capacities: dict[str, float]):
+        """
+        Remplace les capacités (chargement ou rechargement du TOML). Les réservations en cours
+        sont conservées ; un pool retiré n'accepte plus de nouvelle réservation.
+        """
+        for pool, value in capacities.items():
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"Capacité invalide pour la ressource '{pool}' : {value!r}")
+        with self._cond:
+            self.capacity = {pool: float(value) for pool, value in capacities.items()}
+            for pool in self.capacity:
+                self.in_use.setdefault(pool, 0.0)
+            self._grant()
+            self._cond.notify_all()
+
+    def validate(self, name: str, claim: dict[str, float]):
+        """Lève ValueError si la réservation vise un pool inconnu ou dépasse sa capacité."""
+        for pool, amount in claim.items():
+            if pool not in self.capacity:
+                raise ValueError(f"Job '{name}' : ressource inconnue '{pool}'")
+            if amount > self.capacity[pool]:
+                raise ValueError(f"Job '{name}' : {pool}={amount:g} dépasse la capacité du pool ({self.capacity[pool]:g})")
+
+    def _fits(self, claim: dict[str, float], free: dict[str, float]) -> bool:
+        return all(amount <= free.get(pool, 0.0) for pool, amount in claim.items())
+
+    def _grant(self):
+        """Attribue les ressources aux demandes en attente, par priorité (appelé sous le verrou)."""
+        free = {pool: self.capacity.get(pool, 0.0) - used for pool, used in self.in_use.items()}
+        for waiter in sorted(self._waiters, key=lambda w: w.order):
+            if self._fits(waiter.claim, free):
+                waiter.granted = True
+                for pool, amount in waiter.claim.items():
+                    self.in_use[pool] += amount
+            # Servie ou non, la demande retient sa part : les moins prioritaires ne passent pas devant
+            for pool, amount in waiter.claim.items():
+                free[pool] = free.get(pool, 0.0) - amount
+        self._waiters = [w for w in self._waiters if not w.granted]
+
+    def request(self, name: str, claim: dict[str, float], priority: int = 0) -> Waiter | None:
+        """
+        Dépose une demande sans attendre : `waiter.granted` passe à True quand elle est servie
+        (à rendre avec release, ou withdraw tant qu'elle attend). None si le claim est vide.
+        Lève ValueError si la réservation est invalide.
+        """
+        claim = {pool: float(amount) for pool, amount in claim.items() if amount}
+        if not claim:
+            return None
+        with self._cond:
+            self.validate(name, claim)
+            waiter = Waiter(name, claim, priority, next(self._seq))
+            self._waiters.append(waiter)
+            self._grant()
+            return waiter
+
+    def withdraw(self, waiter: Waiter):
+        """Retire une demande en attente (ou rend ses ressources si elle a été servie entre-temps)."""
+        with self._cond:
+            if waiter.granted:
+                self.release(waiter.claim)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._grant()
+                self._cond.notify_all()
+
+    def wait_granted(self, waiters: list[Waiter], timeout: float | None) -> bool:
+        """Attend qu'une des demandes soit servie (au plus `timeout` secondes)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: any(w.granted for w in waiters), timeout)
+
+    def acquire(self, name: str, claim: dict[str, float], priority: int = 0) -> str | None:
+        """
+        Bloque jusqu'à l'obtention de toutes les ressources de `claim`.
+        Retourne None une fois servi, ou la raison de l'abandon ("timed_out", "cancelled").
+        """
+        with self._cond:
+            waiter = self.request(name, claim, priority)
+            if waiter is None:
+                return None
+            if not waiter.granted:
+                logging.info("Job %s en attente de ressources (%s, priorité %d).", name,
+                             ", ".join(f"{p}={a:g}" for p, a in waiter.claim.items()), priority)
+            started = time.monotonic()
+            while not waiter.granted:
+                reason = interrupted()
+                if reason:
+                    self.withdraw(waiter)
+                    return reason
+                remaining = remaining_time()
+                self._cond.wait(WAIT_POLL_S if remaining is None else max(0.0, min(WAIT_POLL_S, remaining)))
+            waited = time.monotonic() - started
+            QUEUE_WAIT.observe(waited, job=name, queue="resources")
+            if waited >= WAIT_POLL_S:
+                logging.info("Job %s : ressources obtenues après %.1fs d'attente.", name, waited)
+        return None
+
+    def release(self, claim: dict[str, float]):
+        with self._cond:
+            for pool, amount in claim.items():
+                if amount:
+                    self.in_use[pool] = max(0.0, self.in_use.get(pool, 0.0) - float(amount))
+            self._grant()
+            self._cond.notify_all()
+
+    @contextmanager
+    def claim(self, job: dict, held: bool = False):
+        """
+        Réserve les ressources déclarées par le job (`resources`, `priority`) pendant le bloc.
+        Produit None, ou le statut du job s'il n'a pas pu obtenir ses ressources
+        ("failed" pour une réservation invalide, "timed_out", "cancelled").
+        Avec held, les ressources ont déjà été obtenues par l'appelant (request), qui les rendra.
+        """
+        claim = job.get("resources") or {}
+        if not claim or held:
+            yield None
+            return
+        try:
+            reason = self.acquire(job["name"], claim, int(job.get("priority", 0)))
+        except ValueError as e:
+            logging.error("%s", e)
+            reason = "failed"
+        if reason:
+            yield reason
+            return
+        try:
+            yield None
+        finally:
+            self.release(claim)
+
+    def snapshot(self) -> dict[str, tuple[float, float]]:
+        """{pool: (utilisé, capacité)}"""
+        with self._cond:
+            return {pool: (self.in_use.get(pool, 0.0), cap) for pool, cap in self.capacity.items()}
+
+
+POOLS = ResourcePools()
+register_gauge("drapo_resource_in_use", "Unités réservées par pool de ressources.",
+               lambda: [({"pool": pool}, used) for pool, (used, _) in POOLS.snapshot().items()])
+register_gauge("drapo_resource_capacity", "Capacité des pools de ressources.",
+               lambda: [({"pool": pool}, cap) for pool, (_, cap) in POOLS.snapshot().items()])
+
+
+def configure_resources(flowconfig: dict):
+    """Applique la section [resources] du TOML d'orchestration aux pools partagés."""
+    capacities = flowconfig.get("resources", {})
+    POOLS.configure(capacities)
+    if capacities:
+        logging.info("Pools de ressources : %s", ", ".join(f"{p}={c:g}" for p, c in capacities.items()))
@@ -1,29 +1,55 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
-import subprocess 
+import json
+import time
 import socket
+import hashlib
 import logging
-from drapo.utils import resolve_path
-from drapo.common import stream_subprocess
+from drapo.utils import git_repo_dir, resolve_path
+from drapo import dbt_state, dbt_inprocess, dbt_shards, pyworkers
+from drapo.cache import get_cache, file_digest
+from drapo.common import RunResult, combine_results, run_output, run_subprocess
 
 
 ################################################# Runner dbt #################################################
 """
 Module pour exécuter des commandes dbt.
 """
-def run_dbt_command(CONFIG: dict, cmd: list[str], working_dir: str = None):
+def run_dbt_command(CONFIG: dict, cmd: list[str], working_dir: str = None, name: str = "dbt",
+                    dry_run: bool = False, state_aware: bool = False, mode: str = "subprocess",
+                    session: str | None = None, shard_by: str | None = None,
+                    max_shards: int = dbt_shards.DEFAULT_MAX_SHARDS) -> RunResult:
     """
     Exécute la commande dbt depuis working_dir (ou BASE_DIR si non fourni).
+    Avec state_aware, seuls les modèles modifiés depuis le dernier succès sont construits
+    (voir drapo.dbt_state).
+    Avec mode="inprocess", la commande est exécutée par le worker dbt persistant de la session
+    (une session par exécution de flow, voir drapo.dbt_inprocess).
+    Avec shard_by ("components" ou "tags"), la sélection est découpée en invocations dbt
+    parallèles, au plus max_shards à la fois (voir drapo.dbt_shards).
+    Retourne le RunResult de dbt (code de sortie et durée).
     """
     # s'il n'y a pas de working_dir ou s'il est vide, on utilise BASE_DIR
     wd = resolve_path("${dbt}", CONFIG)
     logging.info("–> dbt working directory : %s", wd)
-    exit_code = stream_subprocess(cmd, cwd=wd)
-    if exit_code == 0:
-        logging.info("✅ tâche dbt terminée.")
+    run_cmd = dbt_state.prepare_command(CONFIG, name, cmd) if state_aware else cmd
+    result = None
+    if shard_by and not dry_run:
+        if mode == "inprocess":
+            logging.info("dbt sharding : les shards sont des sous-process, mode inprocess ignoré.")
+        result = dbt_shards.run_sharded(run_cmd, wd, name, shard_by, max_shards)
+    if mode == "inprocess" and result is None and not dry_run:
+        result = dbt_inprocess.run_inprocess(run_cmd, wd, name, session)
+    if result is None:
+        result = run_subprocess(run_cmd, cwd=wd, name=name, dry_run=dry_run)
+    if result.ok:
+        logging.info("✅ tâche dbt terminée en %.1fs.", result.duration)
+        if state_aware and not dry_run:
+            dbt_state.save_state(CONFIG, name, run_cmd, wd, source_dir=result.extra.get("target_path"))
     else:
-        logging.error("❌ tâche dbt a échoué (code %d).", exit_code)
+        logging.error("❌ tâche dbt a échoué (code %d).", result.returncode)
+    return result
 
 ################################################# Runner dependencies_installer #################################################
 """
@@ -33,78 +59,232 @@ Module pour vérifier et installer les dépendances du projet parent orchestré
 # If the script is run in a virtual environment, it will install the dependencies in the virtual environment.
 # If the script is run in a Docker container, it will install the dependencies in the container.
 # If the script is run in a GitHub Actions workflow, it will install the dependencies in the workflow.
-def install_dependencies(CONFIG: dict):
+def install_dependencies(CONFIG: dict, name: str = "dependencies", python_interpreter: str | None = None,
+                         dry_run: bool = False) -> RunResult:
     """
-    Installe les dépendances définies dans le fichier de requirements pointé par config.yml
+    Installe les dépendances définies dans le fichier de requirements pointé par config.yml.
+    L'installation est sautée si le fichier (et les fichiers qu'il inclut via -r/-c) et la version
+    de l'interpréteur n'ont pas changé depuis la dernière installation réussie.
+    Si le chemin `wheelhouse` est configuré, pip l'utilise d'abord hors ligne (--no-index), puis
+    le complète après une installation en ligne.
+    Retourne le RunResult de l'installation.
     """
-    
-
-    req_path = resolve_path("${requirements}", CONFIG)
+    interp = python_interpreter or sys.executable
+    req_path = resolve_path("${project_requirements}", CONFIG)
 
     if not os.path.exists(req_path):
-        print(f"Le fichier requirements.txt n'existe pas : {req_path}")
-        sys.exit(1)
+        logging.error("Le fichier requirements.txt n'existe pas : %s", req_path)
+        return RunResult.not_run(name)
 
-    # Exécute pip install -r
-    cmd = [sys.executable, "-m", "pip", "install", "-r", req_path]
+    # 1) Empreinte : contenu des requirements + version de l'interpréteur
+    cache = get_cache(CONFIG)
+    cache_key = f"dependencies:{interp}:{req_path}"
+    fingerprint = requirements_fingerprint(req_path, interp, name)
+    if cache is not None and fingerprint and not dry_run and cache.hit(cache_key, fingerprint):
+        logging.info("♻️ Requirements inchangés depuis la dernière installation (%s), pip install sauté.", req_path)
+        return RunResult.not_run(name, returncode=0)
 
-    print(f"Installation des dépendances depuis {req_path} ...")
+    # 2) Installation, depuis le wheelhouse local si possible
+    logging.info("Installation des dépendances depuis %s ...", req_path)
     try:
-        subprocess.run(cmd, check=True)
-        print("✅ Dépendances installées avec succès.")
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Erreur lors de l'installation des dépendances: {e}")
-        sys.exit(1)
+        wheelhouse = resolve_path("${wheelhouse}", CONFIG)
+    except ValueError:
+        wheelhouse = None
+    pip = [interp, "-m", "pip"]
+    results = []
+    if wheelhouse and os.path.isdir(wheelhouse) and os.listdir(wheelhouse):
+        results.append(run_subprocess(pip + ["install", "--no-index", "--find-links", wheelhouse, "-r", req_path],
+                                      name=name, dry_run=dry_run))
+        if not results[-1].ok:
+            logging.warning("Wheelhouse incomplet (%s), installation depuis l'index.", wheelhouse)
+    if not results or not results[-1].ok:
+        find_links = ["--find-links", wheelhouse] if wheelhouse and os.path.isdir(wheelhouse) else []
+        results.append(run_subprocess(pip + ["install", *find_links, "-r", req_path], name=name, dry_run=dry_run))
+        # Complète le wheelhouse pour les prochaines réinstallations hors ligne
+        if results[-1].ok and wheelhouse and not dry_run:
+            os.makedirs(wheelhouse, exist_ok=True)
+            refresh = run_subprocess(pip + ["wheel", "-r", req_path, "-w", wheelhouse, "--find-links", wheelhouse],
+                                     name=name)
+            if not refresh.ok:
+                logging.warning("Mise à jour du wheelhouse %s impossible (code %d).", wheelhouse, refresh.returncode)
+
+    # Durée et sortie de toutes les tentatives, code retour de la dernière
+    result = combine_results(name, results)
+    result.returncode = results[-1].returncode
+    if result.ok:
+        logging.info("✅ Dépendances installées avec succès en %.1fs.", result.duration)
+        if cache is not None and fingerprint and not dry_run:
+            cache.put(cache_key, fingerprint)
+    else:
+        logging.error("❌ Erreur lors de l'installation des dépendances (code %d).", result.returncode)
+    return result
+
+
+def requirements_files(req_path: str, seen: set[str] | None = None) -> list[str]:
+    """Le fichier de requirements et, récursivement, ceux qu'il inclut (-r / -c)."""
+    seen = seen if seen is not None else set()
+    req_path = os.path.abspath(req_path)
+    if req_path in seen or not os.path.isfile(req_path):
+        return []
+    seen.add(req_path)
+    files = [req_path]
+    with open(req_path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.split("#", 1)[0].split()
+            if len(parts) >= 2 and parts[0] in ("-r", "--requirement", "-c", "--constraint"):
+                included = os.path.join(os.path.dirname(req_path), parts[1])
+                files += requirements_files(included, seen)
+    return files
+
+
+def requirements_fingerprint(req_path: str, interp: str, name: str = "dependencies") -> str | None:
+    """
+    Empreinte des fichiers de requirements et de la version de l'interpréteur (None si indisponible).
+    La version d'un autre interpréteur est lue par le moteur : bornée par l'échéance du job, annulable.
+    """
+    if os.path.abspath(interp) == os.path.abspath(sys.executable):
+        version = sys.version
+    else:
+        try:
+            result, out = run_output([interp, "-c", "import sys; print(sys.version)"], name=name, timeout_s=30)
+        except OSError:
+            return None
+        if not result.ok:
+            return None
+        version = out.strip()
+    h = hashlib.sha256(f"{interp}\n{version}\n".encode())
+    for path in requirements_files(req_path):
+        h.update(f"{path}:{file_digest(path)}\n".encode())
+    return h.hexdigest()
 
 ################################################# Runner git #################################################
 """
 Module pour exécuter des commandes git.
 """
-def update_git_repo(CONFIG: dict,repo_dir: str, branch: str):    
+def update_git_repo(CONFIG: dict,repo_dir: str, branch: str, name: str = "git", dry_run: bool = False,
+                    sync: str = "reset", depth: int | None = None, fetch_filter: str | None = None):
     """
     Update the git repository in repo_dir to the specified branch.
     On Windows, this function does not update the repository and returns immediately.
-    On other platforms, it performs 'git fetch' and 'git reset --hard origin/branch'.
+    On other platforms, it first compares the remote branch (git ls-remote) with the local HEAD and
+    does nothing if they match. Otherwise it performs a 'git fetch' of the branch (shallow or partial
+    only when depth / fetch_filter are set) and either 'git reset --hard FETCH_HEAD' (sync="reset")
+    or 'git merge --ff-only FETCH_HEAD' (sync="ff").
+    The resulting commit is recorded in <drapostate>/git_head.json and returned in extra["commit"].
     Args : 
         repo_dir (str): Path to the git repository directory.
         branch (str): The branch to update to.
+        sync (str): "reset" (default) or "ff".
+        depth (int): Fetch depth (opt-in shallow fetch); full history by default, so an existing
+            full clone is never made shallow.
+        fetch_filter (str): Partial clone filter passed to git fetch, e.g. "blob:none".
     Returns:
-        None if on Windows, otherwise the exit code of the git command.
+        None if on Windows, otherwise the RunResult of the git commands (extra["commit"] is the new HEAD).
     Raises:
         RuntimeError: If the git command fails.
     """
-    rd = resolve_path("${git}", CONFIG)
+    rd = git_repo_dir(CONFIG)
     logging.info("→ Updating Git repo in %s to branch %s", rd, branch)
-    cmds = [
-        ["git", "fetch", "origin", branch],
-        # Optionally add more git commands here if needed
-    ]
-    # Option B: just git pull 
-    # cmds = [["git", "pull", "origin", branch]]
+    if sync not in ("reset", "ff"):
+        raise ValueError(f"sync git inconnu : {sync} (attendu: reset ou ff)")
     if os.name == "nt":
         logging.info("On Windows: skipping git pull in development mode.")
         return None  # On Windows in development mode, do not fetch repo content!
-    else:
-        for cmd in cmds:
-            code = stream_subprocess(cmd, cwd=rd)
-            if code != 0:
-                logging.error("Git command %s failed with code %d", cmd, code)
-                # Raising RuntimeError will stop the flow execution for this job.
-                raise RuntimeError("Git update failed")
-        logging.info("✅ Git repo is now up-to-date on %s", branch)
-    logging.info("✅ Git repo is now up-to-date on %s", branch)
+
+    # 1) Skip if the remote branch did not move
+    local = _git_output(["rev-parse", "HEAD"], rd)
+    remote = _git_output(["ls-remote", "origin", f"refs/heads/{branch}"], rd)
+    remote = remote.split()[0] if remote else None
+    if remote is None:
+        logging.warning("Branche distante %s introuvable via ls-remote, fetch sans comparaison préalable.", branch)
+    elif remote == local:
+        logging.info("✅ Git repo already up-to-date on %s (%s), nothing to fetch.", branch, local[:12])
+        _record_git_head(CONFIG, rd, branch, local)
+        result = RunResult.not_run(name, returncode=0)
+        result.extra["commit"] = local
+        return result
+
+    # 2) Fetch (shallow/partial only on request) then update the worktree
+    fetch = ["git", "fetch", "--no-tags"]
+    if depth:
+        fetch.append(f"--depth={depth}")
+    if fetch_filter:
+        fetch.append(f"--filter={fetch_filter}")
+    cmds = [
+        fetch + ["origin", branch],
+        ["git", "reset", "--hard", "FETCH_HEAD"] if sync == "reset" else ["git", "merge", "--ff-only", "FETCH_HEAD"],
+    ]
+    results = []
+    for cmd in cmds:
+        result = run_subprocess(cmd, cwd=rd, name=name, dry_run=dry_run)
+        results.append(result)
+        if not result.ok:
+            logging.error("Git command %s failed with code %d", cmd, result.returncode)
+            # Raising RuntimeError will stop the flow execution for this job.
+            raise RuntimeError("Git update failed")
+
+    result = combine_results(name, results)
+    if not dry_run:
+        commit = _git_output(["rev-parse", "HEAD"], rd)
+        _record_git_head(CONFIG, rd, branch, commit)
+        result.extra["commit"] = commit
+        logging.info("✅ Git repo is now up-to-date on %s (%s → %s)", branch, (local or "?")[:12], (commit or "?")[:12])
+    return result
+
+
+def _git_output(args: list[str], cwd: str, timeout: float = 60) -> str | None:
+    """
+    Sortie d'une commande git courte (rev-parse, ls-remote), ou None en cas d'échec.
+    Bornée par `timeout` et par l'échéance du job ; une annulation arrête la commande.
+    """
+    try:
+        result, out = run_output(["git", *args], cwd=cwd, name="git", timeout_s=timeout)
+    except OSError as e:
+        logging.warning("git %s impossible : %s", " ".join(args), e)
+        return None
+    if not result.ok:
+        logging.warning("git %s a échoué (%s) : %s", " ".join(args), result.termination or f"code {result.returncode}",
+                        result.extra.get("stderr", "").strip())
+        return None
+    return out.strip()
+
+
+def _record_git_head(CONFIG: dict, repo: str, branch: str, commit: str | None):
+    """Enregistre le commit courant du dépôt pour les jobs et caches suivants."""
+    if not commit:
+        return
+    try:
+        state = resolve_path("${drapostate}", CONFIG)
+    except ValueError:
+        return
+    os.makedirs(state, exist_ok=True)
+    tmp = os.path.join(state, "git_head.json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"repo": repo, "branch": branch, "commit": commit, "updated_at": time.time()}, f)
+    os.replace(tmp, os.path.join(state, "git_head.json"))
 
 ################################################# Runner python #################################################
 """
 Module pour exécuter des scripts python.
 """
-def run_python_script(CONFIG: dict,python_interpreter: str, script_path: str, args: str = ""):
+PROFILERS = ("cprofile", "tracemalloc")
+PROFILE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_profile_script.py")
+
+
+def run_python_script(CONFIG: dict,python_interpreter: str, script_path: str, args: str = "", name: str = "python",
+                      dry_run: bool = False, warm: bool = True, profile: list[str] | None = None,
+                      artifacts_prefix: str | None = None) -> RunResult:
     """
     Exécute un script Python via l'interpréteur donné,
     avec fallback sur sys.executable si le chemin n'est pas valide.
+    Si le pool d'interpréteurs chauds est activé (python_pool dans config.yml) et que warm est vrai,
+    le script est exécuté dans un process forké d'un interpréteur préchargé (voir drapo.pyworkers).
+    Avec `profile` ("cprofile", "tracemalloc"), le script est lancé en sous-process sous profilage
+    et les rapports sont écrits à côté du log du job (<artifacts_prefix>.prof, .tracemalloc.txt).
+    Retourne le RunResult du script (code de sortie et durée).
     """
     # 1) Résolution et vérification de l'interpréteur
-    interp = resolve_path("${python_interpreter}", CONFIG)
+    interp = python_interpreter or resolve_path("${python_interpreter}", CONFIG)
     if not os.path.isfile(interp):
         logging.warning(
             "Interpreter introuvable (%s), fallback vers %s",
@@ -113,29 +293,52 @@ def run_python_script(CONFIG: dict,python_interpreter: str, script_path: str, ar
         interp = sys.executable
 
     # 2) Résolution et vérification du script
-    script = resolve_path("${python_scripts}", CONFIG)
+    script = resolve_path(script_path, CONFIG)
     if not script.endswith(".py"):
         logging.error("Le script doit être un fichier Python (.py) : %s", script)
-        return
+        return RunResult.not_run(name)
     if not os.path.isfile(script):
         logging.error("Script Python introuvable : %s", script)
-        return
+        return RunResult.not_run(name)
 
     # 3) Exécution en streaming avec passage des arguments
-    if args:
-        cmd = [interp, script] + args.split()
-    else:
-        cmd = [interp, script]
-    exit_code = stream_subprocess(
-        cmd,
-        cwd=os.path.dirname(script)
-    )
+    script_args = args.split() if args else []
+    cmd = [interp, script] + script_args
+    artifacts = {}
+    unknown = [p for p in profile or [] if p not in PROFILERS]
+    if unknown:
+        logging.warning("Profilage inconnu ignoré : %s (%s)", ", ".join(unknown), ", ".join(PROFILERS))
+    if artifacts_prefix and profile:
+        os.makedirs(os.path.dirname(artifacts_prefix), exist_ok=True)
+        if "cprofile" in profile:
+            artifacts["cprofile"] = artifacts_prefix + ".prof"
+        if "tracemalloc" in profile:
+            artifacts["tracemalloc"] = artifacts_prefix + ".tracemalloc.txt"
+    if artifacts:
+        options = [arg for kind, path in artifacts.items() for arg in (f"--{kind}", path)]
+        cmd = [interp, PROFILE_SCRIPT, *options, "--", script] + script_args
+
+    result = None
+    if warm and not dry_run and not artifacts:
+        result = pyworkers.run_warm(CONFIG, interp, script, script_args, cwd=os.path.dirname(script), name=name)
+    if result is None:
+        result = run_subprocess(
+            cmd,
+            cwd=os.path.dirname(script),
+            name=name,
+            dry_run=dry_run
+        )
+    for kind, path in artifacts.items():
+        if os.path.isfile(path):
+            result.extra.setdefault("artifacts", []).append(path)
+            logging.info("Rapport %s du job %s : %s", kind, name, path)
 
     # 4) Log du résultat
-    if exit_code == 0:
-        logging.info("✅ Script Python exécuté avec succès.")
+    if result.ok:
+        logging.info("✅ Script Python exécuté avec succès en %.1fs.", result.duration)
     else:
-        logging.error("❌ Échec du script Python (code %d).", exit_code)
+        logging.error("❌ Échec du script Python (code %d).", result.returncode)
+    return result
 
 ################################################# Runner test reachable #################################################
 """
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# sampler.py
+"""
+Relevé des ressources consommées par les process enfants des jobs, lu dans /proc (Linux).
+
+    Pendant l'exécution de chaque process lancé par les runners, un échantillonneur relève
+    périodiquement son temps CPU (y compris celui de ses enfants terminés), son pic de mémoire
+    résidente (VmHWM), ses octets lus et écrits (rchar/wchar : disque, pipes et sockets)
+    et son nombre de threads. Réglé par la section `sampling` de config.yml :
+
+        sampling:
+          enabled: true
+          interval_s: 0.5
+
+    Sur une plateforme sans /proc, les champs restent vides. Le rapport par flow
+    (format_usage_table) liste les jobs les plus coûteux à la fin de chaque flow.
+"""
+
+import os
+import asyncio
+from dataclasses import dataclass
+
+
+DEFAULT_INTERVAL_S = 0.5
+SETTINGS = {"enabled": True, "interval_s": DEFAULT_INTERVAL_S}
+try:
+    CLK_TCK = os.sysconf("SC_CLK_TCK")
+except (AttributeError, ValueError, OSError):
+    CLK_TCK = 100
+
+
+def configure_sampler(settings: dict):
+    """Applique la section `sampling` de config.yml."""
+    SETTINGS["enabled"] = bool(settings.get("enabled", True))
+    SETTINGS["interval_s"] = float(settings.get("interval_s", DEFAULT_INTERVAL_S))
+
+
+@dataclass
+class ProcessUsage:
+    """Ressources consommées par un process (dernier relevé ; maxima pour la mémoire et les threads)."""
+    cpu_s: float = 0.0
+    peak_rss_kb: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    max_threads: int = 0
+
+    def update(self, sample: "ProcessUsage"):
+        # CPU et I/O sont cumulatifs : le dernier relevé fait foi
+        self.cpu_s = max(self.cpu_s, sample.cpu_s)
+        self.read_bytes = max(self.read_bytes, sample.read_bytes)
+        self.write_bytes = max(self.write_bytes, sample.write_bytes)
+        self.peak_rss_kb = max(self.peak_rss_kb, sample.peak_rss_kb)
+        self.max_threads = max(self.max_threads, sample.max_threads)
+
+    def since(self, before: "ProcessUsage") -> "ProcessUsage":
+        """Consommation depuis `before` pour un process persistant (ex: worker dbt)."""
+        return ProcessUsage(
+            cpu_s=max(0.0, self.cpu_s - before.cpu_s),
+            peak_rss_kb=self.peak_rss_kb,
+            read_bytes=max(0, self.read_bytes - before.read_bytes),
+            write_bytes=max(0, self.write_bytes - before.write_bytes),
+            max_threads=self.max_threads,
+        )
+
+
+def read_process_usage(pid: int) -> ProcessUsage | None:
+    """Relevé instantané dans /proc/<pid> ; None si le process n'existe plus ou sans /proc."""
+    usage = ProcessUsage()
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            # Le nom du process (2e champ) peut contenir des espaces : on découpe après la parenthèse fermante
+            fields = f.read().rpartition(b")")[2].split()
+        # utime, stime, cutime, cstime (champs 14 à 17) puis num_threads (champ 20)
+        usage.cpu_s = sum(int(v) for v in fields[11:15]) / CLK_TCK
+        usage.max_threads = int(fields[17])
+        with open(f"/proc/{pid}/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"VmHWM:"):
+                    usage.peak_rss_kb = int(line.split()[1])
+                    break
+    except (OSError, ValueError, IndexError):
+        return None
+    try:
+        with open(f"/proc/{pid}/io", "rb") as f:
+            for line in f:
+                key, _, value = line.partition(b":")
+                if key == b"rchar":
+                    usage.read_bytes = int(value)
+                elif key == b"wchar":
+                    usage.write_bytes = int(value)
+    except (OSError, ValueError):
+        # /proc/<pid>/io peut être interdit (autre utilisateur, conteneur restreint)
+        pass
+    return usage
+
+
+async def sample_process(pid: int, usage: ProcessUsage):
+    """Relève périodiquement l'usage du process tant qu'il tourne (tâche annulée à sa fin)."""
+    if not SETTINGS["enabled"]:
+        return
+    while True:
+        sample = read_process_usage(pid)
+        if sample is not None:
+            usage.update(sample)
+        await asyncio.sleep(SETTINGS["interval_s"])
+
+
+def _human_bytes(value: int | None) -> str:
+    if not value:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024:
+            return f"{value:.0f}{unit}"
+        value /= 1024
+    return f"{value:.1f}TB"
+
+
+def format_usage_table(rows: list[dict], limit: int = 10) -> str:
+    """
+    Tableau des jobs les plus coûteux d'un flow (triés par durée).
+    Chaque ligne : job, status, duration, cpu_s, peak_rss_kb, io_read_bytes, io_write_bytes, max_threads.
+    """
+    rows = sorted(rows, key=lambda r: r.get("duration") or 0.0, reverse=True)[:limit]
+    header = f"{'job':<30} {'status':<10} {'durée':>8} {'cpu':>8} {'cpu%':>5} {'rss max':>8} {'lu':>8} {'écrit':>8} {'thr':>4}"
+    lines = [header, "-" * len(header)]
+    for r in rows:
+        duration = r.get("duration") or 0.0
+        cpu = r.get("cpu_s")
+        lines.append(
+            f"{r['job'][:30]:<30} {r['status'][:10]:<10} {duration:>7.1f}s "
+            f"{(f'{cpu:.1f}s' if cpu is not None else '-'):>8} "
+            f"{(f'{100 * cpu / duration:.0f}' if cpu is not None and duration > 0 else '-'):>5} "
+            f"{_human_bytes((r.get('peak_rss_kb') or 0) * 1024):>8} "
+            f"{_human_bytes(r.get('io_read_bytes')):>8} {_human_bytes(r.get('io_write_bytes')):>8} "
+            f"{r.get('max_threads') or '-':>4}"
+        )
+    return "\n".join(lines)
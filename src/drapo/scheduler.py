@@ -3,50 +3,207 @@
 """
 Module pour programmer des tâches planifiées dans Drapo.
 schedule_jobs est utilisé pour planifier des flux de travail basés sur la configuration fournie.
-    Il utilise la bibliothèque `schedule` pour gérer les tâches planifiées.
+    Les prochaines exécutions sont rangées dans un tas (heapq) par SchedulerEngine, qui dort
+    exactement jusqu'à la plus proche au lieu de sonder toutes les 60 secondes.
+    Chaque flow déclenché tourne dans son propre thread : un flow long ne retarde pas les autres.
+    Un flow encore en cours à son trigger suivant suit sa politique `overlap` (voir drapo.overlap).
+    Types supportés : daily_at, hourly_at, minute_at et cron (expression cron à 5 champs).
     Paramètres:
-        config (dict): Configuration des tâches à planifier, incluant les flux de travail et leurs horaires (fourni par ).
+        CONFIG (dict): Configuration Drapo (config.yml).
+        plan (drapo.plan.Plan): Plan d'orchestration compilé (jobs et flows avec leurs horaires).
     Retourne:
-        None
+        Le nombre de flows planifiés.
 """
 
+import heapq
+import signal
 import logging
-import schedule
-from drapo.orchestrer import run_flow
+import threading
+import time
+from datetime import datetime
+from itertools import count
 
+from drapo.common import request_cancel
+from drapo.metrics import SCHEDULER_LAG
+from drapo.orchestrer import run_flow, timeout_seconds
+from drapo.overlap import guard_for_flow
+from drapo.flowspec import CronTrigger, DailyAt, HourlyAt, MinuteAt, Trigger, make_trigger
+
+
+# Durée max d'une attente : permet de se recaler si l'horloge système est modifiée (NTP, heure d'été)
+MAX_WAIT_S = 3600
+
+
+################################################# Engine #################################################
+class ScheduledEntry:
+    def __init__(self, name: str, trigger: Trigger, callback):
+        self.name = name
+        self.trigger = trigger
+        self.callback = callback
+
+
+class SchedulerEngine:
+    """
+    Boucle de planification événementielle.
+    Les prochaines exécutions sont rangées dans un tas ; la boucle dort jusqu'à la plus proche,
+    et se réveille immédiatement sur un nouveau trigger, un SIGHUP (rechargement) ou un arrêt.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, ScheduledEntry]] = []
+        self._seq = count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._reload_requested = False
+        self._on_reload = None
+        self._workers: set[threading.Thread] = set()
+
+    # ---- registration ----
+    def add(self, name: str, trigger: Trigger, callback, now: datetime | None = None):
+        """Planifie `callback` selon `trigger` ; réveille la boucle si l'échéance devient la plus proche."""
+        entry = ScheduledEntry(name, trigger, callback)
+        with self._cond:
+            self._push(entry, trigger.next_after(now or datetime.now()))
+            self._cond.notify()
+        return entry
+
+    def trigger_now(self, name: str) -> bool:
+        """Déclenche immédiatement un flow déjà planifié, sans modifier son planning."""
+        with self._cond:
+            for _, _, entry in self._heap:
+                if entry.name == name:
+                    self._launch(entry, time.time())
+                    return True
+        return False
+
+    def clear(self):
+        with self._cond:
+            self._heap.clear()
+            self._cond.notify()
+
+    def next_runs(self) -> list[tuple[str, datetime]]:
+        with self._cond:
+            return [(e.name, datetime.fromtimestamp(ts)) for ts, _, e in sorted(self._heap)]
+
+    def _push(self, entry: ScheduledEntry, when: datetime):
+        heapq.heappush(self._heap, (when.timestamp(), next(self._seq), entry))
+        logging.info("Flow '%s' : prochaine exécution %s", entry.name, when.isoformat(sep=" "))
+
+    # ---- signals ----
+    def install_signal_handlers(self, on_reload=None):
+        """
+        SIGINT/SIGTERM arrêtent la boucle et annulent les jobs en cours, SIGHUP appelle `on_reload` depuis la boucle.
+        Doit être appelé depuis le thread principal.
+        """
+        self._on_reload = on_reload
+        signal.signal(signal.SIGINT, lambda *_: self._wake_from_signal(stop=True))
+        signal.signal(signal.SIGTERM, lambda *_: self._wake_from_signal(stop=True))
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda *_: self._wake_from_signal(reload=True))
+
+    def _wake_from_signal(self, stop: bool = False, reload: bool = False):
+        # Un handler de signal ne doit pas prendre le verrou de la boucle : on délègue à un thread.
+        def wake():
+            if stop:
+                request_cancel()
+            with self._cond:
+                self._stopping = self._stopping or stop
+                self._reload_requested = self._reload_requested or reload
+                self._cond.notify()
+        threading.Thread(target=wake, daemon=True).start()
+
+    def request_reload(self):
+        """Demande un rechargement (modification du fichier de flows) ; exécuté par la boucle."""
+        with self._cond:
+            self._reload_requested = True
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+    # ---- loop ----
+    def run_forever(self, wait_for_workers: bool = True):
+        """Exécute la boucle jusqu'à l'arrêt (stop(), SIGINT ou SIGTERM)."""
+        with self._cond:
+            while not self._stopping:
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self._reload()
+                    continue
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    planned, _, entry = heapq.heappop(self._heap)
+                    self._push(entry, entry.trigger.next_after(datetime.fromtimestamp(max(planned, now))))
+                    self._launch(entry, planned)
+                    continue
+                timeout = min(self._heap[0][0] - now, MAX_WAIT_S) if self._heap else MAX_WAIT_S
+                self._cond.wait(timeout)
+        logging.info("Scheduler arrêté.")
+        if wait_for_workers:
+            for worker in list(self._workers):
+                logging.info("Attente de la fin de %s…", worker.name)
+                worker.join()
+
+    def _reload(self):
+        logging.info("Rechargement de la planification demandé.")
+        if self._on_reload is None:
+            return
+        # Le callback re-planifie via add() : on relâche le verrou pendant l'appel.
+        self._cond.release()
+        try:
+            self._on_reload(self)
+        except Exception as e:
+            logging.error("Erreur lors du rechargement : %s", e)
+        finally:
+            self._cond.acquire()
+
+    def _launch(self, entry: ScheduledEntry, planned: float):
+        worker = threading.Thread(target=self._run_entry, args=(entry, planned), name=f"flow-{entry.name}")
+        self._workers.add(worker)
+        worker.start()
+
+    def _run_entry(self, entry: ScheduledEntry, planned: float):
+        lag = max(0.0, time.time() - planned)
+        SCHEDULER_LAG.observe(lag, flow=entry.name)
+        logging.info("Déclenchement du flow '%s' (retard %.3fs)", entry.name, lag)
+        try:
+            entry.callback()
+        except Exception as e:
+            logging.error("Error in flow %s: %s", entry.name, e)
+        finally:
+            with self._cond:
+                self._workers.discard(threading.current_thread())
 
 
 # === Scheduler setup ===
-def schedule_jobs(config: dict):
-    # build a map for lookup by name
-    jobs_map = { job["name"]: job for job in config.get("jobs", []) }
+def schedule_jobs(CONFIG: dict, plan, engine: SchedulerEngine, python_distrib: str | None = None, args=None) -> int:
+    # Chaque callback garde la table des jobs de ce plan : un rechargement ne modifie pas les runs en cours
+    jobs_map = plan.jobs
 
     # only schedule the flow jobs
-    for flow in (j for j in jobs_map.values() if j["type"] == "flow"):
-        sched = flow["schedule"]
-        tm    = flow["time"]
-        steps = flow["steps"]
-        if sched == "daily_at":
-            schedule.every().day.at(tm).do(
-                run_flow,
-                steps=steps,
-                jobs_map=jobs_map
-            )
-            logging.info("Flow '%s' planifié daily_at %s", flow["name"], tm)
-        elif sched == "minute_at":
-            schedule.every().minute.at(tm).do(
-                run_flow,
-                steps=steps,
-                jobs_map=jobs_map
-            )
-            logging.info("Flow '%s' planifié minute_at %s", flow["name"], tm)
-        elif sched == "hourly_at":
-            schedule.every().hour.at(tm).do(
-                run_flow,
-                steps=steps,
-                jobs_map=jobs_map
-            )
-            logging.info("Flow '%s' planifié hourly_at %s", flow["name"], tm)
-        
-        else:
-            logging.error("Cron type non supporté: %s", sched)
+    scheduled = 0
+    for flow in plan.flows:
+        try:
+            trigger = make_trigger(flow)
+            guard = guard_for_flow(CONFIG, flow)
+        except (KeyError, ValueError) as e:
+            logging.error("Flow '%s' non planifié : %s", flow["name"], e)
+            continue
+
+        def callback(flow=flow, guard=guard):
+            guard.run(lambda: run_flow(CONFIG,
+                python_distrib=python_distrib,
+                steps=flow["steps"],
+                jobs_map=jobs_map,
+                args=args,
+                max_parallel=flow.get("max_parallel"),
+                flow_name=flow["name"],
+                timeout_s=timeout_seconds(flow)
+            ))
+
+        engine.add(flow["name"], trigger, callback)
+        logging.info("Flow '%s' planifié %s %s", flow["name"], flow["schedule"], flow.get("cron") or flow.get("time"))
+        scheduled += 1
+    return scheduled
@@ -3,13 +3,16 @@
 import argparse
 import os
 import sys
+import hashlib
 import logging
-import yaml
-import toml
-from logging.handlers import TimedRotatingFileHandler
+import pickle
 import re
+# yaml et toml sont importés à l'usage : les sous-commandes servies par les caches ne les chargent pas
 
 
+# Variable ${...} d'un chemin
+VARIABLE_RE = re.compile(r"\$\{(.+?)\}")
+
 
 ################################################# CLI Parser #################################################
 def parse_args():
@@ -33,13 +36,36 @@ def parse_args():
     )
 
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
-    parser.add_argument("--dry-run", action="store_true") # Argument pour un mode de test sans exécution réelle
+    parser.add_argument( # Prévisualisation : aucun process lancé (voir la sous-commande plan)
+        "--dry-run",
+        action="store_true",
+        help="Print the execution plan with estimated durations instead of running anything"
+    )
     #parser.add_argument("--dbt-args", default="") # Possibilité de passer des arguments à dbt
     #parser.add_argument("--git-args", default="") # Possibilité de passer des arguments à git
     #parser.add_argument("--python-interpreter", default=sys.executable) # Interpréteur Python à utiliser
     #parser.add_argument("--python-script", default="") # Chemin du script Python à exécuter
     #parser.add_argument("--python-args", default="") # Arguments à passer au script Python
 
+    subparsers = parser.add_subparsers(dest="command")
+
+    stats = subparsers.add_parser("stats", help="Print p50/p95 durations and trends per job from the run history")
+    stats.add_argument("--job", default=None, help="Only this job")
+    stats.add_argument("--flow", default=None, help="Only jobs run by this flow")
+    stats.add_argument("--days", type=int, default=30, help="History window in days (default: 30)")
+    stats.add_argument("--trend-days", type=int, default=7, help="Trend: last N days vs the N days before (default: 7)")
+
+    subparsers.add_parser("list", help="List the flows and jobs of the environment's flows file")
+    subparsers.add_parser("validate", help="Check config.yml and the environment's flows file, then exit")
+    run_job = subparsers.add_parser("run-job", help="Run one job now (no scheduler), exit with its status")
+    run_job.add_argument("name", help="Job name")
+    run_flow = subparsers.add_parser("run-flow", help="Run one flow now (no scheduler), exit with its status")
+    run_flow.add_argument("name", help="Flow name")
+    plan = subparsers.add_parser("plan", help="Preview flows: job order, estimated durations, critical path and ETA")
+    plan.add_argument("flows", nargs="*", help="Only these flows (default: all)")
+    plan.add_argument("--days", type=int, default=30, help="History window in days (default: 30)")
+    plan.add_argument("--percentile", type=float, default=50, help="Duration estimate percentile (default: 50)")
+
     return parser.parse_args()
 
 ############################################### load_config ###############################################
@@ -47,10 +73,24 @@ def parse_args():
 Module de chargement du fichier de configuration utilisé par Drapo
 """
 
+class FrozenDict(dict):
+    """dict en lecture seule (reste sérialisable en JSON comme un dict)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Objet en lecture seule (config compilée ou plan d'orchestration)")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
 def load_config(config_path: str) -> dict:
     """
     Charge le fichier YAML et résout les variables ${...}
     """
+    import yaml
     with open(config_path, "r", encoding="utf-8") as f:
         data = yaml.safe_load(f)
 
@@ -70,19 +110,87 @@ def load_config(config_path: str) -> dict:
     for k, v in data["flows"].items():
         resolved = v
         # Remplace toutes les occurrences ${...}
-        matches = re.findall(r"\$\{(.+?)\}", v)
-        for var in matches:
+        for var in VARIABLE_RE.findall(v):
             resolved = resolved.replace("${" + var + "}", variables[var])
         flows[k] = resolved
+    variables.update(flows)
+    # Chaque variable "${nom}" est résolue ici, une fois : resolve_path n'a plus qu'une lecture à faire
+    resolved = {"${" + k + "}": os.path.abspath(v) for k, v in variables.items()}
 
     return {
         "project_root": data["project_root"],
         "paths": paths,
-        "flows": flows
+        "flows": flows,
+        # Calculés une fois : resolve_path ne reconstruit plus les variables à chaque appel
+        "variables": variables,
+        "resolved": FrozenDict(resolved),
+        "logging": data.get("logging") or {},
+        "cache": data.get("cache") or {},
+        "python_pool": data.get("python_pool") or {},
+        "sampling": data.get("sampling") or {},
+        "metrics": data.get("metrics") or {},
+        "reload": data.get("reload") or {},
+        "distributed": data.get("distributed") or {}
     }
 
 # CONFIG = load_config("../config.yml")
 
+
+############################################### Startup cache ###############################################
+"""
+Cache disque des configurations déjà analysées (~/.cache/drapo, ou $XDG_CACHE_HOME/drapo) :
+un démarrage ne relit un fichier que si sa signature (mtime, taille) a changé.
+"""
+
+
+def cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "drapo")
+
+
+def file_signature(*paths: str) -> tuple:
+    """(mtime_ns, taille) de chaque fichier ; lève OSError si l'un d'eux manque."""
+    return tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, paths))
+
+
+def _cache_file(kind: str, source: str) -> str:
+    key = hashlib.sha1(os.path.abspath(source).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir(), f"{kind}-{key}.pickle")
+
+
+def read_cache(kind: str, source: str, signature: tuple):
+    """Objet mis en cache pour `source`, ou None si absent, illisible ou périmé."""
+    try:
+        with open(_cache_file(kind, source), "rb") as f:
+            cached_signature, value = pickle.load(f)
+    except Exception:
+        return None
+    return value if cached_signature == signature else None
+
+
+def write_cache(kind: str, source: str, signature: tuple, value):
+    """Écrit le cache (remplacement atomique) ; un cache non inscriptible est simplement ignoré."""
+    path = _cache_file(kind, source)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "wb") as f:
+            pickle.dump((signature, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.debug("Cache %s non écrit : %s", path, e)
+
+
+def load_config_cached(config_path: str) -> dict:
+    """load_config, servi depuis le cache disque tant que config.yml n'a pas changé."""
+    # Ce module fait partie de la signature : la forme du CONFIG produit suit son code
+    signature = file_signature(config_path, __file__)
+    CONFIG = read_cache("config", config_path, signature)
+    if CONFIG is None:
+        CONFIG = load_config(config_path)
+        write_cache("config", config_path, signature, CONFIG)
+    return CONFIG
+
 ############################################### Path resolver ###############################################
 """
 Module utilitaire pour résoudre les chemins de fichiers dans Drapo.
@@ -100,14 +208,20 @@ def resolve_path(path: str, config: dict) -> str:
     if os.path.isabs(path):
         return path
 
+    # Variables précalculées par load_config (lecture seule)
+    resolved = config.get("resolved")
+    if resolved is not None and path in resolved:
+        return resolved[path]
+
     # Remplace les variables ${...}
-    variables = {"project_root": config.get("project_root", "")}
-    variables.update(config.get("paths", {}))
-    variables.update(config.get("flows", {}))
+    variables = config.get("variables")
+    if variables is None:
+        variables = {"project_root": config.get("project_root", "")}
+        variables.update(config.get("paths", {}))
+        variables.update(config.get("flows", {}))
 
     resolved = path
-    matches = re.findall(r"\$\{(.+?)\}", path)
-    for var in matches:
+    for var in VARIABLE_RE.findall(path):
         if var not in variables:
             raise ValueError(f"Variable '{var}' inconnue dans le chemin: {path}")
         resolved = resolved.replace("${" + var + "}", variables[var])
@@ -115,13 +229,29 @@ def resolve_path(path: str, config: dict) -> str:
     # Normalise et absolutise
     return os.path.abspath(resolved)
 
+
+# Chemin du dépôt git orchestré dans config.yml : `git_repo` (ou `git`, ancien nom)
+GIT_PATH_KEYS = ("git_repo", "git")
+
+
+def git_repo_dir(config: dict) -> str:
+    """
+    Répertoire du dépôt git du projet, mis à jour par les jobs git et lu par `cache.git`.
+    Lève ValueError si config.yml ne déclare ni `git_repo` ni `git` dans `paths`.
+    """
+    for key in GIT_PATH_KEYS:
+        if key in config.get("paths", {}):
+            return resolve_path("${" + key + "}", config)
+    raise ValueError("aucun chemin 'git_repo' dans la section paths de config.yml")
+
 ############################################### TOML Parser ###############################################
 """
 Module pour charger la configuration d'orchestration depuis un fichier TOML.
 """
 
 def load_orchestration_config(CONFIG,fn: str) -> dict:
-    path = resolve_path("${drapoconfig}",CONFIG)
+    import toml
+    path = resolve_path(fn,CONFIG)
     logging.info("Lecture de la config depuis %s", path)
     with open(path, "r", encoding="utf-8") as f:
         return toml.load(f)
@@ -129,18 +259,14 @@ def load_orchestration_config(CONFIG,fn: str) -> dict:
 
 ########################################## Console logger ##########################################
 
-def setup_logger(CONFIG):
+def setup_logger(CONFIG, filename: str = "drapo.log"):
     """
     Initialise le logger avec la config YAML passée en argument.
+    Les records passent par une file : console et fichiers sont écrits par lots dans un thread dédié
+    (voir drapo.logs). La section `logging` de config.yml règle batch_size, queue_size,
+    job_logs (un fichier par exécution de job) et compress (gzip à la rotation).
     """
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    from drapo.logs import BatchStreamHandler, BatchTimedRotatingFileHandler, setup_pipeline
 
     # Under Windows switch console to UTF-8
     if os.name == "nt":
@@ -156,23 +282,26 @@ def setup_logger(CONFIG):
 
     format_str = "%(asctime)s [%(levelname)s] %(message)s"
     date_fmt   = "%Y-%m-%d %H:%M:%S"
+    formatter  = logging.Formatter(format_str, datefmt=date_fmt)
+    settings   = CONFIG.get("logging", {})
 
     # Console handler
-    console_h = logging.StreamHandler()
-    console_formatter = logging.Formatter(format_str, datefmt=date_fmt)
-    console_h.setFormatter(console_formatter)
-    logger.addHandler(console_h)
+    console_h = BatchStreamHandler(sys.stdout)
+    console_h.setFormatter(formatter)
 
     # File handler (rotates daily, keeps 30 days)
-    log_file = resolve_path("${drapolog}", CONFIG)
-    file_handler = TimedRotatingFileHandler(
-        filename=log_file,
+    log_dir = resolve_path("${drapolog}", CONFIG)
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = BatchTimedRotatingFileHandler(
+        filename=os.path.join(log_dir, filename),
         when="midnight",
         interval=1,
         backupCount=30,
         encoding="utf-8",
+        compress=settings.get("compress", False),
     )
-    file_handler.setFormatter(console_h)
-    logger.addHandler(file_handler)
+    file_handler.setFormatter(formatter)
+
+    setup_pipeline([console_h, file_handler], log_dir, settings)
 
     return logger
\ No newline at end of file
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# worker.py
+"""
+Process `drapo-worker` : exécute les jobs déposés dans la file distribuée (voir drapo.distributed).
+
+    drapo-worker [--name w1] [--concurrency 2]
+
+    Le worker lit le même config.yml que le scheduler (section `distributed` activée),
+    prend les jobs par priorité, les exécute avec les runners de Drapo et écrit leur résultat
+    dans la file. Un thread signale périodiquement les jobs en cours ; il arrête ceux que le
+    coordinateur annule ou qu'un autre worker a repris.
+    Plusieurs workers peuvent tourner sur la même machine (un fichier de log par worker).
+
+    SIGTERM / Ctrl-C : le worker ne prend plus de job et attend la fin des jobs en cours ;
+    un second signal les arrête et les rend à la file pour un autre worker.
+"""
+
+import os
+import re
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+
+from drapo.utils import load_config, setup_logger
+from drapo.common import CancelScope, cancel_scope, deadline, interrupted, request_cancel
+from drapo.logs import job_log
+from drapo.sampler import configure_sampler
+from drapo.orchestrer import _run_job
+from drapo.distributed import JobQueue, configure_distributed, encode_result
+
+
+class Worker:
+    def __init__(self, CONFIG: dict, queue: JobQueue, name: str, concurrency: int = 1):
+        self.CONFIG = CONFIG
+        self.queue = queue
+        self.name = name
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._running: dict[int, CancelScope] = {}
+        self._stop_reasons: dict[int, str] = {}
+        self._draining = threading.Event()
+        self._idle = threading.Event()
+
+    def run(self):
+        self.queue.register(self.name, os.getpid())
+        logging.info("Worker %s prêt (%d job(s) simultané(s)).", self.name, self.concurrency)
+        threading.Thread(target=self._heartbeat_loop, name="drapo-heartbeat", daemon=True).start()
+        slots = [threading.Thread(target=self._slot_loop, name=f"drapo-slot-{i}") for i in range(self.concurrency)]
+        for slot in slots:
+            slot.start()
+        for slot in slots:
+            slot.join()
+        self._idle.set()
+        self.queue.unregister(self.name)
+        logging.info("Worker %s arrêté.", self.name)
+
+    def stop(self):
+        """Premier arrêt : plus de nouveau job ; second : les jobs en cours sont arrêtés et rendus à la file."""
+        if not self._draining.is_set():
+            logging.info("Worker %s : arrêt demandé, fin des jobs en cours…", self.name)
+            self._draining.set()
+        else:
+            logging.warning("Worker %s : arrêt immédiat, jobs en cours rendus à la file.", self.name)
+            request_cancel()
+
+    def _slot_loop(self):
+        poll_s = float(self.queue.settings["poll_s"])
+        while not self._draining.is_set():
+            claimed = self.queue.claim(self.name)
+            if claimed is None:
+                self._draining.wait(poll_s)
+                continue
+            self._execute(*claimed)
+
+    def _heartbeat_loop(self):
+        heartbeat_s = float(self.queue.settings["heartbeat_s"])
+        while not self._idle.wait(heartbeat_s):
+            with self._lock:
+                job_ids = list(self._running)
+            try:
+                stops = self.queue.heartbeat(self.name, job_ids)
+                self.queue.requeue_expired()
+            except Exception as e:
+                logging.error("Worker %s : file inaccessible (%s).", self.name, e)
+                continue
+            for job_id, reason in stops.items():
+                with self._lock:
+                    scope = self._running.get(job_id)
+                    if scope is None or job_id in self._stop_reasons:
+                        continue
+                    self._stop_reasons[job_id] = reason
+                logging.warning("Job #%d : %s, arrêt.", job_id,
+                                "annulé par le coordinateur" if reason == "cancelled" else "repris par un autre worker")
+                scope.cancel()
+
+    def _execute(self, job_id: int, payload: dict):
+        job = payload["job"]
+        args = argparse.Namespace(**payload["args"])
+        deadline_at = payload.get("deadline_at")
+        # Échéance transmise en heure murale : le coordinateur peut être sur une autre machine
+        timeout_s = None if deadline_at is None else max(0.001, deadline_at - time.time())
+        scope = CancelScope(job["name"])
+        with self._lock:
+            self._running[job_id] = scope
+        logging.info("Job %s (#%d) pris par %s.", job["name"], job_id, self.name)
+        ok, result, termination, error = False, None, None, None
+        try:
+            with cancel_scope(scope), job_log(job["name"]) as log_path, deadline(timeout_s):
+                if log_path:
+                    logging.info("Log du job %s : %s", job["name"], log_path)
+                try:
+                    ok, result = _run_job(self.CONFIG, job, sys.executable, args, None, log_path)
+                except Exception as e:
+                    # Erreur déterministe : le job est terminé en échec, pas repris par un autre worker
+                    logging.error("Job %s (#%d) en erreur : %s", job["name"], job_id, e)
+                    error = f"{type(e).__name__}: {e}"
+                if not ok:
+                    termination = (result.termination if result is not None else None) or interrupted()
+        finally:
+            with self._lock:
+                del self._running[job_id]
+                reason = self._stop_reasons.pop(job_id, None)
+
+        if reason == "lost":
+            return
+        try:
+            if termination == "cancelled" and reason != "cancelled":
+                # Arrêt du worker, pas du coordinateur : un autre worker reprendra le job
+                self.queue.release(job_id, self.name)
+                logging.info("Job %s (#%d) rendu à la file.", job["name"], job_id)
+                return
+            status = "success" if ok else (termination or "failed")
+            # Même forme que les jobs abandonnés par la file : le coordinateur journalise l'erreur
+            payload = encode_result(result) if error is None else {"error": error}
+            if not self.queue.complete(job_id, self.name, status, payload):
+                logging.warning("Job %s (#%d) repris par un autre worker : résultat ignoré.", job["name"], job_id)
+        except Exception as e:
+            # File inaccessible (ex. base verrouillée) : le slot continue, le bail expiré remettra le job en file
+            logging.error("Job %s (#%d) : résultat non enregistré dans la file (%s).", job["name"], job_id, e)
+
+
+def parse_worker_args():
+    parser = argparse.ArgumentParser(description="DRAPO worker: runs jobs from the distributed queue")
+    parser.add_argument("--name", default=f"{socket.gethostname()}-{os.getpid()}", help="Worker name (default: host-pid)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs run at the same time (default: 1)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_worker_args()
+
+    THIS_DIR = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "..")
+    )
+    CONFIG = load_config(os.path.join(THIS_DIR, "config.yml"))
+    setup_logger(CONFIG, filename=f"worker-{re.sub(r'[^A-Za-z0-9_.-]', '_', args.name)}.log")
+    configure_sampler(CONFIG["sampling"])
+
+    queue = configure_distributed(CONFIG)
+    if queue is None:
+        logging.error("Distributed mode is disabled (distributed.enabled in config.yml).")
+        sys.exit(1)
+
+    worker = Worker(CONFIG, queue, args.name, max(1, args.concurrency))
+    # Le handler ne fait que déléguer : stop() peut arrêter des process
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: threading.Thread(target=worker.stop, daemon=True).start())
+    worker.run()
+    sys.exit(130 if interrupted() == "cancelled" else 0)
+
+
+if __name__ == "__main__":
+    main()